@@ -2,13 +2,22 @@
 Modules with background subtraction routines.
 """
 
+import os
 import sys
+import shutil
+import tempfile
 
+from bisect import bisect_right
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import h5py
 import numpy as np
 
+from scipy import linalg
 from scipy.sparse.linalg import svds
-from scipy.optimize import curve_fit
 
+from PynPoint.Core.DataIO import DataStorage
 from PynPoint.Core.Processing import ProcessingModule
 from PynPoint.ProcessingModules.BadPixelCleaning import BadPixelSigmaFilterModule
 from PynPoint.ProcessingModules.ImageResizing import CropImagesModule
@@ -129,11 +138,14 @@ class MeanBackgroundSubtractionModule(ProcessingModule):
         """
         Run method of the module. Mean background subtraction which uses either a constant index
         offset or the NFRAMES attributes. The mean background is calculated from the cubes before
-        and after the science cube.
+        and after the science cube. The cubes are read once, while the mean of the previous cube
+        is kept, and the output is written in blocks of MEMORY images.
 
         :return: None
         """
 
+        memory = self._m_config_port.get_attribute("MEMORY")
+
         # Use NFRAMES values if shift=None
         if self.m_shift is None:
             self.m_shift = self.m_image_in_port.get_attribute("NFRAMES")
@@ -147,113 +159,61 @@ class MeanBackgroundSubtractionModule(ProcessingModule):
         if self.m_image_in_port.tag == self.m_image_out_port.tag:
             raise ValueError("The tag of the input port should be different from the output port.")
 
-        # Number of substacks
-        if isinstance(self.m_shift, np.ndarray):
-            nstacks = np.size(self.m_shift)
-        else:
-            nstacks = int(np.floor(nframes/self.m_shift))
-
-        # First mean subtraction to set up the output port array
+        # Image indices of the first frame of each dithering position and the end of the stack
         if isinstance(self.m_shift, np.ndarray):
-            next_start = np.sum(self.m_shift[0:self.m_cubes])
-            next_end = np.sum(self.m_shift[0:2*self.m_cubes])
-
             if 2*self.m_cubes > np.size(self.m_shift):
                 raise ValueError("Not enough frames available for the background subtraction.")
 
-            bg_data = self.m_image_in_port[next_start:next_end, ]
-            bg_mean = np.mean(bg_data, axis=0)
+            edges = np.concatenate(([0], np.cumsum(self.m_shift)))
+            edges = np.append(edges[:-1:self.m_cubes], edges[-1])
 
         else:
-            bg_data = self.m_image_in_port[self.m_shift:2*self.m_shift, ]
-            bg_mean = np.mean(bg_data, axis=0)
+            # remaining frames are added to the last cube
+            edges = np.append(np.arange(nframes//self.m_shift)*self.m_shift, nframes)
 
-        # Initiate the result port data with the first frame
-        bg_sub = self.m_image_in_port[0, ] - bg_mean
-        self.m_image_out_port.set_all(bg_sub, data_dim=3)
+        self.m_image_out_port.del_all_data()
 
-        # Mean subtraction of the first stack (minus the first frame)
-        if isinstance(self.m_shift, np.ndarray):
-            tmp_data = self.m_image_in_port[1:next_start, ]
-            tmp_data = tmp_data - bg_mean
-            self.m_image_out_port.append(tmp_data)
+        buffer_sub = []
 
-        else:
-            tmp_data = self.m_image_in_port[1:self.m_shift, ]
-            tmp_data = tmp_data - bg_mean
-            self.m_image_out_port.append(tmp_data)
+        def _write(images):
+            buffer_sub.append(images)
 
-        # Processing of the rest of the data
-        if isinstance(self.m_shift, np.ndarray):
-            for i in range(self.m_cubes, nstacks, self.m_cubes):
-                progress(i, nstacks, "Running MeanBackgroundSubtractionModule...")
+            if not memory or sum(item.shape[0] for item in buffer_sub) >= memory:
+                self.m_image_out_port.append(np.concatenate(buffer_sub, axis=0), data_dim=3)
+                del buffer_sub[:]
+
+        nstacks = edges.size-1
 
-                prev_start = np.sum(self.m_shift[0:i-self.m_cubes])
-                prev_end = np.sum(self.m_shift[0:i])
+        mean_prev = None
+        im_curr = self.m_image_in_port[edges[0]:edges[1], ]
+        mean_curr = np.mean(im_curr, axis=0)
 
-                next_start = np.sum(self.m_shift[0:i+self.m_cubes])
-                next_end = np.sum(self.m_shift[0:i+2*self.m_cubes])
+        for i in range(nstacks):
+            progress(i, nstacks, "Running MeanBackgroundSubtractionModule...")
 
-                # calc the mean (previous)
-                tmp_data = self.m_image_in_port[prev_start:prev_end, ]
-                tmp_mean = np.mean(tmp_data, axis=0)
+            if i < nstacks-1:
+                im_next = self.m_image_in_port[edges[i+1]:edges[i+2], ]
+                mean_next = np.mean(im_next, axis=0)
 
-                if i < nstacks-self.m_cubes:
-                    # calc the mean (next)
-                    tmp_data = self.m_image_in_port[next_start:next_end, ]
-                    tmp_mean = (tmp_mean + np.mean(tmp_data, axis=0)) / 2.0
+            else:
+                im_next = None
+                mean_next = None
 
-                # subtract mean
-                tmp_data = self.m_image_in_port[prev_end:next_start, ]
-                tmp_data = tmp_data - tmp_mean
-                self.m_image_out_port.append(tmp_data)
+            if mean_prev is None:
+                bg_mean = mean_next
+            elif mean_next is None:
+                bg_mean = mean_prev
+            else:
+                bg_mean = (mean_prev + mean_next) / 2.0
 
-        else:
-            # the last and the one before will be performed afterwards
-            top = int(np.ceil(nframes/self.m_shift)) - 2
-
-            for i in range(1, top, 1):
-                progress(i, top, "Running MeanBackgroundSubtractionModule...")
-
-                # calc the mean (next)
-                tmp_data = self.m_image_in_port[(i+1)*self.m_shift:(i+2)*self.m_shift, ]
-                tmp_mean = np.mean(tmp_data, axis=0)
-
-                # calc the mean (previous)
-                tmp_data = self.m_image_in_port[(i-1)*self.m_shift:(i+0)*self.m_shift, ]
-                tmp_mean = (tmp_mean + np.mean(tmp_data, axis=0)) / 2.0
-
-                # subtract mean
-                tmp_data = self.m_image_in_port[(i+0)*self.m_shift:(i+1)*self.m_shift, ]
-                tmp_data = tmp_data - tmp_mean
-                self.m_image_out_port.append(tmp_data)
-
-            # last and the one before
-            # 1. ------------------------------- one before -------------------
-            # calc the mean (previous)
-            tmp_data = self.m_image_in_port[(top-1)*self.m_shift:(top+0)*self.m_shift, ]
-            tmp_mean = np.mean(tmp_data, axis=0)
-
-            # calc the mean (next)
-            # "nframes" is important if the last step is to huge
-            tmp_data = self.m_image_in_port[(top+1)*self.m_shift:nframes, ]
-            tmp_mean = (tmp_mean + np.mean(tmp_data, axis=0)) / 2.0
-
-            # subtract mean
-            tmp_data = self.m_image_in_port[top*self.m_shift:(top+1)*self.m_shift, ]
-            tmp_data = tmp_data - tmp_mean
-            self.m_image_out_port.append(tmp_data)
-
-            # 2. ------------------------------- last -------------------
-            # calc the mean (previous)
-            tmp_data = self.m_image_in_port[(top+0)*self.m_shift:(top+1)*self.m_shift, ]
-            tmp_mean = np.mean(tmp_data, axis=0)
-
-            # subtract mean
-            tmp_data = self.m_image_in_port[(top+1)*self.m_shift:nframes, ]
-            tmp_data = tmp_data - tmp_mean
-            self.m_image_out_port.append(tmp_data)
-            # -----------------------------------------------------------
+            _write(im_curr - bg_mean)
+
+            mean_prev = mean_curr
+            mean_curr = mean_next
+            im_curr = im_next
+
+        if buffer_sub:
+            self.m_image_out_port.append(np.concatenate(buffer_sub, axis=0), data_dim=3)
 
         sys.stdout.write("Running MeanBackgroundSubtractionModule... [DONE]\n")
         sys.stdout.flush()
@@ -324,15 +284,6 @@ class PCABackgroundPreparationModule(ProcessingModule):
     def _prepare(self):
         nframes = self.m_image_in_port.get_attribute("NFRAMES")
 
-        cube_mean = np.zeros((nframes.shape[0],
-                              self.m_image_in_port.get_shape()[2],
-                              self.m_image_in_port.get_shape()[1]))
-
-        count = 0
-        for i, item in enumerate(nframes):
-            cube_mean[i, ] = np.mean(self.m_image_in_port[count:count+item, ], axis=0)
-            count += item
-
         if self.m_dither[1] is None:
             dither_x = self.m_image_in_port.get_attribute("DITHER_X")
             dither_y = self.m_image_in_port.get_attribute("DITHER_Y")
@@ -351,46 +302,34 @@ class PCABackgroundPreparationModule(ProcessingModule):
 
                 bg_frames[i:i+self.m_dither[1]] = False
 
-        return bg_frames, cube_mean
-
-    def _separate(self, bg_frames, bg_indices, parang, cube_mean):
-
-        def _initialize():
-            background_nframes = np.empty(0, dtype=np.int64)
-            star_nframes = np.empty(0, dtype=np.int64)
+        return bg_frames
 
-            background_index = np.empty(0, dtype=np.int64)
-            star_index = np.empty(0, dtype=np.int64)
-
-            if parang is None:
-                background_parang = None
-                star_parang = None
-
-            else:
-                background_parang = np.empty(0, dtype=np.float64)
-                star_parang = np.empty(0, dtype=np.float64)
-
-            return star_index, star_parang, star_nframes, background_index, \
-                   background_parang, background_nframes
+    def _separate(self, bg_frames):
+        """
+        Reads each cube once. The star cubes are kept until the next background cube has been
+        read, after which the mean of the previous and next background cube is subtracted. The
+        output is written in blocks of MEMORY images.
+        """
 
-        def _select_background(i):
+        memory = self._m_config_port.get_attribute("MEMORY")
+        nframes = self.m_image_in_port.get_attribute("NFRAMES")
 
-            # Previous background cube
-            if np.size(bg_indices[bg_indices < i]) > 0:
-                index_prev = np.amax(bg_indices[bg_indices < i])
-                bg_prev = cube_mean[index_prev, ]
+        buffers = {self.m_star_out_port: [],
+                   self.m_mean_out_port: [],
+                   self.m_background_out_port: []}
 
-            else:
-                bg_prev = None
+        def _flush(port):
+            if buffers[port]:
+                port.append(np.concatenate(buffers[port], axis=0), data_dim=3)
+                buffers[port] = []
 
-            # Next background cube
-            if np.size(bg_indices[bg_indices > i]) > 0:
-                index_next = np.amin(bg_indices[bg_indices > i])
-                bg_next = cube_mean[index_next, ]
+        def _write(port, images):
+            buffers[port].append(images)
 
-            else:
-                bg_next = None
+            if memory and sum(item.shape[0] for item in buffers[port]) >= memory:
+                _flush(port)
 
+        def _write_star(bg_prev, bg_next):
             # Select background: previous, next, or mean of previous and next
             if bg_prev is None and bg_next is not None:
                 background = bg_next
@@ -404,13 +343,15 @@ class PCABackgroundPreparationModule(ProcessingModule):
             else:
                 raise ValueError("Neither previous nor next background frames found.")
 
-            return background
+            for im_star in star_cubes:
+                _write(self.m_star_out_port, im_star)
+                _write(self.m_mean_out_port, im_star-background)
 
-        nframes = self.m_image_in_port.get_attribute("NFRAMES")
-        index = self.m_image_in_port.get_attribute("INDEX")
+            del star_cubes[:]
 
-        star_index, star_parang, star_nframes, background_index, background_parang, \
-            background_nframes = _initialize()
+        # Mean of the last background cube and star cubes without a next background cube
+        bg_prev = None
+        star_cubes = []
 
         # Separate star and background cubes. Subtract mean background.
         count = 0
@@ -419,45 +360,40 @@ class PCABackgroundPreparationModule(ProcessingModule):
 
             im_tmp = self.m_image_in_port[count:count+item, ]
 
-            if self.m_mean:
-                for j in enumerate(item):
-                    im_tmp[j, ] -= np.mean(im_tmp[j, ])
-
             # Background frames
             if bg_frames[i]:
-                background = cube_mean[i, ]
-                self.m_background_out_port.append(im_tmp)
-                # self.m_background_out_port.append(im_tmp-background)
+                bg_next = np.mean(im_tmp, axis=0)
 
-                background_nframes = np.append(background_nframes, nframes[i])
-                background_index = np.append(background_index, index[count:count+item])
+                if self.m_mean:
+                    im_tmp -= np.mean(im_tmp, axis=(1, 2))[:, np.newaxis, np.newaxis]
 
-                if parang is not None:
-                    background_parang = np.append(background_parang, parang[count:count+item])
+                _write(self.m_background_out_port, im_tmp)
 
-            # Star frames
-            else:
-                background = _select_background(i)
+                if star_cubes:
+                    _write_star(bg_prev, bg_next)
 
-                self.m_star_out_port.append(im_tmp)
-                self.m_mean_out_port.append(im_tmp-background)
+                bg_prev = bg_next
 
-                star_nframes = np.append(star_nframes, nframes[i])
-                star_index = np.append(star_index, index[count:count+item])
+            # Star frames
+            else:
+                if self.m_mean:
+                    im_tmp -= np.mean(im_tmp, axis=(1, 2))[:, np.newaxis, np.newaxis]
 
-                if parang is not None:
-                    star_parang = np.append(star_parang, parang[count:count+item])
+                star_cubes.append(im_tmp)
 
             count += item
 
-        return star_index, star_parang, star_nframes, background_index, \
-               background_parang, background_nframes
+        if star_cubes:
+            _write_star(bg_prev, None)
+
+        for port in buffers:
+            _flush(port)
 
     def run(self):
         """
         Run method of the module. Separates the star and background frames, subtracts the mean
         background from both the star and background frames, and writes the star and background
-        frames separately.
+        frames separately. Each cube is read only once.
 
         :return: None
         """
@@ -472,22 +408,32 @@ class PCABackgroundPreparationModule(ProcessingModule):
         self.m_background_out_port.del_all_attributes()
 
         nframes = self.m_image_in_port.get_attribute("NFRAMES")
+        index = self.m_image_in_port.get_attribute("INDEX")
 
         if "PARANG" in self.m_image_in_port.get_all_non_static_attributes():
             parang = self.m_image_in_port.get_attribute("PARANG")
         else:
             parang = None
 
-        bg_frames, cube_mean = self._prepare()
-
-        bg_indices = np.nonzero(bg_frames)[0]
+        bg_frames = self._prepare()
 
-        star_index, star_parang, star_nframes, background_index, background_parang, \
-            background_nframes = self._separate(bg_frames, bg_indices, parang, cube_mean)
+        self._separate(bg_frames)
 
         sys.stdout.write("Running PCABackgroundPreparationModule... [DONE]\n")
         sys.stdout.flush()
 
+        bg_images = np.repeat(bg_frames, nframes)
+
+        star_nframes = nframes[~bg_frames]
+        star_index = index[~bg_images]
+
+        background_nframes = nframes[bg_frames]
+        background_index = index[bg_images]
+
+        if parang is not None:
+            star_parang = parang[~bg_images]
+            background_parang = parang[bg_images]
+
         self.m_star_out_port.copy_attributes_from_input_port(self.m_image_in_port)
 
         self.m_star_out_port.add_attribute("NFRAMES", star_nframes, static=False)
@@ -602,26 +548,16 @@ class PCABackgroundSubtractionModule(ProcessingModule):
         :return: None
         """
 
-        def _create_mask(radius, position, nimages):
+        def _create_mask(radius, position):
             """
             Method for creating a circular mask at the star or planet position.
             """
 
-            npix = self.m_star_in_port.get_shape()[1]
-
-            x_grid = np.arange(0, npix, 1)
-            y_grid = np.arange(0, npix, 1)
-
-            xx_grid, yy_grid = np.meshgrid(x_grid, y_grid)
-
-            mask = np.ones((nimages, npix, npix))
-
-            cent_x = position[:, 1]
-            cent_y = position[:, 0]
+            rr_grid = (xx_grid[np.newaxis, ] - position[:, 1, np.newaxis, np.newaxis])**2 + \
+                      (yy_grid[np.newaxis, ] - position[:, 0, np.newaxis, np.newaxis])**2
 
-            for i in range(nimages):
-                rr_grid = np.sqrt((xx_grid - cent_x[i])**2 + (yy_grid - cent_y[i])**2)
-                mask[i, ][rr_grid < radius] = 0.
+            mask = np.ones(rr_grid.shape)
+            mask[rr_grid < radius**2] = 0.
 
             return mask
 
@@ -642,36 +578,33 @@ class PCABackgroundSubtractionModule(ProcessingModule):
 
         def _model_background(basis, im_arr, mask):
             """
-            Method for creating a model of the background.
+            Method for creating a model of the background with a linear least-squares fit of the
+            unmasked pixels. The normal equations of each image follow from the Gram matrix of
+            the full basis by subtracting the contribution of the masked pixels.
             """
 
-            def _dot_product(x_dot, *p):
-                return np.dot(p, x_dot)
-
-            fit_im_chi = np.zeros(im_arr.shape)
-            # fit_coeff_chi = np.zeros((im_arr.shape[0], basis.shape[0]))
-
             basis_reshaped = basis.reshape(basis.shape[0], -1)
 
-            for i in xrange(im_arr.shape[0]):
-                basis_reshaped_masked = (basis*mask[i]).reshape(basis.shape[0], -1)
+            mask = mask.reshape(mask.shape[0], -1)
 
-                data_to_fit = im_arr[i, ]
+            # the masked images are zero outside the mask
+            rhs = np.dot(im_arr.reshape(im_arr.shape[0], -1), basis_reshaped.T)
 
-                init = np.ones(basis_reshaped_masked.shape[0])
+            coeff = np.zeros(rhs.shape)
 
-                fitted = curve_fit(_dot_product,
-                                   basis_reshaped_masked,
-                                   data_to_fit.reshape(-1),
-                                   init)
+            for i in xrange(im_arr.shape[0]):
+                basis_masked = basis_reshaped[:, mask[i, ] == 0.]
+                gram_masked = gram - np.dot(basis_masked, basis_masked.T)
 
-                fit_im = np.dot(fitted[0], basis_reshaped)
-                fit_im = fit_im.reshape(data_to_fit.shape[0], data_to_fit.shape[1])
+                try:
+                    coeff[i, ] = linalg.cho_solve(linalg.cho_factor(gram_masked), rhs[i, ])
 
-                fit_im_chi[i, ] = fit_im
-                # fit_coeff_chi[i, ] = fitted[0]
+                except linalg.LinAlgError:
+                    # the unmasked pixels do not constrain all principle components
+                    coeff[i, ] = linalg.lstsq(basis_reshaped[:, mask[i, ] == 1.].T,
+                                              im_arr[i, ].reshape(-1)[mask[i, ] == 1.])[0]
 
-            return fit_im_chi
+            return np.dot(coeff, basis_reshaped).reshape(im_arr.shape)
 
         self.m_residuals_out_port.del_all_data()
         self.m_residuals_out_port.del_all_attributes()
@@ -707,7 +640,13 @@ class PCABackgroundSubtractionModule(ProcessingModule):
         sys.stdout.write(" [DONE]\n")
         sys.stdout.flush()
 
+        gram = np.dot(basis_pca.reshape(basis_pca.shape[0], -1),
+                      basis_pca.reshape(basis_pca.shape[0], -1).T)
+
         nimages = self.m_star_in_port.get_shape()[0]
+        npix = self.m_star_in_port.get_shape()[1]
+
+        xx_grid, yy_grid = np.meshgrid(np.arange(0, npix, 1), np.arange(0, npix, 1))
 
         frames = memory_frames(memory, nimages)
 
@@ -716,9 +655,7 @@ class PCABackgroundSubtractionModule(ProcessingModule):
 
             im_star = self.m_star_in_port[frames[i]:frames[i+1], ]
 
-            mask_star = _create_mask(self.m_mask_star,
-                                     star[frames[i]:frames[i+1], ],
-                                     frames[i+1]-frames[i])
+            mask_star = _create_mask(self.m_mask_star, star[frames[i]:frames[i+1], ])
 
             if self.m_mask_planet is None:
                 mask_planet = np.ones(im_star.shape)
@@ -735,9 +672,7 @@ class PCABackgroundSubtractionModule(ProcessingModule):
 
                 planet = np.stack((y_planet, x_planet))
 
-                mask_planet = _create_mask(self.m_mask_planet[3],
-                                           np.transpose(planet),
-                                           frames[i+1]-frames[i])
+                mask_planet = _create_mask(self.m_mask_planet[3], np.transpose(planet))
 
             fit_im = _model_background(basis_pca,
                                        im_star*mask_star*mask_planet,
@@ -840,6 +775,11 @@ class DitheringBackgroundModule(ProcessingModule):
              **bad_pixel** (*tuple(int, float, int)*) -- Size of the sigma filter, sigma threshold,
              and number of iterations used for removal of bad pixels before the mask is placed at
              the position of the stellar PSF.
+             **intermediate** (*bool*) -- Store the intermediate results of the dither positions
+             (e.g., dither_crop1, dither_star1) in the central database. Only the mean background
+             subtracted or PCA background subtracted frames, depending on *combine*, are stored
+             if set to False. With CPU > 1, this avoids copying the intermediate results from the
+             databases of the dither positions to the central database.
 
         :return: None
         """
@@ -874,6 +814,11 @@ class DitheringBackgroundModule(ProcessingModule):
         else:
             self.m_bad_pixel = None
 
+        if "intermediate" in kwargs:
+            self.m_intermediate = kwargs["intermediate"]
+        else:
+            self.m_intermediate = True
+
         super(DitheringBackgroundModule, self).__init__(name_in)
 
         self.m_image_in_port = self.add_input_port(image_in_tag)
@@ -926,12 +871,146 @@ class DitheringBackgroundModule(ProcessingModule):
 
         return n_dither, star_pos
 
+    def _scratch_database(self,
+                          database,
+                          count):
+        """
+        Internal method which creates the database of a single dither position with the central
+        configuration and the intermediate results of an earlier run that are required for the
+        processing steps which are not skipped.
+
+        :param database: Location of the database of the dither position.
+        :type database: str
+        :param count: Index of the dither position.
+        :type count: int
+
+        :return: None
+        """
+
+        if not self.m_crop and self.m_prepare:
+            tags = ["dither_crop"]
+        elif not self.m_prepare and self.m_pca_background:
+            tags = ["dither_star", "dither_mean", "dither_background"]
+        else:
+            tags = []
+
+        self._m_data_base.open_connection()
+        data_bank = self._m_data_base.m_data_bank
+
+        h5f = h5py.File(database, mode="w")
+
+        data_bank.copy("config", h5f)
+
+        # the dither positions are already processed in parallel
+        h5f["config"].attrs["CPU"] = 1
+
+        for item in tags:
+            tag = item+str(count+1)
+
+            if tag in data_bank:
+                data_bank.copy(tag, h5f)
+
+            if "header_"+tag in data_bank:
+                data_bank.copy("header_"+tag, h5f)
+
+        # the non-static attributes are linked from the database of the cropped images
+        if self.m_crop and "header_"+self.m_image_in_tag in data_bank:
+            data_bank.copy("header_"+self.m_image_in_tag, h5f)
+
+        h5f.close()
+
+    def _store_results(self,
+                       database):
+        """
+        Internal method which copies the results of a single dither position to the central
+        database.
+
+        :param database: Location of the database of the dither position.
+        :type database: str
+
+        :return: None
+        """
+
+        self._m_data_base.open_connection()
+        data_bank = self._m_data_base.m_data_bank
+
+        h5f = h5py.File(database, mode="r")
+
+        for tag in h5f:
+            if tag == "config" or tag.startswith("header_"):
+                continue
+
+            if not self.m_intermediate:
+                if self.m_combine == "mean" and not tag.startswith("dither_mean"):
+                    continue
+
+                elif self.m_combine != "mean" and not tag.startswith("dither_pca_res"):
+                    continue
+
+            for item in (tag, "header_"+tag):
+                if item in data_bank:
+                    del data_bank[item]
+
+                if item in h5f:
+                    h5f.copy(item, data_bank)
+
+        h5f.close()
+
+    def _remove_intermediate(self,
+                             count):
+        """
+        Internal method which removes the intermediate results of a single dither position from
+        the central database, except for the frames that are combined. Only the results of the
+        processing steps which are not skipped are removed.
+
+        :param count: Index of the dither position.
+        :type count: int
+
+        :return: None
+        """
+
+        tags = []
+
+        if self.m_crop:
+            tags.append("dither_crop")
+
+        if self.m_prepare:
+            tags.extend(["dither_star", "dither_mean", "dither_background"])
+
+        if self.m_pca_background:
+            tags.extend(["dither_pca_res", "dither_pca_fit", "dither_pca_mask"])
+
+            if self.m_bad_pixel is not None:
+                tags.extend(["dither_bad", "dither_bpmap"])
+
+        if self.m_combine == "mean":
+            combine = "dither_mean"
+        else:
+            combine = "dither_pca_res"
+
+        self._m_data_base.open_connection()
+        data_bank = self._m_data_base.m_data_bank
+
+        for item in tags:
+            if item == combine:
+                continue
+
+            tag = item+str(count+1)
+
+            for key in (tag, "header_"+tag):
+                if key in data_bank:
+                    del data_bank[key]
+
     def run(self):
         """
         Run method of the module. Cuts out the detector sections at the different dither positions,
         prepares the PCA background subtraction, applies a bad pixel correction, locates the star
         in each image, runs the PCA background subtraction, combines the output from the different
-        dither positions is written to a single database tag.
+        dither positions is written to a single database tag. With CPU > 1, the dither positions
+        are processed in parallel, each with a separate database for the intermediate results.
+        These databases are stored in a temporary folder in the working place of the pipeline.
+        Otherwise, the dither positions are processed one after the other in the central
+        database.
 
         :return: None
         """
@@ -957,80 +1036,107 @@ class DitheringBackgroundModule(ProcessingModule):
 
         n_dither, star_pos = self._initialize()
 
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        settings = (self.m_prepare,
+                    self.m_pca_background,
+                    self.m_bad_pixel,
+                    self.m_gaussian,
+                    self.m_subframe,
+                    self.m_pca_number,
+                    self.m_mask_star,
+                    self.m_mask_planet)
+
+        # multiprocessing crashed on Mac in combination with numpy
+        if sys.platform == "darwin" or cpu == 1 or n_dither == 1:
+            parallel = False
+        else:
+            parallel = True
+
         tags = []
 
-        for i, position in enumerate(self.m_center):
-            _admin_start(i, n_dither, position, star_pos[i])
-
-            if self.m_crop:
-                crop = CropImagesModule(size=self.m_size,
-                                        center=position,
-                                        name_in="crop"+str(i),
-                                        image_in_tag=self.m_image_in_tag,
-                                        image_out_tag="dither_crop"+str(i+1))
-
-                crop.connect_database(self._m_data_base)
-                crop.run()
-
-            if self.m_prepare:
-                prepare = PCABackgroundPreparationModule(dither=(n_dither,
-                                                                 self.m_cubes,
-                                                                 star_pos[i]),
-                                                         mean=False,
-                                                         name_in="prepare"+str(i),
-                                                         image_in_tag="dither_crop"+str(i+1),
-                                                         star_out_tag="dither_star"+str(i+1),
-                                                         mean_out_tag="dither_mean"+str(i+1),
-                                                         background_out_tag="dither_background" \
-                                                                            +str(i+1))
-
-                prepare.connect_database(self._m_data_base)
-                prepare.run()
-
-            if self.m_pca_background:
-
-                if self.m_bad_pixel is None:
-                    tag_extract = "dither_mean"+str(i+1)
-
-                else:
-                    tag_extract = "dither_bad"+str(i+1)
-
-                    bad = BadPixelSigmaFilterModule(name_in="bad"+str(i),
-                                                    image_in_tag="dither_mean"+str(i+1),
-                                                    image_out_tag="dither_bad"+str(i+1),
-                                                    map_out_tag="dither_bpmap"+str(i+1),
-                                                    box=self.m_bad_pixel[0],
-                                                    sigma=self.m_bad_pixel[1],
-                                                    iterate=self.m_bad_pixel[2])
-
-                    bad.connect_database(self._m_data_base)
-                    bad.run()
-
-                star = StarExtractionModule(name_in="star"+str(i),
-                                            image_in_tag=tag_extract,
-                                            image_out_tag=None,
-                                            position_out_tag="dither_star"+str(i+1),
-                                            image_size=None,
-                                            fwhm_star=self.m_gaussian,
-                                            position=self.m_subframe)
-
-                star.connect_database(self._m_data_base)
-                star.run()
-
-                pca = PCABackgroundSubtractionModule(pca_number=self.m_pca_number,
-                                                     mask_star=self.m_mask_star,
-                                                     mask_planet=self.m_mask_planet,
-                                                     name_in="pca_background"+str(i),
-                                                     star_in_tag="dither_star"+str(i+1),
-                                                     background_in_tag="dither_background"+str(i+1),
-                                                     residuals_out_tag="dither_pca_res"+str(i+1),
-                                                     fit_out_tag="dither_pca_fit"+str(i+1),
-                                                     mask_out_tag="dither_pca_mask"+str(i+1))
-
-                pca.connect_database(self._m_data_base)
-                pca.run()
-
-            _admin_end(i, n_dither)
+        if not self.m_crop and not self.m_prepare and not self.m_pca_background:
+            for i in range(n_dither):
+                _admin_end(i, n_dither)
+
+        elif not parallel:
+            for i, position in enumerate(self.m_center):
+                _admin_start(i, n_dither, position, star_pos[i])
+
+                if self.m_crop:
+                    crop = CropImagesModule(size=self.m_size,
+                                            center=position,
+                                            name_in="crop"+str(i),
+                                            image_in_tag=self.m_image_in_tag,
+                                            image_out_tag="dither_crop"+str(i+1))
+
+                    crop.connect_database(self._m_data_base)
+                    crop.run()
+
+                _dither_position(self._m_data_base,
+                                 i,
+                                 (n_dither, self.m_cubes, star_pos[i]),
+                                 *settings)
+
+                if not self.m_intermediate:
+                    self._remove_intermediate(i)
+
+                _admin_end(i, n_dither)
+
+        else:
+            # temporary folder next to the central database, in the working place of the pipeline
+            working_place = os.path.dirname(os.path.abspath(self._m_data_base._m_location))
+            scratch = tempfile.mkdtemp(prefix="dither_", dir=working_place)
+
+            try:
+                database = []
+
+                for i, position in enumerate(self.m_center):
+                    database.append(os.path.join(scratch, "dither"+str(i+1)+".hdf5"))
+
+                    self._scratch_database(database[i], i)
+
+                    if self.m_crop:
+                        crop = CropImagesModule(size=self.m_size,
+                                                center=position,
+                                                name_in="crop"+str(i),
+                                                image_in_tag=self.m_image_in_tag,
+                                                image_out_tag="dither_crop"+str(i+1))
+
+                        # read from the central database, write to the dither position database
+                        data_base = DataStorage(database[i])
+
+                        crop.connect_database(data_base)
+                        crop.m_image_in_port.set_database_connection(self._m_data_base)
+                        crop.run()
+
+                        data_base.close_connection()
+
+                for i, position in enumerate(self.m_center):
+                    _admin_start(i, n_dither, position, star_pos[i])
+
+                # the worker processes should not inherit an open database
+                self._m_data_base.close_connection()
+
+                pool = Pool(processes=min(cpu, n_dither),
+                            initializer=_init_dither,
+                            initargs=settings)
+
+                try:
+                    pool.map(_dither_shared, [(database[i], i, (n_dither, self.m_cubes, item))
+                                              for i, item in enumerate(star_pos)])
+
+                finally:
+                    pool.close()
+                    pool.join()
+
+                for i in range(n_dither):
+                    self._store_results(database[i])
+
+                    _admin_end(i, n_dither)
+
+            finally:
+                shutil.rmtree(scratch)
 
         if self.m_combine is not None:
             combine = CombineTagsModule(name_in="combine",
@@ -1089,6 +1195,13 @@ class NoddingBackgroundModule(ProcessingModule):
 
         self.m_time_stamps = []
 
+        self.m_sky_time = []
+        self.m_sky_index = []
+
+        # sky frames of the most recently used (previous, next) pairs
+        self.m_sky_cache = OrderedDict()
+        self.m_cache_size = 4
+
         if mode in ["next", "previous", "both"]:
             self.m_mode = mode
         else:
@@ -1097,7 +1210,8 @@ class NoddingBackgroundModule(ProcessingModule):
     def _create_time_stamp_list(self):
         """
         Internal method for assigning a time stamp, based on the exposure number ID, to each cube
-        of sky and science images.
+        of sky and science images. The exposure numbers of the sky cubes are also stored in sorted
+        order, such that the nearest sky cubes of a science cube can be found with a bisection.
         """
 
         class TimeStamp:
@@ -1121,6 +1235,8 @@ class NoddingBackgroundModule(ProcessingModule):
         exp_no_science = self.m_science_in_port.get_attribute("EXP_NO")
         nframes_science = self.m_science_in_port.get_attribute("NFRAMES")
 
+        self.m_time_stamps = []
+
         for i, item in enumerate(exp_no_sky):
             self.m_time_stamps.append(TimeStamp(item, "SKY", i))
 
@@ -1132,44 +1248,64 @@ class NoddingBackgroundModule(ProcessingModule):
 
         self.m_time_stamps = sorted(self.m_time_stamps, key=lambda time_stamp: time_stamp.m_time)
 
+        sky_stamps = [item for item in self.m_time_stamps if item.m_im_type == "SKY"]
+
+        self.m_sky_time = [item.m_time for item in sky_stamps]
+        self.m_sky_index = [item.m_index for item in sky_stamps]
+
+        self.m_sky_cache.clear()
+
     def calc_sky_frame(self,
                        index_of_science_data):
         """
         Method for finding the required sky frame (next, previous, or the mean of next and
         previous) by comparing the time stamp of the science frame with preceding and following
-        sky frames.
+        sky frames. The sky frames are looked up with a bisection of the sorted exposure numbers
+        and recently used sky frames are cached.
         """
 
-        if not any(x.m_im_type == "SKY" for x in self.m_time_stamps):
+        if not self.m_sky_time:
             raise ValueError("List of time stamps does not contain any SKY images.")
 
-        def search_for_next_sky():
-            for i in range(index_of_science_data, len(self.m_time_stamps)):
-                if self.m_time_stamps[i].m_im_type == "SKY":
-                    return self.m_sky_in_port[self.m_time_stamps[i].m_index, ]
-
-            # no next sky found, look for previous sky
-            return search_for_previous_sky()
+        # sky cubes with an equal time stamp precede the science cube
+        position = bisect_right(self.m_sky_time, self.m_time_stamps[index_of_science_data].m_time)
 
-        def search_for_previous_sky():
-            for i in reversed(range(0, index_of_science_data)):
-                if self.m_time_stamps[i].m_im_type == "SKY":
-                    return self.m_sky_in_port[self.m_time_stamps[i].m_index, ]
+        if position == len(self.m_sky_time):
+            # no next sky found, use previous sky
+            next_sky = position-1
+        else:
+            next_sky = position
 
-            # no previous sky found, look for next sky
-            return search_for_next_sky()
+        if position == 0:
+            # no previous sky found, use next sky
+            previous_sky = position
+        else:
+            previous_sky = position-1
 
         if self.m_mode == "next":
-            return search_for_next_sky()
+            key = (next_sky, )
+        elif self.m_mode == "previous":
+            key = (previous_sky, )
+        elif self.m_mode == "both":
+            key = (previous_sky, next_sky)
+
+        if key in self.m_sky_cache:
+            sky = self.m_sky_cache.pop(key)
+
+        else:
+            sky = [self.m_sky_in_port[self.m_sky_index[item], ] for item in key]
+
+            if len(sky) == 1:
+                sky = sky[0]
+            else:
+                sky = (sky[0]+sky[1])/2.
 
-        if self.m_mode == "previous":
-            return search_for_previous_sky()
+            if len(self.m_sky_cache) == self.m_cache_size:
+                self.m_sky_cache.popitem(last=False)
 
-        if self.m_mode == "both":
-            previous_sky = search_for_previous_sky()
-            next_sky = search_for_next_sky()
+        self.m_sky_cache[key] = sky
 
-            return (previous_sky+next_sky)/2.
+        return sky
 
     def run(self):
         """
@@ -1179,11 +1315,16 @@ class NoddingBackgroundModule(ProcessingModule):
         :return: None
         """
 
+        memory = self._m_config_port.get_attribute("MEMORY")
+
         self.m_image_out_port.del_all_data()
         self.m_image_out_port.del_all_attributes()
 
         self._create_time_stamp_list()
 
+        buffer_sub = []
+        nbuffer = 0
+
         for i, time_entry in enumerate(self.m_time_stamps):
             progress(i, len(self.m_time_stamps), "Running NoddingBackgroundModule...")
 
@@ -1193,7 +1334,17 @@ class NoddingBackgroundModule(ProcessingModule):
             sky = self.calc_sky_frame(i)
             science = self.m_science_in_port[time_entry.m_index, ]
 
-            self.m_image_out_port.append(science - sky[None, ], data_dim=3)
+            buffer_sub.append(science - sky[None, ])
+            nbuffer += buffer_sub[-1].shape[0]
+
+            if not memory or nbuffer >= memory:
+                self.m_image_out_port.append(np.concatenate(buffer_sub, axis=0), data_dim=3)
+
+                buffer_sub = []
+                nbuffer = 0
+
+        if buffer_sub:
+            self.m_image_out_port.append(np.concatenate(buffer_sub, axis=0), data_dim=3)
 
         sys.stdout.write("Running NoddingBackgroundModule... [DONE]\n")
         sys.stdout.flush()
@@ -1201,3 +1352,124 @@ class NoddingBackgroundModule(ProcessingModule):
         self.m_image_out_port.copy_attributes_from_input_port(self.m_science_in_port)
         self.m_image_out_port.add_history_information("Background subtraction", "nodding")
         self.m_image_out_port.close_port()
+
+
+_DITHER_ARGS = None
+
+
+def _dither_position(data_base,
+                     count,
+                     dither,
+                     prepare,
+                     pca_background,
+                     bad_pixel,
+                     gaussian,
+                     subframe,
+                     pca_number,
+                     mask_star,
+                     mask_planet):
+    """
+    Internal function which prepares the PCA background subtraction, applies a bad pixel
+    correction, locates the star, and runs the PCA background subtraction of a single dither
+    position of the DitheringBackgroundModule. The intermediate results are written to either
+    the central database or the database of the dither position.
+
+    :param data_base: Database that is used for the processing steps.
+    :type data_base: PynPoint.Core.DataIO.DataStorage
+    :param count: Index of the dither position.
+    :type count: int
+    :param dither: Tuple with the number of dither positions, the number of cubes per dither
+                   position, and the dither position (see PCABackgroundPreparationModule).
+    :type dither: tuple
+
+    :return: None
+    """
+
+    number = str(count+1)
+
+    if prepare:
+        preparation = PCABackgroundPreparationModule(dither=dither,
+                                                     mean=False,
+                                                     name_in="prepare"+str(count),
+                                                     image_in_tag="dither_crop"+number,
+                                                     star_out_tag="dither_star"+number,
+                                                     mean_out_tag="dither_mean"+number,
+                                                     background_out_tag="dither_background"+number)
+
+        preparation.connect_database(data_base)
+        preparation.run()
+
+    if pca_background:
+
+        if bad_pixel is None:
+            tag_extract = "dither_mean"+number
+
+        else:
+            tag_extract = "dither_bad"+number
+
+            bad = BadPixelSigmaFilterModule(name_in="bad"+str(count),
+                                            image_in_tag="dither_mean"+number,
+                                            image_out_tag="dither_bad"+number,
+                                            map_out_tag="dither_bpmap"+number,
+                                            box=bad_pixel[0],
+                                            sigma=bad_pixel[1],
+                                            iterate=bad_pixel[2])
+
+            bad.connect_database(data_base)
+            bad.run()
+
+        star = StarExtractionModule(name_in="star"+str(count),
+                                    image_in_tag=tag_extract,
+                                    image_out_tag=None,
+                                    position_out_tag="dither_star"+number,
+                                    image_size=None,
+                                    fwhm_star=gaussian,
+                                    position=subframe)
+
+        star.connect_database(data_base)
+        star.run()
+
+        pca = PCABackgroundSubtractionModule(pca_number=pca_number,
+                                             mask_star=mask_star,
+                                             mask_planet=mask_planet,
+                                             name_in="pca_background"+str(count),
+                                             star_in_tag="dither_star"+number,
+                                             background_in_tag="dither_background"+number,
+                                             residuals_out_tag="dither_pca_res"+number,
+                                             fit_out_tag="dither_pca_fit"+number,
+                                             mask_out_tag="dither_pca_mask"+number)
+
+        pca.connect_database(data_base)
+        pca.run()
+
+
+def _init_dither(*settings):
+    """
+    Internal function which initializes a worker process of the DitheringBackgroundModule with
+    the settings of the processing steps. The progress of the worker processes is not printed.
+
+    :return: None
+    """
+
+    global _DITHER_ARGS
+
+    _DITHER_ARGS = settings
+
+    sys.stdout = open(os.devnull, "w")
+
+
+def _dither_shared(args):
+    """
+    Internal function which processes a single dither position in a worker process that has
+    been initialized with _init_dither.
+
+    :return: None
+    """
+
+    database, count, dither = args
+
+    data_base = DataStorage(database)
+
+    _dither_position(data_base, count, dither, *_DITHER_ARGS)
+
+    data_base.close_connection()
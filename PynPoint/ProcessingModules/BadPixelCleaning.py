@@ -2,64 +2,70 @@
 Modules for the detection and interpolation of bad pixels.
 """
 
-import copy
+import sys
+
+from multiprocessing import Pool
 
-import cv2
 import numpy as np
 
-from numba import jit
+from numba import jit, prange
+from scipy.ndimage.filters import correlate1d, median_filter
 
 from PynPoint.Core.Processing import ProcessingModule
+from PynPoint.Util.ModuleTools import memory_frames, progress
 
 
-@jit(cache=True)
-def _calc_fast_convolution(f_roof, w_conv, s_conv, n_size, g_conv, n_conv):
-    output = np.zeros(n_conv, dtype=np.complex64)
+@jit(cache=True, nopython=True, parallel=True)
+def _calc_fast_convolution(f_roof, w_conv, s_conv, n_size, g_conv):
+    """"
+    Internal function which subtracts the convolution of a new line of the spectrum with the
+    spectrum of the bad pixel map from the error spectrum, in place. The rows are calculated in
+    parallel. The convolution is rounded to single precision, as in the original implementation
+    by Markus.
+
+    :return: None
+    """
 
-    if s_conv[0] == 0 and s_conv[1] == 0:
+    n_0 = g_conv.shape[0]
+    n_1 = g_conv.shape[1]
+
+    s_0 = s_conv[0]
+    s_1 = s_conv[1]
+
+    if s_0 == 0 and s_1 == 0:
         check = True
 
-    elif s_conv[0] == n_conv[0]/2 and s_conv[1] == 0:
+    elif s_0 == n_0/2 and s_1 == 0:
         check = True
 
-    elif s_conv[0] == 0 and s_conv[1] == n_conv[1]/2:
+    elif s_0 == 0 and s_1 == n_1/2:
         check = True
 
-    elif s_conv[0] == n_conv[0]/2 and s_conv[1] == n_conv[1]/2:
+    elif s_0 == n_0/2 and s_1 == n_1/2:
         check = True
 
     else:
         check = False
 
-    if check:
-        for m in range(n_conv[0]):
-            for j in range(n_conv[1]):
-                output[m, j] = f_roof * w_conv[m-s_conv[0], j-s_conv[1]]
-
-    else:
-        for m in range(n_conv[0]):
-            for j in range(n_conv[1]):
-                w_tmp_1 = w_conv[m-s_conv[0], j-s_conv[1]]
-                w_tmp_2 = w_conv[(m+s_conv[0])%n_conv[0], (j+s_conv[1])%n_conv[1]]
-
-                output[m, j] = f_roof*w_tmp_1 + np.conjugate(f_roof)*w_tmp_2
+    for m in prange(n_0):
+        for j in range(n_1):
+            if check:
+                output = np.complex64(f_roof * w_conv[(m-s_0)%n_0, (j-s_1)%n_1])
 
-    # Original code by Markus
-    # if ((s_conv[0] == n_conv[0]/2) and (s_conv[1] == 0)) or ((s_conv[0] == 0) and (s_conv[1] == \
-    #         n_conv[1]/2)) or ((s_conv[0] == n_conv[0]/2) and (s_conv[1] == n_conv[1]/2)):
-    #     res = output/float(n_size) # seems to make problems, unclear why
-    #
-    # else:
-    #     res = output/float(n_size)
+            else:
+                w_tmp_1 = w_conv[(m-s_0)%n_0, (j-s_1)%n_1]
+                w_tmp_2 = w_conv[(m+s_0)%n_0, (j+s_1)%n_1]
 
-    res = output / float(n_size)
+                output = np.complex64(f_roof*w_tmp_1 + np.conjugate(f_roof)*w_tmp_2)
 
-    return g_conv - res
+            g_conv[m, j] -= np.complex128(output) / n_size
 
 
 def _bad_pixel_interpolation(image_in,
                              bad_pixel_map,
-                             iterations):
+                             iterations,
+                             map_fft=None,
+                             tolerance=None):
     """"
     Internal function to interpolate bad pixels.
 
@@ -67,8 +73,15 @@ def _bad_pixel_interpolation(image_in,
     :type image_in: ndarray
     :param bad_pixel_map: Bad pixel map.
     :type bad_pixel_map: ndarray
-    :param iterations: Number of iterations.
+    :param iterations: Maximum number of iterations.
     :type iterations: int
+    :param map_fft: Fourier transform of the bad pixel map, which can be shared by all images.
+                    Calculated from *bad_pixel_map* if set to None.
+    :type map_fft: ndarray
+    :param tolerance: The iterations are stopped when the largest line of the error spectrum
+                      has dropped below this fraction of its initial value. All iterations are
+                      used if set to None.
+    :type tolerance: float
 
     :return: Image in which the bad pixels have been interpolated.
     :rtype: ndarray
@@ -76,23 +89,33 @@ def _bad_pixel_interpolation(image_in,
 
     image_in = image_in * bad_pixel_map
 
-    g = copy.deepcopy(image_in)
-    G = np.fft.fft2(g)
-    w = copy.deepcopy(bad_pixel_map)
-    W = np.fft.fft2(w)
+    G = np.fft.fft2(image_in)
+
+    if map_fft is None:
+        W = np.fft.fft2(bad_pixel_map)
+    else:
+        W = map_fft
 
-    N = g.shape
+    N = image_in.shape
     N_size = float(N[0] * N[1])
     F_roof = np.zeros(N, dtype=complex)
-    tmp_G = copy.deepcopy(G)
+    tmp_G = G
 
     iteration = 0
 
     while iteration < iterations:
         # 1.) select line using max search and compute conjugate
-        tmp_s = np.unravel_index(np.argmax(abs(tmp_G.real[:, 0: N[1] / 2])), (N[0], N[1] / 2))
+        abs_G = np.abs(tmp_G.real[:, 0: N[1] / 2])
+        tmp_s = np.unravel_index(np.argmax(abs_G), (N[0], N[1] / 2))
         tmp_s_conjugate = (np.mod(N[0] - tmp_s[0], N[0]), np.mod(N[1] - tmp_s[1], N[1]))
 
+        if tolerance is not None:
+            if iteration == 0:
+                max_init = abs_G[tmp_s]
+
+            if abs_G[tmp_s] <= tolerance*max_init:
+                break
+
         # 2.) compute the new F_roof
         # special cases s = 0 or s = N/2 no conjugate line exists
         if ((tmp_s[0] == 0) and (tmp_s[1] == 0)) or \
@@ -110,6 +133,10 @@ def _bad_pixel_interpolation(image_in,
             b = np.power(np.abs(W[(2 * tmp_s[0]) % N[0], (2 * tmp_s[1]) % N[1]]), 2)
 
             if a == b:
+                # the shared spectrum of the bad pixel map is not changed
+                if W is map_fft:
+                    W = np.copy(map_fft)
+
                 W[(2 * tmp_s[0]) % N[0], (2 * tmp_s[1]) % N[1]] += 0.00000000001
 
             a = (np.power(np.abs(W[(0, 0)]), 2))
@@ -124,13 +151,116 @@ def _bad_pixel_interpolation(image_in,
             F_roof[tmp_s_conjugate] += np.conjugate(F_roof_tmp)
 
         # 4.) calc the new error spectrum using fast numba function
-        tmp_G = _calc_fast_convolution(F_roof_tmp, W, tmp_s, N_size, tmp_G, N)
+        _calc_fast_convolution(F_roof_tmp, W, np.asarray(tmp_s), N_size, tmp_G)
 
         iteration += 1
 
     return image_in * bad_pixel_map + np.fft.ifft2(F_roof).real * (1 - bad_pixel_map)
 
 
+def _local_interpolation(images,
+                         bad_pixel_map):
+    """"
+    Internal function which replaces the bad pixels of a stack of images by the mean of the good
+    pixels in the surrounding 3x3 box. Bad pixels without good neighbors are filled in a next
+    pass with the interpolated values of their neighbors.
+
+    :param images: Stack of images (3D).
+    :type images: ndarray
+    :param bad_pixel_map: Bad pixel map.
+    :type bad_pixel_map: ndarray
+
+    :return: Images in which the bad pixels have been interpolated.
+    :rtype: ndarray
+    """
+
+    weights = np.array(bad_pixel_map, dtype=np.float64)
+    images = images * weights
+
+    while np.any(weights == 0.):
+        weight_sum = _box_sum(weights[np.newaxis, ], 3)[0, ]
+        fill = (weights == 0.) & (weight_sum > 0.)
+
+        if not np.any(fill):
+            break
+
+        images[:, fill] = _box_sum(images, 3)[:, fill] / weight_sum[fill]
+        weights[fill] = 1.
+
+    return images
+
+
+def _robust_std(data):
+    """
+    Internal function which estimates the standard deviation from the median absolute deviation.
+
+    :param data: Input data.
+    :type data: ndarray
+
+    :return: Standard deviation.
+    :rtype: float
+    """
+
+    return 1.4826*np.median(np.abs(data-np.median(data)))
+
+
+def _box_sum(images,
+             box):
+    """
+    Internal function which calculates the sum of the pixel values within a square box around
+    each pixel of a stack of images. The box is applied as a separable filter along the two image
+    axes with the same anchor and reflected border (without repeating the edge pixels) as
+    cv2.blur.
+
+    :param images: Stack of images (3D).
+    :type images: ndarray
+    :param box: Size of the box.
+    :type box: int
+
+    :return: Stack with the box sums.
+    :rtype: ndarray
+    """
+
+    weights = np.ones(box)
+
+    images = correlate1d(images, weights, axis=1, mode="mirror")
+
+    return correlate1d(images, weights, axis=2, mode="mirror")
+
+
+@jit(cache=True, nopython=True, parallel=True)
+def _sigma_filter(images,
+                  mean_image,
+                  dev_image,
+                  var_image,
+                  bad_pixel_map):
+    """"
+    Internal function which replaces the pixels that deviate more than the threshold from the
+    neighborhood mean. The images and bad pixel map are changed in place and the images of the
+    stack are processed in parallel.
+
+    :param images: Stack of images (3D).
+    :type images: ndarray
+    :param mean_image: Neighborhood means.
+    :type mean_image: ndarray
+    :param dev_image: Pixel deviations from the neighborhood means, squared.
+    :type dev_image: ndarray
+    :param var_image: Neighborhood variances * (N_sigma)^2.
+    :type var_image: ndarray
+    :param bad_pixel_map: Bad pixel map.
+    :type bad_pixel_map: ndarray
+
+    :return: None
+    """
+
+    for k in prange(images.shape[0]):
+        for i in range(images.shape[1]):
+            for j in range(images.shape[2]):
+                if dev_image[k, i, j] >= var_image[k, i, j]:
+                    images[k, i, j] = mean_image[k, i, j]
+                    bad_pixel_map[k, i, j] = 0
+
+
 @jit(cache=True)
 def _sigma_detection(dev_image,
                      var_image,
@@ -165,25 +295,6 @@ class BadPixelSigmaFilterModule(ProcessingModule):
     the surrounding pixels.
     """
 
-    @staticmethod
-    @jit(cache=True)
-    def _sigma_filter(dev_image,
-                      var_image,
-                      mean_image,
-                      source_image,
-                      out_image,
-                      bad_pixel_map):
-
-        for i in range(source_image.shape[0]):
-            for j in range(source_image.shape[1]):
-
-                if dev_image[i][j] < var_image[i][j]:
-                    out_image[i][j] = source_image[i][j]
-
-                else:
-                    out_image[i][j] = mean_image[i][j]
-                    bad_pixel_map[i][j] = 0
-
     def __init__(self,
                  name_in="sigma_filtering",
                  image_in_tag="im_arr",
@@ -231,63 +342,70 @@ class BadPixelSigmaFilterModule(ProcessingModule):
         """
         Run method of the module. Finds bad pixels with a sigma filter, replaces bad pixels with
         the mean value of the surrounding pixels, and writes the cleaned images to the database.
+        The neighborhood means and variances are calculated for a MEMORY block at once with a
+        separable box filter, after which the bad pixels of all images in the block are replaced
+        in parallel.
 
         :return: None
         """
 
-        def _bad_pixel_sigma_filter(image_in,
-                                    box,
-                                    sigma,
-                                    iterate):
+        # algorithm adapted from http://idlastro.gsfc.nasa.gov/ftp/pro/image/sigma_filter.pro
 
-            # algorithm adapted from http://idlastro.gsfc.nasa.gov/ftp/pro/image/sigma_filter.pro
+        if self.m_image_out_port.tag != self.m_image_in_port.tag:
+            self.m_image_out_port.del_all_attributes()
+            self.m_image_out_port.del_all_data()
 
-            bad_pixel_map = np.ones(image_in.shape)
+        if self.m_map_out_port is not None:
+            self.m_map_out_port.del_all_data()
+            self.m_map_out_port.del_all_attributes()
 
-            if iterate < 1:
-                iterate = 1
+        memory = self._m_config_port.get_attribute("MEMORY")
 
-            while iterate > 0:
-                box2 = box * box
+        ndim = self.m_image_in_port.get_ndim()
 
-                source_image = copy.deepcopy(image_in)
+        if ndim == 2:
+            nimages = 1
+        elif ndim == 3:
+            nimages = self.m_image_in_port.get_shape()[0]
 
-                mean_image = (cv2.blur(copy.deepcopy(source_image),
-                                       (box, box)) * box2 - source_image) / (box2 - 1)
+        frames = memory_frames(memory, nimages)
 
-                dev_image = (mean_image - source_image) ** 2
+        box2 = self.m_box * self.m_box
+        fact = float(self.m_sigma ** 2) / (box2 - 2)
 
-                fact = float(sigma ** 2) / (box2 - 2)
-                var_image = fact * (cv2.blur(copy.deepcopy(dev_image),
-                                             (box, box)) * box2 - dev_image)
+        for i, _ in enumerate(frames[:-1]):
+            progress(i, len(frames[:-1]), "Running BadPixelSigmaFilterModule...")
 
-                out_image = image_in
+            if ndim == 2:
+                images = self.m_image_in_port[:, :][np.newaxis, ]
+            elif ndim == 3:
+                images = self.m_image_in_port[frames[i]:frames[i+1], ]
 
-                self._sigma_filter(dev_image,
-                                   var_image,
-                                   mean_image,
-                                   source_image,
-                                   out_image,
-                                   bad_pixel_map)
+            bad_pixel_map = np.ones(images.shape)
 
-                iterate -= 1
+            for _ in range(max(self.m_iterate, 1)):
+                mean_image = (_box_sum(images, self.m_box) - images) / (box2 - 1)
 
-            if self.m_map_out_port is not None:
-                self.m_map_out_port.append(bad_pixel_map, data_dim=3)
+                dev_image = (mean_image - images) ** 2
+                var_image = fact * (_box_sum(dev_image, self.m_box) - dev_image)
 
-            return out_image
+                _sigma_filter(images, mean_image, dev_image, var_image, bad_pixel_map)
 
-        if self.m_map_out_port is not None:
-            self.m_map_out_port.del_all_data()
-            self.m_map_out_port.del_all_attributes()
+            # the sigma filter does not change the shape of the images
+            if self.m_image_out_port.tag == self.m_image_in_port.tag:
+                if np.size(frames) == 2:
+                    self.m_image_out_port.set_all(images, keep_attributes=True)
+                else:
+                    self.m_image_out_port[frames[i]:frames[i+1]] = images
 
-        self.apply_function_to_images(_bad_pixel_sigma_filter,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running BadPixelSigmaFilterModule...",
-                                      func_args=(self.m_box,
-                                                 self.m_sigma,
-                                                 self.m_iterate))
+            else:
+                self.m_image_out_port.append(images, data_dim=3)
+
+            if self.m_map_out_port is not None:
+                self.m_map_out_port.append(bad_pixel_map, data_dim=3)
+
+        sys.stdout.write("Running BadPixelSigmaFilterModule... [DONE]\n")
+        sys.stdout.flush()
 
         self.m_image_out_port.add_history_information("Bad pixel cleaning",
                                                       "Sigma filter = " + str(self.m_sigma))
@@ -380,6 +498,114 @@ class BadPixelMapModule(ProcessingModule):
         self.m_bp_map_out_port.close_port()
 
 
+class BadPixelTimeSeriesModule(ProcessingModule):
+    """
+    Module to create a bad pixel map from the time series of the pixel values in a stack of
+    images. Hot, dead, and flickering pixels are flagged from the temporal median and median
+    absolute deviation (MAD) of each pixel.
+    """
+
+    def __init__(self,
+                 name_in="bad_pixel_time_series",
+                 image_in_tag="im_arr",
+                 bp_map_out_tag="bp_map",
+                 box=5,
+                 sigma=5.):
+        """
+        Constructor of BadPixelTimeSeriesModule.
+
+        :param name_in: Unique name of the module instance.
+        :type name_in: str
+        :param image_in_tag: Tag of the database entry with the images that are read as input.
+        :type image_in_tag: str
+        :param bp_map_out_tag: Tag of the database entry with the bad pixel map that is written as
+                               output.
+        :type bp_map_out_tag: str
+        :param box: Size of the median filter that is used to compare the temporal median and
+                    MAD of a pixel with the surrounding pixels.
+        :type box: int
+        :param sigma: Sigma threshold.
+        :type sigma: float
+
+        :return: None
+        """
+
+        super(BadPixelTimeSeriesModule, self).__init__(name_in)
+
+        self.m_image_in_port = self.add_input_port(image_in_tag)
+        self.m_bp_map_out_port = self.add_output_port(bp_map_out_tag)
+
+        self.m_box = box
+        self.m_sigma = sigma
+
+    def run(self):
+        """
+        Run method of the module. Calculates the temporal median, MAD, minimum, and maximum of
+        each pixel in a single pass over the stack. The stack is read in sections of rows that
+        contain the time series of all images, such that each section has the size of MEMORY
+        images and the median and MAD are exact. Pixels of which the temporal median deviates
+        more than *sigma* times the (robust) standard deviation from the median filtered map are
+        flagged as hot or dead, pixels that have a constant value are flagged as dead, and pixels
+        of which the temporal MAD exceeds the median filtered MAD map by more than *sigma* times
+        the standard deviation are flagged as flickering. The bad pixel map (with zeros for bad
+        pixels) can be used by the BadPixelInterpolationModule.
+
+        :return: None
+        """
+
+        if self.m_image_in_port.get_ndim() != 3:
+            raise ValueError("The time series of the pixels requires a 3D stack of images.")
+
+        memory = self._m_config_port.get_attribute("MEMORY")
+        nimages, npix_y, npix_x = self.m_image_in_port.get_shape()
+
+        # sections of rows with the time series of all images and the size of MEMORY images
+        if memory == 0 or memory >= nimages:
+            rows = [0, npix_y]
+        else:
+            rows = memory_frames(max(memory*npix_y//nimages, 1), npix_y)
+
+        im_median = np.zeros((npix_y, npix_x))
+        im_mad = np.zeros((npix_y, npix_x))
+        im_min = np.zeros((npix_y, npix_x))
+        im_max = np.zeros((npix_y, npix_x))
+
+        for i, _ in enumerate(rows[:-1]):
+            progress(i, len(rows[:-1]), "Running BadPixelTimeSeriesModule...")
+
+            images = self.m_image_in_port[:, rows[i]:rows[i+1], :]
+
+            median = np.median(images, axis=0)
+
+            im_median[rows[i]:rows[i+1], ] = median
+            im_mad[rows[i]:rows[i+1], ] = np.median(np.abs(images-median), axis=0)
+            im_min[rows[i]:rows[i+1], ] = np.amin(images, axis=0)
+            im_max[rows[i]:rows[i+1], ] = np.amax(images, axis=0)
+
+        sys.stdout.write("Running BadPixelTimeSeriesModule... [DONE]\n")
+        sys.stdout.flush()
+
+        res_median = im_median - median_filter(im_median, size=self.m_box, mode="mirror")
+        res_mad = im_mad - median_filter(im_mad, size=self.m_box, mode="mirror")
+
+        std_median = self.m_sigma*_robust_std(res_median)
+        std_mad = self.m_sigma*_robust_std(res_mad)
+
+        hot = res_median > std_median
+        dead = (res_median < -std_median) | (im_min == im_max)
+        flickering = res_mad > std_mad
+
+        bpmap = np.ones(im_median.shape)
+        bpmap[hot | dead | flickering] = 0.
+
+        self.m_bp_map_out_port.set_all(bpmap)
+
+        self.m_bp_map_out_port.add_history_information("Bad pixel map",
+                                                       "Time series, sigma = "+str(self.m_sigma))
+
+        self.m_bp_map_out_port.close_port()
+
+
 class BadPixelInterpolationModule(ProcessingModule):
     """
     Module to interpolate bad pixels with spectral deconvolution.
@@ -390,9 +616,11 @@ class BadPixelInterpolationModule(ProcessingModule):
                  image_in_tag="im_arr",
                  bad_pixel_map_tag="bp_map",
                  image_out_tag="im_arr_bp_clean",
-                 iterations=1000):
+                 iterations=1000,
+                 tolerance=None,
+                 sparse=None):
         """
-        Constructor of BadPixelMapModule.
+        Constructor of BadPixelInterpolationModule.
 
         :param name_in: Unique name of the module instance.
         :type name_in: str
@@ -403,8 +631,16 @@ class BadPixelInterpolationModule(ProcessingModule):
         :type bad_pixel_map_tag: str
         :param image_out_tag: Tag of the database entry that is written as output.
         :type image_out_tag: str
-        :param iterations: Number of iterations of the spectral deconvolution.
+        :param iterations: Maximum number of iterations of the spectral deconvolution.
         :type iterations: int
+        :param tolerance: Stop the iterations of an image when the largest line of the error
+                          spectrum has dropped below this fraction of its initial value. All
+                          iterations are used if set to None.
+        :type tolerance: float
+        :param sparse: Fraction of bad pixels in the bad pixel map below which the bad pixels are
+                       replaced by the mean of the good pixels in the surrounding 3x3 pixels
+                       instead of the spectral deconvolution. Not used if set to None.
+        :type sparse: float
 
         :return: None
         """
@@ -416,14 +652,22 @@ class BadPixelInterpolationModule(ProcessingModule):
         self.m_image_out_port = self.add_output_port(image_out_tag)
 
         self.m_iterations = iterations
+        self.m_tolerance = tolerance
+        self.m_sparse = sparse
 
     def run(self):
         """
         Run method of the module. Interpolates bad pixels with an iterative spectral deconvolution.
+        The Fourier transform of the bad pixel map is shared by all images, and the images of
+        each MEMORY block are processed in parallel if CPU > 1.
 
         :return: None
         """
 
+        if self.m_image_out_port.tag != self.m_image_in_port.tag:
+            self.m_image_out_port.del_all_attributes()
+            self.m_image_out_port.del_all_data()
+
         bad_pixel_map = self.m_bp_map_in_port.get_all()
         im_shape = self.m_image_in_port.get_shape()
 
@@ -435,18 +679,93 @@ class BadPixelInterpolationModule(ProcessingModule):
             raise ValueError("The shape of the bad pixel map does not match the shape of the "
                              "images.")
 
-        def _image_interpolation(image_in):
-            return _bad_pixel_interpolation(image_in,
-                                            bad_pixel_map,
-                                            self.m_iterations)
+        memory = self._m_config_port.get_attribute("MEMORY")
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        local = self.m_sparse is not None and \
+            np.count_nonzero(bad_pixel_map == 0.) < self.m_sparse*bad_pixel_map.size
+
+        map_fft = np.fft.fft2(bad_pixel_map)
+
+        # multiprocessing crashed on Mac in combination with numpy
+        if sys.platform == "darwin" or cpu == 1 or local:
+            pool = None
+
+        else:
+            pool = Pool(processes=cpu,
+                        initializer=_init_interpolation,
+                        initargs=(bad_pixel_map, map_fft, self.m_iterations, self.m_tolerance))
+
+        frames = memory_frames(memory, im_shape[0])
+
+        try:
+            for i, _ in enumerate(frames[:-1]):
+                progress(i, len(frames[:-1]), "Running BadPixelInterpolationModule...")
+
+                images = self.m_image_in_port[frames[i]:frames[i+1], ]
+
+                if local:
+                    im_interp = _local_interpolation(images, bad_pixel_map)
+
+                elif pool is None:
+                    im_interp = np.zeros(images.shape)
+
+                    for j, image in enumerate(images):
+                        im_interp[j, ] = _bad_pixel_interpolation(image,
+                                                                  bad_pixel_map,
+                                                                  self.m_iterations,
+                                                                  map_fft,
+                                                                  self.m_tolerance)
+
+                else:
+                    im_interp = np.asarray(pool.map(_interpolation_shared, list(images)))
+
+                if self.m_image_out_port.tag == self.m_image_in_port.tag:
+                    self.m_image_out_port[frames[i]:frames[i+1]] = im_interp
+                else:
+                    self.m_image_out_port.append(im_interp, data_dim=3)
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
-        self.apply_function_to_images(_image_interpolation,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running BadPixelInterpolationModule...")
+        sys.stdout.write("Running BadPixelInterpolationModule... [DONE]\n")
+        sys.stdout.flush()
 
         self.m_image_out_port.add_history_information("Bad pixel interpolation",
                                                       "Iterations = " + str(self.m_iterations))
 
         self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
         self.m_image_out_port.close_port()
+
+
+_INTERPOLATION_ARGS = None
+
+
+def _init_interpolation(bad_pixel_map,
+                        map_fft,
+                        iterations,
+                        tolerance):
+    """
+    Internal function which initializes a worker process of the BadPixelInterpolationModule with
+    the bad pixel map and its Fourier transform.
+
+    :return: None
+    """
+
+    global _INTERPOLATION_ARGS
+
+    _INTERPOLATION_ARGS = (bad_pixel_map, iterations, map_fft, tolerance)
+
+
+def _interpolation_shared(image):
+    """
+    Internal function which interpolates the bad pixels of an image in a worker process that has
+    been initialized with _init_interpolation.
+
+    :return: Image in which the bad pixels have been interpolated.
+    :rtype: ndarray
+    """
+
+    return _bad_pixel_interpolation(image, *_INTERPOLATION_ARGS)
@@ -9,13 +9,139 @@ import warnings
 import numpy as np
 
 from scipy.interpolate import interp1d
+from scipy.ndimage import maximum_filter
 from scipy.stats import t
 
 from PynPoint.Core.Processing import ProcessingModule
 from PynPoint.ProcessingModules.PSFpreparation import PSFpreparationModule
 from PynPoint.ProcessingModules.PSFSubtractionPCA import PcaPsfSubtractionModule
 from PynPoint.ProcessingModules.FluxAndPosition import FakePlanetModule
-from PynPoint.Util.AnalysisTools import false_alarm, student_fpf
+from PynPoint.Util.AnalysisTools import false_alarm, student_fpf, snr_map
+from PynPoint.Util.ModuleTools import progress
+
+
+class _MagnitudeIteration(object):
+    """
+    Internal class which iterates the magnitude of a single fake planet towards the threshold of
+    the false positive fraction. The state of the iteration is stored such that multiple fake
+    planets can be processed in the same PSF subtraction.
+    """
+
+    def __init__(self,
+                 magnitude,
+                 mag_step,
+                 fpf_threshold,
+                 accuracy,
+                 position):
+        """
+        :param magnitude: Initial magnitude of the fake planet.
+        :type magnitude: float
+        :param mag_step: Initial magnitude step size.
+        :type mag_step: float
+        :param fpf_threshold: Threshold of the false positive fraction.
+        :type fpf_threshold: float
+        :param accuracy: Fractional accuracy of the false positive fraction.
+        :type accuracy: float
+        :param position: Separation (arcsec) and position angle (deg) of the fake planet, only
+                         used for the warning messages.
+        :type position: tuple
+
+        :return: None
+        """
+
+        self.m_list_mag = [magnitude]
+        self.m_list_fpf = []
+        self.m_mag_step = mag_step
+        self.m_fpf_threshold = fpf_threshold
+        self.m_accuracy = accuracy
+        self.m_position = position
+
+        self.m_iteration = 1
+        self.m_done = False
+        self.m_result = None
+
+    @property
+    def magnitude(self):
+        """
+        Returns the magnitude for which the false positive fraction is required next.
+
+        :return: Magnitude of the fake planet.
+        :rtype: float
+        """
+
+        return self.m_list_mag[-1]
+
+    def update(self, fpf):
+        """
+        Function which processes the false positive fraction of the current magnitude and selects
+        the next magnitude, or stores the final magnitude once the accuracy condition is met.
+
+        :param fpf: False positive fraction at the current magnitude.
+        :type fpf: float
+
+        :return: None
+        """
+
+        list_mag = self.m_list_mag
+        list_fpf = self.m_list_fpf
+        fpf_threshold = self.m_fpf_threshold
+
+        list_fpf.append(fpf)
+
+        if abs(fpf_threshold-list_fpf[-1]) < self.m_accuracy*fpf_threshold:
+            if len(list_fpf) == 1:
+                self.m_result = list_mag[0]
+                self.m_done = True
+                return
+
+            if (fpf_threshold > list_fpf[-2] and fpf_threshold < list_fpf[-1]) or \
+               (fpf_threshold < list_fpf[-2] and fpf_threshold > list_fpf[-1]):
+
+                fpf_interp = interp1d(list_fpf[-2:], list_mag[-2:], 'linear')
+                self.m_result = fpf_interp(fpf_threshold)
+                self.m_done = True
+                return
+
+        if list_fpf[-1] < fpf_threshold:
+            if list_mag[-1]+self.m_mag_step in list_mag:
+                self.m_mag_step /= 2.
+
+            list_mag.append(list_mag[-1]+self.m_mag_step)
+
+        else:
+            if np.size(list_fpf) > 2 and \
+               list_mag[-1] < list_mag[-2] and list_mag[-2] < list_mag[-3] and \
+               list_fpf[-1] > list_fpf[-2] and list_fpf[-2] < list_fpf[-3]:
+
+                warnings.warn("Magnitude decreases but false positive fraction "
+                              "increases. Adjusting magnitude to %s and step size "
+                              "to %s" % (list_mag[-3], self.m_mag_step/2.))
+
+                self.m_list_fpf = []
+                self.m_list_mag = [list_mag[-3]]
+                self.m_mag_step /= 2.
+
+            else:
+                if list_mag[-1]-self.m_mag_step in list_mag:
+                    self.m_mag_step /= 2.
+
+                list_mag.append(list_mag[-1]-self.m_mag_step)
+
+        if self.m_list_mag[-1] <= 0.:
+            warnings.warn("The relative magnitude has become smaller or equal to "
+                          "zero. Adjusting magnitude to 7.5 and step size to 0.1.")
+
+            self.m_list_mag[-1] = 7.5
+            self.m_mag_step = 0.1
+
+        self.m_iteration += 1
+
+        if self.m_iteration == 50:
+            warnings.warn("ContrastModule could not converge at the position of "
+                          "%s arcsec and %s deg." % self.m_position)
+
+            self.m_result = np.nan
+            self.m_done = True
 
 
 class ContrastCurveModule(ProcessingModule):
@@ -42,7 +168,9 @@ class ContrastCurveModule(ProcessingModule):
                  norm=False,
                  cent_size=None,
                  edge_size=None,
-                 extra_rot=0.):
+                 extra_rot=0.,
+                 batch=False,
+                 roi_margin=None):
         """
         Constructor of ContrastCurveModule.
 
@@ -90,8 +218,16 @@ class ContrastCurveModule(ProcessingModule):
         :param ignore: Ignore the two neighboring apertures that may contain self-subtraction from
                        the planet.
         :type ignore: bool
-        :param pca_number: Number of principle components used for the PSF subtraction.
-        :type pca_number: int
+        :param pca_number: Number of principle components used for the PSF subtraction. Can be a
+                           single value or a list of integers. For a single value, the output of
+                           *contrast_out_tag* has the shape (number of separations, 4). For a
+                           list, the contrast limits of all component numbers are calculated from
+                           the same images with injected planets and the same PCA basis, and the
+                           output has the shape (number of components, number of separations, 4).
+                           The component numbers are sorted such that the first axis of the output
+                           is in ascending order of the number of components, irrespective of the
+                           order of the list.
+        :type pca_number: int, list
         :param norm: Normalization of each image by its Frobenius norm.
         :type norm: bool
         :param cent_size: Central mask radius (arcsec). No mask is used when set to None.
@@ -102,6 +238,20 @@ class ContrastCurveModule(ProcessingModule):
         :type edge_size: float
         :param extra_rot: Additional rotation angle of the images in clockwise direction (deg).
         :type extra_rot: float
+        :param batch: Inject multiple fake planets in the same stack of images such that a single
+                      PSF subtraction is required for a batch of positions. The planets of a batch
+                      have the same position angle and their separations differ by at least two
+                      aperture diameters such that the planets do not fall within each other's
+                      reference apertures. Note that the planets of a batch can still affect
+                      each other through the PCA basis, in particular for a small number of
+                      images. Only one planet per PSF subtraction is injected when set to False.
+        :type batch: bool
+        :param roi_margin: Half width (arcsec) of an annulus around the separation of the fake
+                           planets (or the range of separations of a batch). The PSF subtraction
+                           and derotation are only applied to the pixels within the annulus, which
+                           should therefore be wider than the aperture. The full images are used
+                           if set to None.
+        :type roi_margin: float
 
         :return: None
         """
@@ -130,11 +280,131 @@ class ContrastCurveModule(ProcessingModule):
         self.m_psf_scaling = psf_scaling
         self.m_aperture = aperture
         self.m_ignore = ignore
-        self.m_pca_number = pca_number
+        self.m_pca_number = np.sort(np.atleast_1d(pca_number))
+        self.m_pca_list = not np.isscalar(pca_number)
         self.m_norm = norm
         self.m_cent_size = cent_size
         self.m_edge_size = edge_size
         self.m_extra_rot = extra_rot
+        self.m_batch = batch
+        self.m_roi_margin = roi_margin
+
+    def _batches(self, pos_r, pos_t):
+        """
+        Internal function which divides the positions of the fake planets into batches that are
+        processed with a single PSF subtraction. Batches are created in such an order that the
+        contrast at all previous angles of the same separation is known when a batch is started.
+
+        :param pos_r: Separations (pix).
+        :type pos_r: numpy.ndarray
+        :param pos_t: Position angles (deg).
+        :type pos_t: numpy.ndarray
+
+        :return: List of batches, each a list with (separation index, angle index) tuples.
+        :rtype: list
+        """
+
+        batches = []
+
+        if not self.m_batch:
+            for m in range(len(pos_r)):
+                for n in range(len(pos_t)):
+                    batches.append([(m, n)])
+
+            return batches
+
+        for n in range(len(pos_t)):
+            remaining = list(np.argsort(pos_r))
+
+            while remaining:
+                selected = [remaining[0]]
+
+                for m in remaining[1:]:
+                    if pos_r[m]-pos_r[selected[-1]] >= 4.*self.m_aperture:
+                        selected.append(m)
+
+                remaining = [m for m in remaining if m not in selected]
+                batches.append([(m, n) for m in selected])
+
+        return batches
+
+    def _psf_subtraction(self, planets):
+        """
+        Internal function which injects the fake planets, prepares the images, and runs the
+        PSF subtraction.
+
+        :param planets: List with the separation (arcsec), position angle (deg), and magnitude
+                        of the fake planets.
+        :type planets: list
+
+        :return: Mean residuals of the PSF subtraction, one image for each number of principal
+                 components.
+        :rtype: numpy.ndarray
+        """
+
+        fake_planet = FakePlanetModule(position=[item[0:2] for item in planets],
+                                       magnitude=[item[2] for item in planets],
+                                       psf_scaling=self.m_psf_scaling,
+                                       interpolation="spline",
+                                       name_in="fake_planet",
+                                       image_in_tag=self.m_image_in_tag,
+                                       psf_in_tag=self.m_psf_in_tag,
+                                       image_out_tag="contrast_fake",
+                                       verbose=False)
+
+        fake_planet.connect_database(self._m_data_base)
+        fake_planet.run()
+
+        prep = PSFpreparationModule(name_in="prep",
+                                    image_in_tag="contrast_fake",
+                                    image_out_tag="contrast_prep",
+                                    image_mask_out_tag=None,
+                                    mask_out_tag=None,
+                                    norm=self.m_norm,
+                                    resize=None,
+                                    cent_size=self.m_cent_size,
+                                    edge_size=self.m_edge_size,
+                                    verbose=False)
+
+        prep.connect_database(self._m_data_base)
+        prep.run()
+
+        if self.m_roi_margin is None:
+            annulus = {}
+
+        else:
+            sep = [item[0] for item in planets]
+
+            annulus = {"annulus": (max(min(sep)-self.m_roi_margin, 0.),
+                                   max(sep)+self.m_roi_margin)}
+
+        psf_sub = PcaPsfSubtractionModule(name_in="pca_contrast",
+                                          pca_numbers=self.m_pca_number,
+                                          images_in_tag="contrast_prep",
+                                          reference_in_tag="contrast_prep",
+                                          res_mean_tag="contrast_res_mean",
+                                          res_median_tag=None,
+                                          res_arr_out_tag=None,
+                                          res_rot_mean_clip_tag=None,
+                                          extra_rot=self.m_extra_rot,
+                                          verbose=False,
+                                          **annulus)
+
+        psf_sub.connect_database(self._m_data_base)
+        psf_sub.run()
+
+        res_input_port = self.add_input_port("contrast_res_mean")
+        im_res = res_input_port.get_all()
+
+        if im_res.ndim == 2:
+            im_res = im_res[np.newaxis, ]
+
+        if im_res.shape[0] != self.m_pca_number.size:
+            raise ValueError("The number of residual images (%s) does not match the number of "
+                             "principal components (%s)." % (im_res.shape[0],
+                                                             self.m_pca_number.size))
+
+        return im_res
 
     def run(self):
         """
@@ -143,7 +413,8 @@ class ContrastCurveModule(ProcessingModule):
         needed. Once the fractional accuracy of the false positive fraction threshold is met, a
         linear interpolation is used to determine the final contrast. Note that the sigma level
         is fixed therefore the false positive fraction changes with separation, following the
-        Student's t-distribution (Mawet et al. 2014).
+        Student's t-distribution (Mawet et al. 2014). Multiple fake planets are injected in the
+        same stack of images if *batch* is set to True.
 
         :return: None
         """
@@ -188,195 +459,297 @@ class ContrastCurveModule(ProcessingModule):
 
         pos_r = np.delete(pos_r, index_del)
 
-        fake_mag = np.zeros((len(pos_r), len(pos_t)))
+        npca = self.m_pca_number.size
+
+        fake_mag = np.zeros((npca, len(pos_r), len(pos_t)))
         fake_fpf = np.zeros((len(pos_r)))
 
+        for m, sep in enumerate(pos_r):
+            fake_fpf[m] = student_fpf(self.m_sigma, sep, self.m_aperture, self.m_ignore)
+
         count = 1
 
         sys.stdout.write("Running ContrastCurveModule...\n")
         sys.stdout.flush()
 
-        for m, sep in enumerate(pos_r):
-            fpf_threshold = student_fpf(self.m_sigma, sep, self.m_aperture, self.m_ignore)
-            fake_fpf[m] = fpf_threshold
-
-            for n, ang in enumerate(pos_t):
+        for batch in self._batches(pos_r, pos_t):
+            if len(batch) == 1:
                 sys.stdout.write("Processing position " + str(count) + " out of " + \
-                      str(np.size(fake_mag)))
-                sys.stdout.flush()
+                      str(np.size(fake_mag[0])))
+            else:
+                sys.stdout.write("Processing positions " + str(count) + "-" + \
+                      str(count+len(batch)-1) + " out of " + str(np.size(fake_mag[0])))
+            sys.stdout.flush()
 
-                x_fake = center[0] + sep*math.cos(np.radians(ang+90.-self.m_extra_rot))
-                y_fake = center[1] + sep*math.sin(np.radians(ang+90.-self.m_extra_rot))
+            iterations = {}
 
-                num_mag = np.size(fake_mag[m, 0:n])
-                num_nan = np.size(np.where(np.isnan(fake_mag[m, 0:n])))
+            for k in range(npca):
+                for m, n in batch:
+                    num_mag = np.size(fake_mag[k, m, 0:n])
+                    num_nan = np.size(np.where(np.isnan(fake_mag[k, m, 0:n])))
 
-                if n == 0 or num_mag-num_nan == 0:
-                    list_mag = [self.m_magnitude[0]]
-                    mag_step = self.m_magnitude[1]
+                    if n == 0 or num_mag-num_nan == 0:
+                        magnitude = self.m_magnitude[0]
+                        mag_step = self.m_magnitude[1]
 
-                else:
-                    list_mag = [np.nanmean(fake_mag[m, 0:n])]
-                    mag_step = 0.1
+                    else:
+                        magnitude = np.nanmean(fake_mag[k, m, 0:n])
+                        mag_step = 0.1
+
+                    iterations[(k, m, n)] = _MagnitudeIteration(magnitude,
+                                                                mag_step,
+                                                                fake_fpf[m],
+                                                                self.m_accuracy,
+                                                                (pos_r[m]*pixscale, pos_t[n]))
+
+            # false positive fractions of all principal components for (m, n, magnitude)
+            fpf_cache = {}
+
+            while True:
+                active = [item for item in sorted(iterations) if not iterations[item].m_done]
 
-                list_fpf = []
+                if not active:
+                    break
 
-                iteration = 1
+                # a single magnitude per position is injected, the remaining magnitudes that are
+                # required by other numbers of principal components follow in the next iteration
+                planets = {}
+                for k, m, n in active:
+                    mag = iterations[(k, m, n)].magnitude
 
-                while True:
+                    if (m, n) not in planets and (m, n, mag) not in fpf_cache:
+                        planets[(m, n)] = mag
+
+                if planets:
                     sys.stdout.write('.')
                     sys.stdout.flush()
 
-                    mag = list_mag[-1]
-
-                    fake_planet = FakePlanetModule(position=(sep*pixscale, ang),
-                                                   magnitude=mag,
-                                                   psf_scaling=self.m_psf_scaling,
-                                                   interpolation="spline",
-                                                   name_in="fake_planet",
-                                                   image_in_tag=self.m_image_in_tag,
-                                                   psf_in_tag=self.m_psf_in_tag,
-                                                   image_out_tag="contrast_fake",
-                                                   verbose=False)
-
-                    fake_planet.connect_database(self._m_data_base)
-                    fake_planet.run()
-
-                    prep = PSFpreparationModule(name_in="prep",
-                                                image_in_tag="contrast_fake",
-                                                image_out_tag="contrast_prep",
-                                                image_mask_out_tag=None,
-                                                mask_out_tag=None,
-                                                norm=self.m_norm,
-                                                resize=None,
-                                                cent_size=self.m_cent_size,
-                                                edge_size=self.m_edge_size,
-                                                verbose=False)
-
-                    prep.connect_database(self._m_data_base)
-                    prep.run()
-
-                    psf_sub = PcaPsfSubtractionModule(name_in="pca_contrast",
-                                                      pca_numbers=self.m_pca_number,
-                                                      images_in_tag="contrast_prep",
-                                                      reference_in_tag="contrast_prep",
-                                                      res_mean_tag="contrast_res_mean",
-                                                      res_median_tag=None,
-                                                      res_arr_out_tag=None,
-                                                      res_rot_mean_clip_tag=None,
-                                                      extra_rot=self.m_extra_rot,
-                                                      verbose=False)
-
-                    psf_sub.connect_database(self._m_data_base)
-                    psf_sub.run()
-
-                    res_input_port = self.add_input_port("contrast_res_mean")
-                    im_res = res_input_port.get_all()
-
-                    if len(im_res.shape) == 3:
-                        if im_res.shape[0] == 1:
-                            im_res = np.squeeze(im_res, axis=0)
-                        else:
-                            raise ValueError("Multiple residual images found, expecting only one.")
+                    im_res = self._psf_subtraction([(pos_r[m]*pixscale, pos_t[n], mag)
+                                                    for (m, n), mag in sorted(planets.items())])
 
                     if self.m_pca_out_port is not None:
-                        if count == 1 and iteration == 1:
+                        if count == 1 and not fpf_cache:
                             self.m_pca_out_port.set_all(im_res, data_dim=3)
                         else:
                             self.m_pca_out_port.append(im_res, data_dim=3)
 
-                    _, _, fpf = false_alarm(im_res, x_fake, y_fake, self.m_aperture, self.m_ignore)
+                    for (m, n), mag in planets.items():
+                        x_fake = center[0] + \
+                            pos_r[m]*math.cos(np.radians(pos_t[n]+90.-self.m_extra_rot))
+                        y_fake = center[1] + \
+                            pos_r[m]*math.sin(np.radians(pos_t[n]+90.-self.m_extra_rot))
 
-                    list_fpf.append(fpf)
+                        fpf = np.zeros(npca)
+                        for k in range(npca):
+                            _, _, fpf[k] = false_alarm(im_res[k, ],
+                                                       x_fake,
+                                                       y_fake,
+                                                       self.m_aperture,
+                                                       self.m_ignore)
 
-                    if abs(fpf_threshold-list_fpf[-1]) < self.m_accuracy*fpf_threshold:
-                        if len(list_fpf) == 1:
-                            fake_mag[m, n] = list_mag[0]
+                        fpf_cache[(m, n, mag)] = fpf
 
-                            sys.stdout.write("\n")
-                            sys.stdout.flush()
-                            break
+                for k, m, n in active:
+                    mag = iterations[(k, m, n)].magnitude
 
-                        else:
-                            if (fpf_threshold > list_fpf[-2] and fpf_threshold < list_fpf[-1]) or \
-                               (fpf_threshold < list_fpf[-2] and fpf_threshold > list_fpf[-1]):
+                    if (m, n, mag) in fpf_cache:
+                        iterations[(k, m, n)].update(fpf_cache[(m, n, mag)][k])
 
-                                fpf_interp = interp1d(list_fpf[-2:], list_mag[-2:], 'linear')
-                                fake_mag[m, n] = fpf_interp(fpf_threshold)
+            for k, m, n in iterations:
+                fake_mag[k, m, n] = iterations[(k, m, n)].m_result
 
-                                sys.stdout.write("\n")
-                                sys.stdout.flush()
-                                break
+            sys.stdout.write("\n")
+            sys.stdout.flush()
 
-                            else:
-                                pass
+            count += len(batch)
 
-                    if list_fpf[-1] < fpf_threshold:
-                        if list_mag[-1]+mag_step in list_mag:
-                            mag_step /= 2.
+        result = np.zeros((npca, len(pos_r), 4))
 
-                        list_mag.append(list_mag[-1]+mag_step)
+        for k in range(npca):
+            result[k, ] = np.column_stack((pos_r*pixscale,
+                                           np.nanmean(fake_mag[k, ], axis=1),
+                                           np.nanvar(fake_mag[k, ], axis=1),
+                                           fake_fpf))
 
-                    else:
-                        if np.size(list_fpf) > 2 and \
-                           list_mag[-1] < list_mag[-2] and list_mag[-2] < list_mag[-3] and \
-                           list_fpf[-1] > list_fpf[-2] and list_fpf[-2] < list_fpf[-3]:
+        if self.m_pca_list:
+            self.m_contrast_out_port.set_all(result, data_dim=3)
+        else:
+            self.m_contrast_out_port.set_all(result[0, ], data_dim=2)
 
-                            warnings.warn("Magnitude decreases but false positive fraction "
-                                          "increases. Adjusting magnitude to %s and step size "
-                                          "to %s" % (list_mag[-3], mag_step/2.))
+        sys.stdout.write("Running ContrastCurveModule... [DONE]\n")
+        sys.stdout.flush()
 
-                            list_fpf = []
-                            list_mag = [list_mag[-3]]
-                            mag_step /= 2.
+        if self.m_pca_out_port is not None:
+            self.m_pca_out_port.add_history_information("Contrast limits",
+                                                        str(self.m_sigma)+" sigma")
 
-                        else:
-                            if list_mag[-1]-mag_step in list_mag:
-                                mag_step /= 2.
+            self.m_pca_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+
+        self.m_contrast_out_port.add_history_information("Contrast limits",
+                                                         str(self.m_sigma)+" sigma")
 
-                            list_mag.append(list_mag[-1]-mag_step)
+        self.m_contrast_out_port.copy_attributes_from_input_port(self.m_image_in_port)
 
-                    if list_mag[-1] <= 0.:
-                        warnings.warn("The relative magnitude has become smaller or equal to "
-                                      "zero. Adjusting magnitude to 7.5 and step size to 0.1.")
+        self.m_contrast_out_port.close_port()
 
-                        list_mag[-1] = 7.5
-                        mag_step = 0.1
 
-                    iteration += 1
+class SnrMapModule(ProcessingModule):
+    """
+    Module to calculate a map of the signal-to-noise ratio (SNR) and false positive fraction (FPF)
+    of post-processed images with the Student's t-test (Mawet et al. 2014). The SNR is calculated
+    at every pixel with the same statistic as FalsePositiveModule.
+    """
+
+    def __init__(self,
+                 name_in="snr_map",
+                 image_in_tag="res_mean",
+                 snr_out_tag="snr_map",
+                 fpf_out_tag=None,
+                 candidate_out_tag=None,
+                 aperture=0.1,
+                 ignore=False,
+                 oversampling=4,
+                 threshold=5.):
+        """
+        Constructor of SnrMapModule.
+
+        :param name_in: Unique name of the module instance.
+        :type name_in: str
+        :param image_in_tag: Tag of the database entry with the post-processed images that are read
+                             as input.
+        :type image_in_tag: str
+        :param snr_out_tag: Tag of the database entry with the SNR maps that are written as output.
+                            Pixels for which the SNR can not be calculated (i.e., close to the
+                            center or where the ring of apertures falls outside the image) are set
+                            to NaN.
+        :type snr_out_tag: str
+        :param fpf_out_tag: Tag of the database entry with the FPF maps that are written as output.
+                            No data is written if set to None.
+        :type fpf_out_tag: str
+        :param candidate_out_tag: Tag of the database entry with the list of candidates that is
+                                  written as output. A candidate is a local maximum of the SNR map,
+                                  within an aperture radius, with an SNR above *threshold*. The
+                                  output format is: (image index, x position (pix), y position
+                                  (pix), separation (arcsec), position angle (deg), SNR, FPF).
+                                  No data is written if set to None.
+        :type candidate_out_tag: str
+        :param aperture: Aperture radius (arcsec).
+        :type aperture: float
+        :param ignore: Ignore the two neighboring apertures that may contain self-subtraction from
+                       the planet.
+        :type ignore: bool
+        :param oversampling: Number of subpixel positions per pixel, along each axis, at which the
+                             aperture sums are calculated. The aperture sums of the reference
+                             apertures are interpolated between these positions.
+        :type oversampling: int
+        :param threshold: Detection threshold (sigma) for the list of candidates.
+        :type threshold: float
+
+        :return: None
+        """
 
-                    if iteration == 50:
-                        warnings.warn("ContrastModule could not converge at the position of "
-                                      "%s arcsec and %s deg." % (sep*pixscale, ang))
+        super(SnrMapModule, self).__init__(name_in)
 
-                        fake_mag[m, n] = np.nan
+        self.m_image_in_port = self.add_input_port(image_in_tag)
+        self.m_snr_out_port = self.add_output_port(snr_out_tag)
 
-                        sys.stdout.write("\n")
-                        sys.stdout.flush()
+        if fpf_out_tag is None:
+            self.m_fpf_out_port = None
+        else:
+            self.m_fpf_out_port = self.add_output_port(fpf_out_tag)
 
-                        break
+        if candidate_out_tag is None:
+            self.m_candidate_out_port = None
+        else:
+            self.m_candidate_out_port = self.add_output_port(candidate_out_tag)
 
-                count += 1
+        self.m_aperture = aperture
+        self.m_ignore = ignore
+        self.m_oversampling = oversampling
+        self.m_threshold = threshold
 
-        result = np.column_stack((pos_r*pixscale,
-                                  np.nanmean(fake_mag, axis=1),
-                                  np.nanvar(fake_mag, axis=1),
-                                  fake_fpf))
+    def run(self):
+        """
+        Run method of the module. Calculates the aperture sums at all pixels with FFT convolutions
+        and the SNR and FPF of all pixels with the same number of reference apertures at once.
+        These groups of pixels are processed in parallel with the number of processes set by the
+        CPU attribute of the central configuration.
 
-        self.m_contrast_out_port.set_all(result, data_dim=2)
+        :return: None
+        """
 
-        sys.stdout.write("Running ContrastCurveModule... [DONE]\n")
+        pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
+        aperture = self.m_aperture/pixscale
+
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        ndim = self.m_image_in_port.get_ndim()
+
+        images = self.m_image_in_port.get_all()
+
+        if ndim == 2:
+            images = images[np.newaxis, ]
+
+        snr = np.zeros(images.shape)
+        fpf = np.zeros(images.shape)
+
+        for i in range(images.shape[0]):
+            progress(i, images.shape[0], "Running SnrMapModule...")
+
+            snr[i, ], fpf[i, ] = snr_map(images[i, ],
+                                         aperture,
+                                         self.m_ignore,
+                                         self.m_oversampling,
+                                         cpu)
+
+        sys.stdout.write("Running SnrMapModule... [DONE]\n")
         sys.stdout.flush()
 
-        if self.m_pca_out_port is not None:
-            self.m_pca_out_port.add_history_information("Contrast limits",
-                                                        str(self.m_sigma)+" sigma")
+        if ndim == 2:
+            self.m_snr_out_port.set_all(snr[0, ])
+        else:
+            self.m_snr_out_port.set_all(snr, data_dim=3)
 
-            self.m_pca_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+        self.m_snr_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+        self.m_snr_out_port.add_history_information("Signal-to-noise map",
+                                                    "Student's t-test")
 
-        self.m_contrast_out_port.add_history_information("Contrast limits",
-                                                         str(self.m_sigma)+" sigma")
+        if self.m_fpf_out_port is not None:
+            if ndim == 2:
+                self.m_fpf_out_port.set_all(fpf[0, ])
+            else:
+                self.m_fpf_out_port.set_all(fpf, data_dim=3)
 
-        self.m_contrast_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+            self.m_fpf_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+            self.m_fpf_out_port.add_history_information("False positive fraction map",
+                                                        "Student's t-test")
 
-        self.m_contrast_out_port.close_port()
+        if self.m_candidate_out_port is not None:
+            snr_max = np.where(np.isnan(snr), -np.inf, snr)
+
+            size = 2*int(math.ceil(aperture)) + 1
+            local_max = maximum_filter(snr_max, size=(1, size, size), mode='constant',
+                                       cval=-np.inf)
+
+            index, y_pos, x_pos = np.nonzero((snr_max == local_max) & \
+                                             (snr_max > self.m_threshold))
+
+            center = (images.shape[1]/2., images.shape[2]/2.)
+
+            sep = np.sqrt((center[0]-y_pos)**2.+(center[1]-x_pos)**2.)*pixscale
+            ang = (np.arctan2(y_pos-center[0], x_pos-center[1])*180./math.pi - 90.)%360.
+
+            candidates = np.column_stack((index,
+                                          x_pos,
+                                          y_pos,
+                                          sep,
+                                          ang,
+                                          snr[index, y_pos, x_pos],
+                                          fpf[index, y_pos, x_pos]))
+
+            self.m_candidate_out_port.set_all(candidates.reshape(-1, 7), data_dim=2)
+            self.m_candidate_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+            self.m_candidate_out_port.add_history_information("Candidates",
+                                                              "SNR > "+str(self.m_threshold))
+
+        self.m_snr_out_port.close_port()
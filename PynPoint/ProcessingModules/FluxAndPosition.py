@@ -4,15 +4,21 @@ Modules for photometric and astrometric measurements of a planet.
 
 import math
 import sys
+import ctypes
 import warnings
 
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+
 import numpy as np
 import emcee
 
-from scipy.ndimage import shift, fourier_shift, rotate
+from emcee.interruptible_pool import InterruptiblePool
+
+from scipy.ndimage import rotate
 from scipy.ndimage.filters import gaussian_filter
 from scipy.optimize import minimize
-from scipy.stats import t
 from sklearn.decomposition import PCA
 from skimage.feature import hessian_matrix
 from astropy.nddata import Cutout2D
@@ -22,7 +28,8 @@ from PynPoint.Core.Processing import ProcessingModule
 from PynPoint.ProcessingModules.PSFpreparation import PSFpreparationModule
 from PynPoint.ProcessingModules.PSFSubtractionPCA import PcaPsfSubtractionModule
 from PynPoint.Util.ModuleTools import progress, memory_frames
-from PynPoint.Util.AnalysisTools import false_alarm
+from PynPoint.Util.AnalysisTools import false_alarm, aperture_sum, aperture_sum_stack
+from PynPoint.Util.ImageTools import PsfStamp, annulus_mask, rotate_pixels, rotation_mask
 
 
 class FakePlanetModule(ProcessingModule):
@@ -45,9 +52,12 @@ class FakePlanetModule(ProcessingModule):
 
         :param position: Angular separation (arcsec) and position angle (deg) of the fake planet.
                          Angle is measured in counterclockwise direction with respect to the
-                         upward direction (i.e., East of North).
+                         upward direction (i.e., East of North). Multiple planets are injected
+                         simultaneously if a list of (separation, angle) tuples is provided.
         :type position: tuple
-        :param magnitude: Magnitude of the fake planet with respect to the star.
+        :param magnitude: Magnitude of the fake planet with respect to the star. Can be a list
+                          with one magnitude for each planet in *position*, otherwise the same
+                          magnitude is used for all planets.
         :type magnitude: float
         :param psf_scaling: Additional scaling factor of the planet flux (e.g., to correct for a
                             neutral density filter). A negative value will inject a negative
@@ -71,6 +81,11 @@ class FakePlanetModule(ProcessingModule):
 
         :Keyword arguments:
              * **verbose** (*bool*) -- Print progress.
+             * **stamp_radius** (*float*) -- Radius (arcsec) of the stamp around the center of
+                                             the PSF that is shifted and injected. Only the stamp
+                                             is interpolated so the computation time scales with
+                                             the area of the stamp. The full images of
+                                             *psf_in_tag* are injected if set to None (default).
 
         :return: None
         """
@@ -80,6 +95,11 @@ class FakePlanetModule(ProcessingModule):
         else:
             self.m_verbose = True
 
+        if "stamp_radius" in kwargs:
+            self.m_stamp_radius = kwargs["stamp_radius"]
+        else:
+            self.m_stamp_radius = None
+
         super(FakePlanetModule, self).__init__(name_in)
 
         self.m_image_in_port = self.add_input_port(image_in_tag)
@@ -150,29 +170,33 @@ class FakePlanetModule(ProcessingModule):
 
         return frames, psf, ndim_psf
 
-    def _shift_psf(self, psf, parang):
-        pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
+    def _planets_init(self):
+        position = np.atleast_2d(np.asarray(self.m_position, dtype=np.float64))
+        magnitude = np.atleast_1d(np.asarray(self.m_magnitude, dtype=np.float64))
 
-        radial = self.m_position[0]/pixscale
-        theta = self.m_position[1]*math.pi/180. + math.pi/2.
+        if position.ndim != 2 or position.shape[1] != 2:
+            raise ValueError("The position argument should contain a (separation, angle) tuple "
+                             "or a list of (separation, angle) tuples.")
 
-        x_shift = radial*math.cos(theta-parang)
-        y_shift = radial*math.sin(theta-parang)
+        if magnitude.size == 1:
+            magnitude = np.full(position.shape[0], magnitude[0])
 
-        if self.m_interpolation == "spline":
-            psf_shift = shift(psf, (y_shift, x_shift), order=5, mode='reflect')
+        elif magnitude.size != position.shape[0]:
+            raise ValueError("The number of magnitudes (%s) does not match the number of "
+                             "positions (%s)." % (magnitude.size, position.shape[0]))
 
-        elif self.m_interpolation == "bilinear":
-            psf_shift = shift(psf, (y_shift, x_shift), order=1, mode='reflect')
+        return position, magnitude
 
-        elif self.m_interpolation == "fft":
-            psf_fft = fourier_shift(np.fft.fftn(psf), (y_shift, x_shift))
-            psf_shift = np.fft.ifftn(psf_fft).real
+    def _planet_shifts(self, parang, position):
+        pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
 
-        else:
-            raise ValueError("Interpolation should be fft, spline, or bilinear.")
+        radial = position[0]/pixscale
+        theta = position[1]*math.pi/180. + math.pi/2.
+
+        x_shift = radial*np.cos(theta-parang)
+        y_shift = radial*np.sin(theta-parang)
 
-        return psf_shift
+        return np.column_stack((y_shift, x_shift))
 
     def run(self):
         """
@@ -189,25 +213,37 @@ class FakePlanetModule(ProcessingModule):
         parang = self.m_image_in_port.get_attribute("PARANG")
         parang *= math.pi/180.
 
-        flux_ratio = 10.**(-self.m_magnitude/2.5)
+        position, magnitude = self._planets_init()
+        flux_ratio = 10.**(-magnitude/2.5)
 
         frames, psf, ndim_psf = self._images_init()
 
+        if self.m_stamp_radius is None:
+            stamp_radius = None
+        else:
+            stamp_radius = self.m_stamp_radius/self.m_image_in_port.get_attribute("PIXSCALE")
+
+        # the spline coefficients of a single PSF template are only calculated once
+        if ndim_psf == 2:
+            psf_stamp = PsfStamp(psf,
+                                 radius=stamp_radius,
+                                 interpolation=self.m_interpolation)
+
         for j, _ in enumerate(frames[:-1]):
             if self.m_verbose:
                 progress(j, len(frames[:-1]), "Running FakePlanetModule...")
 
             image = np.copy(self.m_image_in_port[frames[j]:frames[j+1]])
 
-            for i in range(image.shape[0]):
-                if ndim_psf == 2:
-                    psf_tmp = np.copy(psf)
-
-                elif ndim_psf == 3:
-                    psf_tmp = self.m_psf_in_port[frames[j]+i, ]
+            if ndim_psf == 3:
+                psf_stamp = PsfStamp(self.m_psf_in_port[frames[j]:frames[j+1]],
+                                     radius=stamp_radius,
+                                     interpolation=self.m_interpolation)
 
-                psf_shift = self._shift_psf(psf_tmp, parang[frames[j]+i])
-                image[i, ] += self.m_psf_scaling*flux_ratio*psf_shift
+            for k, item in enumerate(position):
+                psf_stamp.add_to_images(image,
+                                        self._planet_shifts(parang[frames[j]:frames[j+1]], item),
+                                        self.m_psf_scaling*flux_ratio[k])
 
             self.m_image_out_port.append(image)
 
@@ -217,11 +253,14 @@ class FakePlanetModule(ProcessingModule):
 
         self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
 
+        history = []
+        for k, item in enumerate(position):
+            history.append("(" + "{0:.2f}".format(item[0]) + ", " + \
+                                 "{0:.2f}".format(item[1]) + ", " + \
+                                 "{0:.2f}".format(magnitude[k]) + ")")
+
         self.m_image_out_port.add_history_information("Fake planet",
-                                                      "(sep, angle, mag) = " + "(" + \
-                                                      "{0:.2f}".format(self.m_position[0])+", "+ \
-                                                      "{0:.2f}".format(self.m_position[1])+", "+ \
-                                                      "{0:.2f}".format(self.m_magnitude)+")")
+                                                      "(sep, angle, mag) = " + ", ".join(history))
 
         self.m_image_out_port.close_port()
 
@@ -248,7 +287,10 @@ class SimplexMinimizationModule(ProcessingModule):
                  pca_number=20,
                  cent_size=None,
                  edge_size=None,
-                 extra_rot=0.):
+                 extra_rot=0.,
+                 roi_margin=None,
+                 n_start=1,
+                 start_step=1.):
         """
         Constructor of SimplexMinimizationModule.
 
@@ -310,6 +352,23 @@ class SimplexMinimizationModule(ProcessingModule):
         :type edge_size: float
         :param extra_rot: Additional rotation angle of the images in clockwise direction (deg).
         :type extra_rot: float
+        :param roi_margin: Half width (arcsec) of an annulus around the separation of *position*.
+                           The PSF subtraction and derotation are only applied to the pixels
+                           within the annulus, which should therefore be wider than the aperture.
+                           The full images are used if set to None.
+        :type roi_margin: float
+        :param n_start: Number of start positions of the minimization. With more than one start
+                        position, a separate minimization is started from each point of a square
+                        grid around *position*, in parallel processes if CPU > 1, with the fake
+                        planet injection and PSF subtraction done in memory. The evaluations of
+                        each start are written consecutively to *flux_position_tag*, with the
+                        number of evaluations per start stored in the NEVAL attribute, and the
+                        last row contains the best result of all starts. The residuals of the
+                        best evaluation of each start and the overall best residuals are written
+                        to *res_out_tag*.
+        :type n_start: int
+        :param start_step: Spacing (pix) of the grid with start positions.
+        :type start_step: float
 
         :return: None
         """
@@ -335,10 +394,142 @@ class SimplexMinimizationModule(ProcessingModule):
         self.m_cent_size = cent_size
         self.m_edge_size = edge_size
         self.m_extra_rot = extra_rot
+        self.m_roi_margin = roi_margin
+        self.m_n_start = n_start
+        self.m_start_step = start_step
 
         self.m_image_in_tag = image_in_tag
         self.m_psf_in_tag = psf_in_tag
 
+    def _multi_start(self,
+                     pos_init,
+                     center,
+                     pixscale,
+                     annulus):
+        """
+        Internal method which runs the simplex minimization from a grid of start positions around
+        *pos_init*. The fake planet injection and PSF subtraction are done in memory such that
+        the minimizations can run in parallel processes. The evaluations of each start are
+        written to *flux_position_tag*, followed by a row with the overall best result. The
+        residuals of the best evaluation of each start are written to *res_out_tag*, followed by
+        the overall best residuals.
+
+        :return: Number of evaluations of each start.
+        :rtype: ndarray
+        """
+
+        images = np.ascontiguousarray(self.m_image_in_port.get_all(), dtype=np.float64)
+        psf = self.m_psf_in_port.get_all()
+        parang = self.m_image_in_port.get_attribute("PARANG")
+
+        cpu = self._m_config_port.get_attribute("CPU")
+
+        npix = images.shape[1]
+
+        mask = np.ones((images.shape[1], images.shape[2]))
+
+        if self.m_cent_size is not None or self.m_edge_size is not None:
+            if npix%2 == 0:
+                x_grid = y_grid = np.linspace(-npix/2+0.5, npix/2-0.5, npix)
+            elif npix%2 == 1:
+                x_grid = y_grid = np.linspace(-(npix-1)/2, (npix-1)/2, npix)
+
+            xx_grid, yy_grid = np.meshgrid(x_grid, y_grid)
+            rr_grid = np.sqrt(xx_grid**2+yy_grid**2)
+
+        if self.m_cent_size is not None:
+            mask[rr_grid < self.m_cent_size/pixscale] = 0.
+
+        if self.m_edge_size is not None:
+            mask[rr_grid > min(self.m_edge_size/pixscale, npix/2.)] = 0.
+
+        if annulus:
+            annulus = annulus_mask(images.shape[1:],
+                                   annulus["annulus"][0]/pixscale,
+                                   annulus["annulus"][1]/pixscale)
+        else:
+            annulus = None
+
+        args = {"psf":_psf_stamp(psf, images.shape[0], pixscale),
+                "parang":parang,
+                "psf_scaling":self.m_psf_scaling,
+                "pixscale":pixscale,
+                "pca_number":self.m_pca_number,
+                "extra_rot":self.m_extra_rot,
+                "annulus":annulus,
+                "mask":mask,
+                "center":center,
+                "crop_position":self.m_position,
+                "aperture":self.m_aperture,
+                "sigma":self.m_sigma,
+                "merit":self.m_merit,
+                "tolerance":self.m_tolerance,
+                "quantum":1e-2*self.m_tolerance}
+
+        offsets = _start_grid(self.m_n_start, self.m_start_step)
+
+        x_init = np.zeros((self.m_n_start, 3))
+        x_init[:, 0] = pos_init[0] + offsets[:, 0]
+        x_init[:, 1] = pos_init[1] + offsets[:, 1]
+        x_init[:, 2] = self.m_magnitude
+
+        # multiprocessing crashed on Mac in combination with numpy
+        if sys.platform == "darwin" or cpu == 1:
+            _init_simplex(images, images.shape, args)
+
+            results = []
+            for item in x_init:
+                results.append(_simplex_start(item))
+
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+        else:
+            shared_images = RawArray(ctypes.c_double, images.size)
+            np.frombuffer(shared_images, dtype=np.float64)[:] = images.ravel()
+
+            pool = Pool(processes=min(cpu, self.m_n_start),
+                        initializer=_init_simplex,
+                        initargs=(shared_images, images.shape, args))
+
+            try:
+                results = pool.map(_simplex_start, x_init)
+
+            finally:
+                pool.close()
+                pool.join()
+
+        n_eval = np.zeros(self.m_n_start, dtype=np.int)
+
+        best_merit = np.inf
+        best_row = None
+        best_res = None
+
+        for i, (rows, im_res) in enumerate(results):
+            n_eval[i] = rows.shape[0]
+
+            self.m_flux_position_port.append(rows, data_dim=2)
+            self.m_res_out_port.append(im_res, data_dim=3)
+
+            if np.all(np.isnan(rows[:, 5])):
+                continue
+
+            index = np.nanargmin(rows[:, 5])
+
+            if rows[index, 5] < best_merit:
+                best_merit = rows[index, 5]
+                best_row = rows[index, ]
+                best_res = im_res
+
+        if best_row is None:
+            raise ValueError("The function of merit is NaN for all evaluations of all start "
+                             "positions. Please check the aperture and the input data.")
+
+        self.m_flux_position_port.append(best_row, data_dim=2)
+        self.m_res_out_port.append(best_res, data_dim=3)
+
+        return n_eval
+
     def run(self):
         """
         Run method of the module. The position and flux of a planet are measured by injecting
@@ -350,16 +541,12 @@ class SimplexMinimizationModule(ProcessingModule):
         :return: None
         """
 
-        def _rotate(center, position, angle):
-            pos_x = (position[0]-center[0])*math.cos(np.radians(angle)) - \
-                    (position[1]-center[1])*math.sin(np.radians(angle))
-
-            pos_y = (position[0]-center[0])*math.sin(np.radians(angle)) + \
-                    (position[1]-center[1])*math.cos(np.radians(angle))
+        def _objective(arg):
+            merit = memo.get(arg)
 
-            return (center[0]+pos_x, center[1]+pos_y)
+            if merit is not None:
+                return merit
 
-        def _objective(arg):
             sys.stdout.write('.')
             sys.stdout.flush()
 
@@ -405,7 +592,8 @@ class SimplexMinimizationModule(ProcessingModule):
                                               res_arr_out_tag=None,
                                               res_rot_mean_clip_tag=None,
                                               extra_rot=self.m_extra_rot,
-                                              verbose=False)
+                                              verbose=False,
+                                              **annulus)
 
             psf_sub.connect_database(self._m_data_base)
             psf_sub.run()
@@ -421,57 +609,16 @@ class SimplexMinimizationModule(ProcessingModule):
 
             self.m_res_out_port.append(im_res, data_dim=3)
 
-            im_crop = Cutout2D(data=im_res,
-                               position=self.m_position,
-                               size=2*self.m_aperture).data
-
-            npix = im_crop.shape[0]
-
-            if self.m_merit == "hessian":
-
-                if npix%2 == 0:
-                    x_grid = y_grid = np.linspace(-npix/2+0.5, npix/2-0.5, npix)
-                elif npix%2 == 1:
-                    x_grid = y_grid = np.linspace(-(npix-1)/2, (npix-1)/2, npix)
-
-                xx_grid, yy_grid = np.meshgrid(x_grid, y_grid)
-                rr_grid = np.sqrt(xx_grid*xx_grid+yy_grid*yy_grid)
-
-                hessian_rr, hessian_rc, hessian_cc = hessian_matrix(im_crop,
-                                                                    sigma=self.m_sigma,
-                                                                    mode='constant',
-                                                                    cval=0.,
-                                                                    order='rc')
-
-                hes_det = (hessian_rr*hessian_cc) - (hessian_rc*hessian_rc)
-                hes_det[rr_grid > self.m_aperture] = 0.
-                merit = np.sum(np.abs(hes_det))
-
-            elif self.m_merit == "sum":
+            merit = _simplex_merit(im_res,
+                                   self.m_position,
+                                   (pos_x, pos_y),
+                                   self.m_aperture,
+                                   self.m_sigma,
+                                   self.m_merit)
 
-                if self.m_sigma > 0.:
-                    im_crop = gaussian_filter(input=im_crop, sigma=self.m_sigma)
+            memo.put(arg, merit)
 
-                aperture = CircularAperture((npix/2., npix/2.), self.m_aperture)
-                phot_table = aperture_photometry(np.abs(im_crop), aperture, method='exact')
-                merit = phot_table['aperture_sum']
-
-            elif self.m_merit == "ttest":
-
-                if self.m_sigma > 0.:
-                    im_res = gaussian_filter(input=im_res, sigma=self.m_sigma)
-                    im_crop = gaussian_filter(input=im_crop, sigma=self.m_sigma)
-
-                noise, _, _ = false_alarm(im_res, pos_x, pos_y, self.m_aperture, True)
-
-                aperture = CircularAperture((npix/2., npix/2.), self.m_aperture)
-                phot_table = aperture_photometry(np.abs(im_crop), aperture, method='exact')
-                merit = phot_table['aperture_sum']**2 / noise**2
-
-            else:
-                raise ValueError("Function of merit not recognized.")
-
-            position = _rotate(center, (pos_x, pos_y), -self.m_extra_rot)
+            position = _rotate_position(center, (pos_x, pos_y), -self.m_extra_rot)
 
             res = np.asarray((position[0],
                               position[1],
@@ -516,13 +663,30 @@ class SimplexMinimizationModule(ProcessingModule):
         sys.stdout.write("Running SimplexMinimizationModule")
         sys.stdout.flush()
 
-        pos_init = _rotate(center, self.m_position, self.m_extra_rot)
+        pos_init = _rotate_position(center, self.m_position, self.m_extra_rot)
+
+        if self.m_roi_margin is None:
+            annulus = {}
+
+        else:
+            sep_init = math.sqrt((self.m_position[1]-center[0])**2 +
+                                 (self.m_position[0]-center[1])**2)*pixscale
 
-        minimize(fun=_objective,
-                 x0=[pos_init[0], pos_init[1], self.m_magnitude],
-                 method="Nelder-Mead",
-                 tol=None,
-                 options={'xatol': self.m_tolerance, 'fatol': float("inf")})
+            annulus = {"annulus": (max(sep_init-self.m_roi_margin, 0.),
+                                   sep_init+self.m_roi_margin)}
+
+        # evaluations that differ by less than a hundredth of the tolerance are not repeated
+        memo = _MeritMemo(1e-2*self.m_tolerance)
+
+        if self.m_n_start == 1:
+            minimize(fun=_objective,
+                     x0=[pos_init[0], pos_init[1], self.m_magnitude],
+                     method="Nelder-Mead",
+                     tol=None,
+                     options={'xatol': self.m_tolerance, 'fatol': float("inf")})
+
+        else:
+            n_eval = self._multi_start(pos_init, center, pixscale, annulus)
 
         sys.stdout.write(" [DONE]\n")
         sys.stdout.flush()
@@ -536,6 +700,9 @@ class SimplexMinimizationModule(ProcessingModule):
         self.m_res_out_port.copy_attributes_from_input_port(self.m_image_in_port)
         self.m_flux_position_port.copy_attributes_from_input_port(self.m_image_in_port)
 
+        if self.m_n_start > 1:
+            self.m_flux_position_port.add_attribute("NEVAL", n_eval, static=False)
+
         self.m_res_out_port.close_port()
 
 
@@ -558,7 +725,8 @@ class FalsePositiveModule(ProcessingModule):
         :param position: The x and y position (pix) where the SNR and FPF is calculated. Note that
                          the bottom left of the image is defined as (0, 0) so there is a -0.5
                          offset with respect to the DS9 coordinate system. Aperture photometry
-                         corrects for the partial inclusion of pixels at the boundary.
+                         corrects for the partial inclusion of pixels at the boundary. A list of
+                         positions can be provided, in which case one row is written per position.
         :type position: tuple
         :param aperture: Aperture radius (arcsec).
         :type aperture: float
@@ -590,8 +758,8 @@ class FalsePositiveModule(ProcessingModule):
 
     def run(self):
         """
-        Run method of the module. Calculates the SNR and FPF for a specified position in a post-
-        processed image with the Student's t-test (Mawet et al. 2014). This approach accounts
+        Run method of the module. Calculates the SNR and FPF for the specified positions in a
+        post-processed image with the Student's t-test (Mawet et al. 2014). This approach accounts
         for small sample statistics.
 
         :return: None
@@ -611,41 +779,26 @@ class FalsePositiveModule(ProcessingModule):
 
             image = image[0, ]
 
-        npix = image.shape[0]
-        center = npix/2.
-
         if image.ndim > 2:
             raise ValueError("The image_in_tag should contain a 2D array.")
 
-        sep = math.sqrt((center-self.m_position[0])**2.+(center-self.m_position[1])**2.)
-        ang = (math.atan2(self.m_position[1]-center,
-                          self.m_position[0]-center)*180./math.pi - 90.)%360.
-
-        num_ap = int(math.pi*sep/self.m_aperture)
-        ap_theta = np.linspace(0, 2.*math.pi, num_ap, endpoint=False)
-
-        if self.m_ignore:
-            num_ap -= 2
-            ap_theta = np.delete(ap_theta, [1, np.size(ap_theta)-1])
-
-        ap_phot = np.zeros(num_ap)
-        for i, theta in enumerate(ap_theta):
-            x_tmp = center + (self.m_position[0]-center)*math.cos(theta) - \
-                             (self.m_position[1]-center)*math.sin(theta)
-            y_tmp = center + (self.m_position[0]-center)*math.sin(theta) + \
-                             (self.m_position[1]-center)*math.cos(theta)
+        position = np.asarray(self.m_position, dtype=np.float64).reshape(-1, 2)
 
-            aperture = CircularAperture((x_tmp, y_tmp), self.m_aperture)
-            phot_table = aperture_photometry(image, aperture, method='exact')
-            ap_phot[i] = phot_table['aperture_sum']
+        center = (image.shape[0]/2., image.shape[1]/2.)
 
-        snr = (ap_phot[0] - np.mean(ap_phot[1:])) / \
-              (np.std(ap_phot[1:]) * math.sqrt(1.+1./float(num_ap-1)))
+        sep = np.sqrt((center[1]-position[:, 0])**2.+(center[0]-position[:, 1])**2.)
+        ang = (np.arctan2(position[:, 1]-center[0],
+                          position[:, 0]-center[1])*180./math.pi - 90.)%360.
 
-        fpf = 1. - t.cdf(snr, num_ap-2)
+        # all rings are evaluated with a single sparse aperture matrix
+        _, snr, fpf = false_alarm(image,
+                                  position[:, 0],
+                                  position[:, 1],
+                                  self.m_aperture,
+                                  self.m_ignore)
 
-        result = np.column_stack((self.m_position[0],
-                                  self.m_position[1],
+        result = np.column_stack((position[:, 0],
+                                  position[:, 1],
                                   sep*pixscale,
                                   ang,
                                   snr,
@@ -670,54 +823,71 @@ def _fake_planet(science,
                  position,
                  magnitude,
                  psf_scaling,
-                 pixscale):
+                 pixscale,
+                 stamp_radius=None):
     """
     Internal function to inject fake planets into a cube of images. This function is similar to
-    FakePlanetModule but does not require access to the PynPoint database.
+    FakePlanetModule but does not require access to the PynPoint database. The PSF can be provided
+    as a PsfStamp in order to reuse its interpolation coefficients between calls.
     """
 
     radial = position[0]/pixscale
     theta = position[1]*math.pi/180. + math.pi/2.
     flux_ratio = 10.**(-magnitude/2.5)
 
-    if psf.ndim == 2:
-        psf_size = (psf.shape[0], psf.shape[1])
-    elif psf.ndim == 3:
-        psf_size = (psf.shape[1], psf.shape[2])
+    if not isinstance(psf, PsfStamp):
+        psf = _psf_stamp(psf, science.shape[0], pixscale, stamp_radius)
 
-    if psf_size != (science.shape[1], science.shape[2]):
+    if psf.image_shape != (science.shape[1], science.shape[2]):
         raise ValueError("The science images should have the same dimensions as the PSF template.")
 
-    if psf.ndim == 3 and psf.shape[0] == 1:
-        psf = np.squeeze(psf, axis=0)
-    elif psf.ndim == 3 and psf.shape[0] != science.shape[0]:
-        psf = np.mean(psf, axis=0)
+    x_shift = radial*np.cos(theta-np.radians(parang))
+    y_shift = radial*np.sin(theta-np.radians(parang))
 
     fake = np.copy(science)
 
-    for i in range(fake.shape[0]):
-        x_shift = radial*math.cos(theta-math.radians(parang[i]))
-        y_shift = radial*math.sin(theta-math.radians(parang[i]))
+    psf.add_to_images(fake, np.column_stack((y_shift, x_shift)), psf_scaling*flux_ratio)
+
+    return fake
 
-        if psf.ndim == 2:
-            psf_tmp = np.copy(psf)
-        elif psf.ndim == 3:
-            psf_tmp = np.copy(psf[i, ])
 
-        psf_tmp = shift(psf_tmp,
-                        (y_shift, x_shift),
-                        order=5,
-                        mode='reflect')
+def _psf_stamp(psf,
+               nimages,
+               pixscale,
+               stamp_radius=None):
+    """
+    Internal function to create the PsfStamp that is used by _fake_planet. A cube with a number of
+    PSF templates different from *nimages* is averaged.
 
-        fake[i, ] += psf_scaling*flux_ratio*psf_tmp
+    :param psf: PSF template, either a single image (2D) or a cube (3D).
+    :type psf: ndarray
+    :param nimages: Number of science images.
+    :type nimages: int
+    :param pixscale: Pixel scale (arcsec).
+    :type pixscale: float
+    :param stamp_radius: Radius (arcsec) of the PSF stamp. The full image is used if set to None.
+    :type stamp_radius: float
 
-    return fake
+    :return: PSF template with precomputed interpolation coefficients.
+    :rtype: PynPoint.Util.ImageTools.PsfStamp
+    """
+
+    if psf.ndim == 3 and psf.shape[0] == 1:
+        psf = np.squeeze(psf, axis=0)
+    elif psf.ndim == 3 and psf.shape[0] != nimages:
+        psf = np.mean(psf, axis=0)
+
+    if stamp_radius is not None:
+        stamp_radius /= pixscale
+
+    return PsfStamp(psf, radius=stamp_radius, interpolation="spline")
 
 
 def _psf_subtraction(images,
                      parang,
                      pca_number,
-                     extra_rot):
+                     extra_rot,
+                     annulus=None):
     """
     Internal function for PSF subtraction with PCA.
 
@@ -729,6 +899,11 @@ def _psf_subtraction(images,
     :type pca_number: int
     :param extra_rot: Additional rotation angle of the images (deg).
     :type extra_rot: float
+    :param annulus: Boolean mask of the pixels that are derotated. The PSF subtraction is
+                    applied to the mask padded by three pixels, such that the interpolation at
+                    the edge of the mask uses residuals instead of zeros. The residuals are zero
+                    outside the mask. The full images are used if set to None.
+    :type annulus: ndarray
 
     :return: Mean residuals of the PSF subtraction.
     :rtype: ndarray
@@ -737,7 +912,12 @@ def _psf_subtraction(images,
     pca = PCA(n_components=pca_number, svd_solver="arpack")
 
     images -= np.mean(images, axis=0)
-    images_reshape = images.reshape((images.shape[0], images.shape[1]*images.shape[2]))
+
+    if annulus is None:
+        images_reshape = images.reshape((images.shape[0], images.shape[1]*images.shape[2]))
+    else:
+        annulus_fit = rotation_mask(annulus)
+        images_reshape = images[:, annulus_fit]
 
     pca.fit(images_reshape)
 
@@ -745,16 +925,77 @@ def _psf_subtraction(images,
     pca_rep = np.vstack((pca_rep, np.zeros((0, images.shape[0])))).T
 
     model = pca.inverse_transform(pca_rep)
-    model = model.reshape(images.shape)
 
-    residuals = images - model
+    if annulus is None:
+        model = model.reshape(images.shape)
 
-    for j, item in enumerate(-1.*parang):
-        residuals[j, ] = rotate(residuals[j, ], item+extra_rot, reshape=False)
+        residuals = images - model
+
+        for j, item in enumerate(-1.*parang):
+            residuals[j, ] = rotate(residuals[j, ], item+extra_rot, reshape=False)
+
+    else:
+        res_annulus = images_reshape - model
+
+        residuals = np.zeros(images.shape)
+        res_temp = np.zeros(images.shape[1:])
+
+        for j, item in enumerate(-1.*parang):
+            res_temp[annulus_fit] = res_annulus[j, ]
+            residuals[j, annulus] = rotate_pixels(res_temp, item+extra_rot, annulus)
 
     return np.mean(residuals, axis=0)
 
 
+def _autocorr_time(chain,
+                   window=5.):
+    """
+    Internal function to estimate the integrated autocorrelation time of each parameter. The
+    autocorrelation function is averaged over the walkers and summed up to the smallest lag
+    that is larger than *window* times the estimated autocorrelation time (Sokal 1997). Walkers
+    that have not moved in a parameter are excluded from the average. The autocorrelation time
+    is set to the number of steps if none of the walkers has moved in a parameter.
+
+    :param chain: Chain with the shape (nwalkers, nsteps, ndim).
+    :type chain: ndarray
+    :param window: Factor for the automated window selection.
+    :type window: float
+
+    :return: Autocorrelation time of each parameter.
+    :rtype: ndarray
+    """
+
+    acf = np.zeros(chain.shape[1:])
+    count = np.zeros(chain.shape[2])
+
+    for item in chain:
+        with np.errstate(invalid="ignore"):
+            acf_walker = emcee.autocorr.function(item, axis=0)
+
+        finite = np.isfinite(acf_walker[0, ])
+
+        acf[:, finite] += acf_walker[:, finite]
+        count[finite] += 1.
+
+    taus = 2.*np.cumsum(acf/np.maximum(count, 1.), axis=0) - 1.
+
+    tau = np.zeros(chain.shape[2])
+
+    for i in range(chain.shape[2]):
+        if count[i] == 0.:
+            tau[i] = float(chain.shape[1])
+            continue
+
+        lag = np.arange(chain.shape[1]) >= window*taus[:, i]
+
+        if np.any(lag):
+            tau[i] = taus[np.argmax(lag), i]
+        else:
+            tau[i] = taus[-1, i]
+
+    return tau
+
+
 def _lnprob(param,
             bounds,
             images,
@@ -765,7 +1006,8 @@ def _lnprob(param,
             pixscale,
             pca_number,
             extra_rot,
-            aperture):
+            aperture,
+            annulus=None):
     """
     Internal function for the log posterior function. Should be placed at the highest level of the
     Python module in order to be pickled.
@@ -779,9 +1021,8 @@ def _lnprob(param,
     :type bounds: tuple, float
     :param images: Stack with images.
     :type images: ndarray
-    :param psf: PSF template, either a single image (2D) or a cube (3D) with the dimensions
-                equal to *image_in_tag*.
-    :type psf: ndarray
+    :param psf: PSF template with precomputed interpolation coefficients.
+    :type psf: PynPoint.Util.ImageTools.PsfStamp
     :param mask: Array with the circular mask (zeros) of the central and outer regions.
     :type mask: ndarray
     :param parang: Array with the angles for derotation.
@@ -799,6 +1040,9 @@ def _lnprob(param,
     :type extra_rot: float
     :param aperture: Circular aperture at the position specified in *param*.
     :type aperture: photutils.CircularAperture
+    :param annulus: Boolean mask of the pixels that are derotated after the PSF subtraction (see
+                    _psf_subtraction). The full images are used if set to None.
+    :type annulus: ndarray
 
     :return: Log posterior.
     :rtype float
@@ -848,7 +1092,8 @@ def _lnprob(param,
         im_res = _psf_subtraction(fake,
                                   parang,
                                   pca_number,
-                                  extra_rot)
+                                  extra_rot,
+                                  annulus)
 
         phot_table = aperture_photometry(np.abs(im_res), aperture, method='exact')
 
@@ -865,6 +1110,355 @@ def _lnprob(param,
     return lnprob
 
 
+# arguments of the log posterior that are stored once in each worker process of the MCMC sampling
+_LNPROB_ARGS = None
+
+
+def _init_lnprob(shared_images,
+                 shape,
+                 args):
+    """
+    Internal function which initializes a worker process of the MCMC sampling. The images are
+    read from shared memory without a copy and the other arguments of _lnprob are stored for the
+    lifetime of the process, such that only the parameter vector of a walker is pickled.
+
+    :param shared_images: Stack of images in shared memory.
+    :type shared_images: multiprocessing.sharedctypes.RawArray
+    :param shape: Shape of the stack of images.
+    :type shape: tuple
+    :param args: Arguments of _lnprob after *param*, with the images replaced by None.
+    :type args: tuple
+
+    :return: None
+    """
+
+    global _LNPROB_ARGS
+
+    images = np.frombuffer(shared_images, dtype=np.float64).reshape(shape)
+
+    _LNPROB_ARGS = (args[0], images) + tuple(args[2:])
+
+
+def _lnprob_shared(param):
+    """
+    Internal function for the log posterior function in a worker process that has been
+    initialized with _init_lnprob.
+
+    :param param: Tuple with the separation (arcsec), angle (deg), and contrast (mag).
+    :type param: tuple, float
+
+    :return: Log posterior.
+    :rtype: float
+    """
+
+    return _lnprob(param, *_LNPROB_ARGS)
+
+
+def _rotate_position(center,
+                     position,
+                     angle):
+    """
+    Internal function to rotate a position (x, y) around a center (y, x) in counterclockwise
+    direction.
+
+    :param center: Center (y, x) of the rotation (pix).
+    :type center: tuple
+    :param position: Position (x, y) that is rotated (pix).
+    :type position: tuple
+    :param angle: Rotation angle (deg).
+    :type angle: float
+
+    :return: Rotated position (x, y).
+    :rtype: tuple
+    """
+
+    pos_x = (position[0]-center[0])*math.cos(np.radians(angle)) - \
+            (position[1]-center[1])*math.sin(np.radians(angle))
+
+    pos_y = (position[0]-center[0])*math.sin(np.radians(angle)) + \
+            (position[1]-center[1])*math.cos(np.radians(angle))
+
+    return (center[0]+pos_x, center[1]+pos_y)
+
+
+def _simplex_merit(im_res,
+                   crop_position,
+                   position,
+                   aperture,
+                   sigma,
+                   merit):
+    """
+    Internal function to calculate the function of merit of the SimplexMinimizationModule.
+
+    :param im_res: Residuals of the PSF subtraction.
+    :type im_res: ndarray
+    :param crop_position: Position (x, y) of the image crop in which the merit is calculated (pix).
+    :type crop_position: tuple
+    :param position: Position (x, y) of the fake planet (pix), used for the noise of the t-test.
+    :type position: tuple
+    :param aperture: Aperture radius (pix).
+    :type aperture: int
+    :param sigma: Standard deviation (pix) of the Gaussian smoothing kernel.
+    :type sigma: float
+    :param merit: Function of merit (hessian, sum, or ttest).
+    :type merit: str
+
+    :return: Function of merit.
+    :rtype: float
+    """
+
+    im_crop = Cutout2D(data=im_res,
+                       position=crop_position,
+                       size=2*aperture).data
+
+    npix = im_crop.shape[0]
+
+    if merit == "hessian":
+
+        if npix%2 == 0:
+            x_grid = y_grid = np.linspace(-npix/2+0.5, npix/2-0.5, npix)
+        elif npix%2 == 1:
+            x_grid = y_grid = np.linspace(-(npix-1)/2, (npix-1)/2, npix)
+
+        xx_grid, yy_grid = np.meshgrid(x_grid, y_grid)
+        rr_grid = np.sqrt(xx_grid*xx_grid+yy_grid*yy_grid)
+
+        hessian_rr, hessian_rc, hessian_cc = hessian_matrix(im_crop,
+                                                            sigma=sigma,
+                                                            mode='constant',
+                                                            cval=0.,
+                                                            order='rc')
+
+        hes_det = (hessian_rr*hessian_cc) - (hessian_rc*hessian_rc)
+        hes_det[rr_grid > aperture] = 0.
+        value = np.sum(np.abs(hes_det))
+
+    elif merit == "sum":
+
+        if sigma > 0.:
+            im_crop = gaussian_filter(input=im_crop, sigma=sigma)
+
+        value = aperture_sum(np.abs(im_crop), npix/2., npix/2., aperture)
+
+    elif merit == "ttest":
+
+        if sigma > 0.:
+            im_res = gaussian_filter(input=im_res, sigma=sigma)
+            im_crop = gaussian_filter(input=im_crop, sigma=sigma)
+
+        noise, _, _ = false_alarm(im_res, position[0], position[1], aperture, True)
+
+        value = aperture_sum(np.abs(im_crop), npix/2., npix/2., aperture)**2 / noise**2
+
+    else:
+        raise ValueError("Function of merit not recognized.")
+
+    return value
+
+
+class _MeritMemo(object):
+    """
+    Internal class with a least-recently-used cache of the function of merit of the simplex
+    minimization. The parameters are quantized such that evaluations which differ by less than
+    the quantum are calculated only once.
+    """
+
+    def __init__(self,
+                 quantum,
+                 size=100):
+
+        self.m_quantum = quantum
+        self.m_size = size
+        self.m_cache = OrderedDict()
+
+    def _key(self, arg):
+        return tuple(np.round(np.asarray(arg, dtype=np.float64)/self.m_quantum).astype(int))
+
+    def get(self, arg):
+        """
+        Returns the cached function of merit or None if the parameters have not been evaluated.
+        """
+
+        key = self._key(arg)
+
+        if key not in self.m_cache:
+            return None
+
+        value = self.m_cache.pop(key)
+        self.m_cache[key] = value
+
+        return value
+
+    def put(self, arg, value):
+        """
+        Stores the function of merit of the parameters and removes the least recently used value
+        when the cache is full.
+        """
+
+        self.m_cache[self._key(arg)] = value
+
+        if len(self.m_cache) > self.m_size:
+            self.m_cache.popitem(last=False)
+
+
+def _start_grid(n_start,
+                step):
+    """
+    Internal function to create the offsets (pix) of the start positions of a multi-start simplex
+    minimization. The offsets are taken from a square grid, sorted by the distance to the center,
+    such that the first offset is zero.
+
+    :param n_start: Number of start positions.
+    :type n_start: int
+    :param step: Spacing (pix) of the grid.
+    :type step: float
+
+    :return: Offsets (x, y) with the shape (n_start, 2).
+    :rtype: ndarray
+    """
+
+    half = int(math.ceil((math.sqrt(n_start)-1.)/2.))
+
+    grid = np.arange(-half, half+1)
+    yy_grid, xx_grid = np.meshgrid(grid, grid, indexing="ij")
+
+    offsets = np.column_stack((xx_grid.ravel(), yy_grid.ravel()))
+    order = np.lexsort((np.arctan2(offsets[:, 1], offsets[:, 0]),
+                        np.sum(offsets**2, axis=1)))
+
+    return step*offsets[order[:n_start], ].astype(np.float64)
+
+
+# arguments of the simplex objective that are stored once in each worker process
+_SIMPLEX_ARGS = None
+
+
+def _init_simplex(shared_images,
+                  shape,
+                  args):
+    """
+    Internal function which initializes a process of the multi-start simplex minimization. The
+    images are read from shared memory without a copy and the other arguments are stored for the
+    lifetime of the process.
+
+    :param shared_images: Stack of images in shared memory, or a contiguous float64 array when
+                          the minimization runs in the main process.
+    :type shared_images: multiprocessing.sharedctypes.RawArray
+    :param shape: Shape of the stack of images.
+    :type shape: tuple
+    :param args: Dictionary with the arguments of _simplex_objective.
+    :type args: dict
+
+    :return: None
+    """
+
+    global _SIMPLEX_ARGS
+
+    images = np.frombuffer(shared_images, dtype=np.float64).reshape(shape)
+
+    _SIMPLEX_ARGS = dict(args, images=images)
+
+
+def _simplex_objective(arg,
+                       args):
+    """
+    Internal function for the objective of the multi-start simplex minimization. This function
+    is equivalent to the objective of SimplexMinimizationModule but the fake planet injection
+    and PSF subtraction are done in memory instead of through the database.
+
+    :param arg: Position (x, y) (pix) and contrast (mag) of the negative fake planet.
+    :type arg: ndarray
+    :param args: Dictionary with the arguments that are set by _init_simplex.
+    :type args: dict
+
+    :return: Function of merit, output row of *flux_position_tag*, and the residuals.
+    :rtype: float, ndarray, ndarray
+    """
+
+    pos_x, pos_y, mag = arg
+    center = args["center"]
+
+    sep = math.sqrt((pos_y-center[0])**2+(pos_x-center[1])**2)*args["pixscale"]
+    ang = math.atan2(pos_y-center[0], pos_x-center[1])*180./math.pi - 90.
+
+    fake = _fake_planet(args["images"],
+                        args["psf"],
+                        args["parang"],
+                        (sep, ang),
+                        mag,
+                        args["psf_scaling"],
+                        args["pixscale"])
+
+    fake *= args["mask"]
+
+    im_res = _psf_subtraction(fake,
+                              args["parang"],
+                              args["pca_number"],
+                              args["extra_rot"],
+                              args["annulus"])
+
+    merit = _simplex_merit(im_res,
+                           args["crop_position"],
+                           (pos_x, pos_y),
+                           args["aperture"],
+                           args["sigma"],
+                           args["merit"])
+
+    position = _rotate_position(center, (pos_x, pos_y), -args["extra_rot"])
+
+    row = np.asarray((position[0],
+                      position[1],
+                      sep,
+                      (ang-args["extra_rot"])%360.,
+                      mag,
+                      merit))
+
+    return merit, row, im_res
+
+
+def _simplex_start(x_init):
+    """
+    Internal function which runs a single simplex minimization from a start point in a process
+    that has been initialized with _init_simplex.
+
+    :param x_init: Start point with the position (x, y) (pix) and contrast (mag).
+    :type x_init: ndarray
+
+    :return: Output rows of all evaluations and the residuals of the best evaluation.
+    :rtype: ndarray, ndarray
+    """
+
+    args = _SIMPLEX_ARGS
+
+    memo = _MeritMemo(args["quantum"])
+
+    rows = []
+    best = [np.inf, None]
+
+    def _objective(arg):
+        merit = memo.get(arg)
+
+        if merit is None:
+            merit, row, im_res = _simplex_objective(arg, args)
+            memo.put(arg, merit)
+
+            rows.append(row)
+
+            if merit < best[0]:
+                best[0] = merit
+                best[1] = im_res
+
+        return merit
+
+    minimize(fun=_objective,
+             x0=x_init,
+             method="Nelder-Mead",
+             tol=None,
+             options={'xatol': args["tolerance"], 'fatol': float("inf")})
+
+    return np.asarray(rows), best[1]
+
+
 class MCMCsamplingModule(ProcessingModule):
     """
     Module to determine the contrast and position of a planet with an affine invariant Markov chain
@@ -885,6 +1479,13 @@ class MCMCsamplingModule(ProcessingModule):
                  aperture=0.1,
                  mask=0.,
                  extra_rot=0.,
+                 lnprob_out_tag=None,
+                 checkpoint=None,
+                 resume=False,
+                 tau_step=None,
+                 tau_factor=50.,
+                 tau_tolerance=0.01,
+                 roi_margin=None,
                  **kwargs):
         """
         Constructor of MCMCsamplingModule.
@@ -906,7 +1507,7 @@ class MCMCsamplingModule(ProcessingModule):
                            dimensions equal to *image_in_tag*.
         :type psf_in_tag: str
         :param chain_out_tag: Tag of the database entry with the Markov chain that is written as
-                              output. The shape of the array is (nwalkers*nsteps, 3).
+                              output. The shape of the array is (nwalkers, nsteps, 3).
         :type chain_out_tag: str
         :param nwalkers: Number of ensemble members (i.e. chains).
         :type nwalkers: int
@@ -924,6 +1525,40 @@ class MCMCsamplingModule(ProcessingModule):
         :type mask: float
         :param extra_rot: Additional rotation angle of the images (deg).
         :type extra_rot: float
+        :param lnprob_out_tag: Tag of the database entry with the log posterior probabilities of
+                               the walkers, with the shape (nwalkers, nsteps). No data is written
+                               if set to None.
+        :type lnprob_out_tag: str
+        :param checkpoint: Number of steps after which the walker positions and log posterior
+                           probabilities are appended to the database entry *chain_out_tag* +
+                           "_checkpoint", with the shape (nsteps, nwalkers, 4). The checkpoint is
+                           only written at the end of the sampling if set to None while *resume*
+                           is True, and not at all if both are not set.
+        :type checkpoint: int
+        :param resume: Continue the sampling from the last walker positions that are stored in
+                       the checkpoint of *chain_out_tag*, until the chain contains *nsteps* steps.
+                       The sampling starts from the a priori position (*param*) if no checkpoint
+                       exists.
+        :type resume: bool
+        :param tau_step: Number of steps after which the integrated autocorrelation time (tau) of
+                         the walker-averaged chain is estimated. The sampling stops when the chain
+                         is longer than *tau_factor* times tau and tau has changed by less than a
+                         fraction *tau_tolerance* since the previous estimate, for all parameters.
+                         In that case, *nsteps* is the maximum number of steps. The history of
+                         tau is stored as the non-static attributes TAU_STEP and TAU of
+                         *chain_out_tag*. A fixed number of *nsteps* steps is run if set to None.
+        :type tau_step: int
+        :param tau_factor: Minimum length of the chain in units of the autocorrelation time.
+        :type tau_factor: float
+        :param tau_tolerance: Maximum fractional change of the autocorrelation time between two
+                              estimates.
+        :type tau_tolerance: float
+        :param roi_margin: Half width (arcsec) of an annulus around the separation of *param*. The
+                           PSF subtraction and derotation are only applied to the pixels within
+                           the annulus, which should therefore be wider than the aperture and the
+                           range of the separation in *bounds*. The full images are used if set
+                           to None.
+        :type roi_margin: float
         :param \**kwargs:
             See below.
 
@@ -957,6 +1592,23 @@ class MCMCsamplingModule(ProcessingModule):
             self.m_psf_in_port = self.add_input_port(psf_in_tag)
         self.m_chain_out_port = self.add_output_port(chain_out_tag)
 
+        if lnprob_out_tag is None:
+            self.m_lnprob_out_port = None
+        else:
+            self.m_lnprob_out_port = self.add_output_port(lnprob_out_tag)
+
+        if checkpoint is None and not resume:
+            self.m_checkpoint_port = None
+        else:
+            self.m_checkpoint_port = self.add_output_port(chain_out_tag+"_checkpoint")
+
+        self.m_checkpoint = checkpoint
+        self.m_resume = resume
+        self.m_tau_step = tau_step
+        self.m_tau_factor = tau_factor
+        self.m_tau_tolerance = tau_tolerance
+        self.m_roi_margin = roi_margin
+
         self.m_param = param
         self.m_bounds = bounds
         self.m_nwalkers = nwalkers
@@ -971,7 +1623,9 @@ class MCMCsamplingModule(ProcessingModule):
         """
         Run method of the module. Shifts the reference PSF to the location of the fake planet
         with an additional correction for the parallactic angle and writes the stack with images
-        with the injected planet signal.
+        with the injected planet signal. The log posterior is evaluated in parallel with the
+        number of processes set by the CPU attribute of the central configuration. In that case,
+        the images are stored once in shared memory.
 
         :return: None
         """
@@ -1001,7 +1655,7 @@ class MCMCsamplingModule(ProcessingModule):
         self.m_mask /= pixscale
 
         images = self.m_image_in_port.get_all()
-        psf = self.m_psf_in_port.get_all()
+        psf = _psf_stamp(self.m_psf_in_port.get_all(), images.shape[0], pixscale)
 
         mask = np.ones((images.shape[1], images.shape[2]))
         npix = images.shape[1]
@@ -1023,43 +1677,172 @@ class MCMCsamplingModule(ProcessingModule):
 
         circ_ap = CircularAperture((x_pos, y_pos), self.m_aperture)
 
-        initial = np.zeros((self.m_nwalkers, ndim))
-
-        initial[:, 0] = self.m_param[0] + np.random.normal(0, self.m_sigma[0], self.m_nwalkers)
-        initial[:, 1] = self.m_param[1] + np.random.normal(0, self.m_sigma[1], self.m_nwalkers)
-        initial[:, 2] = self.m_param[2] + np.random.normal(0, self.m_sigma[2], self.m_nwalkers)
-
-        sampler = emcee.EnsembleSampler(nwalkers=self.m_nwalkers,
-                                        dim=ndim,
-                                        lnpostfn=_lnprob,
-                                        a=self.m_scale,
-                                        args=([self.m_bounds,
-                                               images,
-                                               psf,
-                                               mask,
-                                               parang,
-                                               self.m_psf_scaling,
-                                               pixscale,
-                                               self.m_pca_number,
-                                               self.m_extra_rot,
-                                               circ_ap]),
-                                        threads=cpu)
-
-        for i, _ in enumerate(sampler.sample(p0=initial, iterations=self.m_nsteps)):
-            progress(i, self.m_nsteps, "Running MCMCsamplingModule...")
+        if self.m_roi_margin is None:
+            annulus = None
+        else:
+            annulus = annulus_mask(images.shape[1:],
+                                   (self.m_param[0]-self.m_roi_margin)/pixscale,
+                                   (self.m_param[0]+self.m_roi_margin)/pixscale)
+
+        if self.m_resume:
+            previous = self.add_input_port(self.m_checkpoint_port.tag).get_all()
+        else:
+            previous = None
+
+        if previous is None:
+            if self.m_resume:
+                warnings.warn("No checkpoint found in %s. Starting the sampling from the a "
+                              "priori position." % self.m_checkpoint_port.tag)
+
+            if self.m_checkpoint_port is not None:
+                self.m_checkpoint_port.del_all_data()
+                self.m_checkpoint_port.del_all_attributes()
+
+            initial = np.zeros((self.m_nwalkers, ndim))
+
+            initial[:, 0] = self.m_param[0] + np.random.normal(0, self.m_sigma[0], self.m_nwalkers)
+            initial[:, 1] = self.m_param[1] + np.random.normal(0, self.m_sigma[1], self.m_nwalkers)
+            initial[:, 2] = self.m_param[2] + np.random.normal(0, self.m_sigma[2], self.m_nwalkers)
+
+            lnprob0 = None
+            nsteps = self.m_nsteps
+
+        else:
+            if previous.shape[1] != self.m_nwalkers:
+                raise ValueError("The number of walkers in the checkpoint (%s) is different from "
+                                 "nwalkers (%s)." % (previous.shape[1], self.m_nwalkers))
+
+            initial = previous[-1, :, :ndim]
+            lnprob0 = previous[-1, :, ndim]
+            nsteps = max(self.m_nsteps-previous.shape[0], 0)
+
+        args = (self.m_bounds,
+                images,
+                psf,
+                mask,
+                parang,
+                self.m_psf_scaling,
+                pixscale,
+                self.m_pca_number,
+                self.m_extra_rot,
+                circ_ap,
+                annulus)
+
+        # multiprocessing crashed on Mac in combination with numpy
+        if sys.platform == "darwin" or cpu == 1:
+            pool = None
+
+            sampler = emcee.EnsembleSampler(nwalkers=self.m_nwalkers,
+                                            dim=ndim,
+                                            lnpostfn=_lnprob,
+                                            a=self.m_scale,
+                                            args=args)
+
+        else:
+            # the images are copied once to shared memory and the other arguments are sent once
+            # to each worker such that only the parameters of the walkers are pickled
+            shared_images = RawArray(ctypes.c_double, images.size)
+            np.frombuffer(shared_images, dtype=np.float64)[:] = images.ravel()
+
+            pool = InterruptiblePool(processes=cpu,
+                                     initializer=_init_lnprob,
+                                     initargs=(shared_images,
+                                               images.shape,
+                                               (args[0], None) + args[2:]))
+
+            sampler = emcee.EnsembleSampler(nwalkers=self.m_nwalkers,
+                                            dim=ndim,
+                                            lnpostfn=_lnprob_shared,
+                                            a=self.m_scale,
+                                            pool=pool)
+
+        steps = []
+
+        tau_step = []
+        tau_list = []
+
+        nsteps_done = 0
+
+        try:
+            for i, item in enumerate(sampler.sample(p0=initial,
+                                                    lnprob0=lnprob0,
+                                                    iterations=nsteps)):
+
+                progress(i, nsteps, "Running MCMCsamplingModule...")
+
+                nsteps_done = i+1
+
+                if self.m_checkpoint_port is not None:
+                    steps.append(np.column_stack((item[0], item[1])))
+
+                    if self.m_checkpoint is not None and len(steps) == self.m_checkpoint:
+                        self._write_checkpoint(steps)
+                        steps = []
+
+                if self.m_tau_step is not None and nsteps_done%self.m_tau_step == 0:
+                    chain = sampler.chain[:, :nsteps_done, :]
+
+                    if previous is not None:
+                        chain = np.concatenate((np.transpose(previous[:, :, :ndim], (1, 0, 2)),
+                                                chain), axis=1)
+
+                    tau = _autocorr_time(chain)
+
+                    tau_step.append(chain.shape[1])
+                    tau_list.append(tau)
+
+                    if len(tau_list) > 1 and \
+                       np.all(self.m_tau_factor*tau < chain.shape[1]) and \
+                       np.all(np.abs(tau_list[-2]-tau) < self.m_tau_tolerance*tau):
+                        break
+
+            if steps:
+                self._write_checkpoint(steps)
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         sys.stdout.write("Running MCMCsamplingModule... [DONE]\n")
         sys.stdout.flush()
 
-        self.m_chain_out_port.set_all(sampler.chain)
+        # the arrays of the sampler are preallocated for nsteps
+        chain = sampler.chain[:, :nsteps_done, :]
+        lnprob = sampler.lnprobability[:, :nsteps_done]
+
+        if previous is not None:
+            chain = np.concatenate((np.transpose(previous[:, :, :ndim], (1, 0, 2)), chain), axis=1)
+            lnprob = np.concatenate((np.transpose(previous[:, :, ndim]), lnprob), axis=1)
+
+        self.m_chain_out_port.set_all(chain)
         self.m_chain_out_port.add_history_information("Flux and position", "MCMC sampling")
         self.m_chain_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+
+        if tau_list:
+            self.m_chain_out_port.add_attribute("TAU_STEP", np.asarray(tau_step), static=False)
+            self.m_chain_out_port.add_attribute("TAU", np.asarray(tau_list), static=False)
+
+        if self.m_lnprob_out_port is not None:
+            self.m_lnprob_out_port.set_all(lnprob)
+            self.m_lnprob_out_port.add_history_information("Flux and position", "MCMC sampling")
+            self.m_lnprob_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+
         self.m_chain_out_port.close_port()
 
+        if nsteps_done == 0:
+            return
+
+        if nsteps_done < nsteps:
+            print "Stopped after %s steps with an autocorrelation time of %s." \
+                  % (chain.shape[1], tau_list[-1])
+
         print "Mean acceptance fraction: {0:.3f}".format(np.mean(sampler.acceptance_fraction))
 
+        flatchain = sampler.chain[:, :nsteps_done, :].reshape(-1, ndim)
+
         try:
-            autocorr = emcee.autocorr.integrated_time(sampler.flatchain,
+            autocorr = emcee.autocorr.integrated_time(flatchain,
                                                       low=10,
                                                       high=None,
                                                       step=1,
@@ -1073,6 +1856,21 @@ class MCMCsamplingModule(ProcessingModule):
         except emcee.autocorr.AutocorrError:
             print "The chain is too short to reliably estimate the autocorrelation time. [WARNING]"
 
+    def _write_checkpoint(self,
+                          steps):
+        """
+        Internal function which appends the walker positions and log posterior probabilities of
+        a number of steps to the checkpoint and writes them to the hard drive.
+
+        :param steps: List with one array per step with the shape (nwalkers, 4).
+        :type steps: list
+
+        :return: None
+        """
+
+        self.m_checkpoint_port.append(np.asarray(steps), data_dim=3)
+        self.m_checkpoint_port.flush()
+
 
 class AperturePhotometryModule(ProcessingModule):
     """
@@ -1091,8 +1889,10 @@ class AperturePhotometryModule(ProcessingModule):
         :param radius: Radius (arcsec) of the circular aperture.
         :type radius: int
         :param position: Center position (pix) of the aperture, (x, y). The center of the image
-                         will be used if set to None.
-        :type position: tuple, float
+                         will be used if set to None. The position of the star in each image is
+                         used if set to "STAR_POSITION", in which case the non-static attribute
+                         STAR_POSITION (y, x) is required.
+        :type position: tuple, float, str
         :param name_in: Unique name of the module instance.
         :type name_in: str
         :param image_in_tag: Tag of the database entry that is read as input.
@@ -1115,34 +1915,72 @@ class AperturePhotometryModule(ProcessingModule):
     def run(self):
         """
         Run method of the module. Calculates the counts for each frames and saves the values
-        in the database.
+        in the database. The exact overlap weights of the aperture are calculated once for each
+        subpixel offset and the photometry of all images that are loaded in memory is calculated
+        with a single tensor product.
 
         :return: None
         """
 
-        def photometry(image, aperture):
-            photo = aperture_photometry(image, aperture, method='exact')
-            return photo['aperture_sum']
-
         self.m_phot_out_port.del_all_data()
         self.m_phot_out_port.del_all_attributes()
 
+        memory = self._m_config_port.get_attribute("MEMORY")
         pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
         self.m_radius /= pixscale
 
-        size = self.m_image_in_port.get_shape()[1]
+        shape = self.m_image_in_port.get_shape()
+
+        if len(shape) == 2:
+            nimages = 1
+        elif len(shape) == 3:
+            nimages = shape[0]
+
+        size = shape[-1]
 
         if self.m_position is None:
             self.m_position = (size/2., size/2.)
 
-        # Position in CircularAperture is defined as (x, y)
-        aperture = CircularAperture(self.m_position, self.m_radius)
+        if isinstance(self.m_position, str):
+            # positions are stored as (y, x) and converted to pixel centers as (x, y)
+            star = np.asarray(self.m_image_in_port.get_attribute(self.m_position), dtype=np.float64)
+            star = star.reshape(-1, 2)
+
+            if star.shape[0] != nimages:
+                raise ValueError("The number of positions in %s should be equal to the number "
+                                 "of images." % self.m_position)
+
+            pos_x = star[:, 1]
+            pos_y = star[:, 0]
+
+        else:
+            pos_x = np.full(nimages, self.m_position[0], dtype=np.float64)
+            pos_y = np.full(nimages, self.m_position[1], dtype=np.float64)
 
-        self.apply_function_to_images(photometry,
-                                      self.m_image_in_port,
-                                      self.m_phot_out_port,
-                                      "Running AperturePhotometryModule...",
-                                      func_args=(aperture,))
+        fixed = np.all(pos_x == pos_x[0]) and np.all(pos_y == pos_y[0])
+
+        frames = memory_frames(memory, nimages)
+
+        for i, _ in enumerate(frames[:-1]):
+            progress(i, len(frames[:-1]), "Running AperturePhotometryModule...")
+
+            if len(shape) == 2:
+                images = self.m_image_in_port.get_all()[np.newaxis, ]
+            else:
+                images = self.m_image_in_port[frames[i]:frames[i+1], ]
+
+            if fixed:
+                phot = aperture_sum_stack(images, pos_x[0], pos_y[0], self.m_radius)
+            else:
+                phot = aperture_sum_stack(images,
+                                          pos_x[frames[i]:frames[i+1]],
+                                          pos_y[frames[i]:frames[i+1]],
+                                          self.m_radius)
+
+            self.m_phot_out_port.append(phot[:, np.newaxis], data_dim=2)
+
+        sys.stdout.write("Running AperturePhotometryModule... [DONE]\n")
+        sys.stdout.flush()
 
         self.m_phot_out_port.copy_attributes_from_input_port(self.m_image_in_port)
         self.m_phot_out_port.add_history_information("Aperture photometry",
@@ -2,13 +2,14 @@
 Modules with simple pre-processing tools.
 """
 
+import sys
 import warnings
 
 import numpy as np
 
-from skimage.transform import rescale
-
 from PynPoint.Core.Processing import ProcessingModule
+from PynPoint.Util.ImageTools import scale_image
+from PynPoint.Util.ModuleTools import memory_frames, progress
 
 
 class CropImagesModule(ProcessingModule):
@@ -52,10 +53,14 @@ class CropImagesModule(ProcessingModule):
     def run(self):
         """
         Run method of the module. Reduces the image size by cropping around an given position.
+        Only the cropped section of each MEMORY block is read from the database.
 
         :return: None
         """
 
+        if self.m_image_in_port.tag == self.m_image_out_port.tag:
+            raise ValueError("Input and output ports should have a different tag.")
+
         self.m_image_out_port.del_all_attributes()
         self.m_image_out_port.del_all_data()
 
@@ -63,39 +68,35 @@ class CropImagesModule(ProcessingModule):
 
         self.m_size = int(self.m_size/pixscale)
 
-        def _image_cutting(image_in,
-                           size,
-                           center):
-
-            if center is None:
-                x_off = (image_in.shape[1] - size) / 4
-                y_off = (image_in.shape[0] - size) / 4
+        npix_y, npix_x = self.m_image_in_port.get_shape()[-2:]
 
-                if size > image_in.shape[0] or size > image_in.shape[1]:
-                    raise ValueError("Input frame resolution smaller than target image resolution.")
+        if self.m_center is None:
+            x_off = (npix_x - self.m_size) / 4
+            y_off = (npix_y - self.m_size) / 4
 
-                image_out = image_in[y_off:y_off+size, x_off:x_off+size]
+            if self.m_size > npix_y or self.m_size > npix_x:
+                raise ValueError("Input frame resolution smaller than target image resolution.")
 
-            else:
-                x_in = int(center[0] - size/2)
-                y_in = int(center[1] - size/2)
+            section = (y_off, y_off+self.m_size, x_off, x_off+self.m_size)
 
-                x_out = int(center[0] + size/2)
-                y_out = int(center[1] + size/2)
+        else:
+            x_in = int(self.m_center[0] - self.m_size/2)
+            y_in = int(self.m_center[1] - self.m_size/2)
 
-                if x_in < 0 or y_in < 0 or x_out > image_in.shape[1] or y_out > image_in.shape[0]:
-                    raise ValueError("Target image resolution does not fit inside the input frame "
-                                     "resolution.")
+            x_out = int(self.m_center[0] + self.m_size/2)
+            y_out = int(self.m_center[1] + self.m_size/2)
 
-                image_out = image_in[y_in:y_out, x_in:x_out]
+            if x_in < 0 or y_in < 0 or x_out > npix_x or y_out > npix_y:
+                raise ValueError("Target image resolution does not fit inside the input frame "
+                                 "resolution.")
 
-            return image_out
+            section = (y_in, y_out, x_in, x_out)
 
-        self.apply_function_to_images(_image_cutting,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running CropImagesModule...",
-                                      func_args=(self.m_size, self.m_center))
+        _read_section(self._m_config_port.get_attribute("MEMORY"),
+                      self.m_image_in_port,
+                      self.m_image_out_port,
+                      section,
+                      "Running CropImagesModule...")
 
         self.m_image_out_port.add_history_information("Image cropped", str(self.m_size))
         self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
@@ -148,7 +149,7 @@ class ScaleImagesModule(ProcessingModule):
     def run(self):
         """
         Run method of the module. Rescales an image with a fifth order spline interpolation and a
-        reflecting boundary condition.
+        reflecting boundary condition (see PynPoint.Util.ImageTools.scale_image).
 
         :return: None
         """
@@ -161,10 +162,7 @@ class ScaleImagesModule(ProcessingModule):
 
             sum_before = np.sum(image_in)
 
-            tmp_image = rescale(image=np.asarray(image_in, dtype=np.float64),
-                                scale=(scaling_size, scaling_size),
-                                order=5,
-                                mode="reflect")
+            tmp_image = scale_image(image_in, scaling_size)
 
             sum_after = np.sum(tmp_image)
 
@@ -300,22 +298,73 @@ class RemoveLinesModule(ProcessingModule):
 
     def run(self):
         """
-        Run method of the module. Removes the lines given by *lines* from each frame.
+        Run method of the module. Removes the lines given by *lines* from each frame. Only the
+        remaining section of each MEMORY block is read from the database.
 
         :return: None
         """
 
-        def _remove_lines(image_in):
-            shape_in = image_in.shape
+        if self.m_image_in_port.tag == self.m_image_out_port.tag:
+            raise ValueError("Input and output ports should have a different tag.")
+
+        self.m_image_out_port.del_all_attributes()
+        self.m_image_out_port.del_all_data()
 
-            return image_in[int(self.m_lines[2]):shape_in[0]-int(self.m_lines[3]),
-                            int(self.m_lines[0]):shape_in[1]-int(self.m_lines[1])]
+        npix_y, npix_x = self.m_image_in_port.get_shape()[-2:]
 
-        self.apply_function_to_images(_remove_lines,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running RemoveLinesModule...")
+        section = (int(self.m_lines[2]), npix_y-int(self.m_lines[3]),
+                   int(self.m_lines[0]), npix_x-int(self.m_lines[1]))
+
+        _read_section(self._m_config_port.get_attribute("MEMORY"),
+                      self.m_image_in_port,
+                      self.m_image_out_port,
+                      section,
+                      "Running RemoveLinesModule...")
 
         self.m_image_out_port.add_history_information("Lines removed", str(self.m_lines))
         self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
         self.m_image_out_port.close_port()
+
+
+def _read_section(memory,
+                  image_in_port,
+                  image_out_port,
+                  section,
+                  message):
+    """
+    Internal function which reads a section of the images for each MEMORY block, such that only
+    the requested hyperslab is read from the database, and appends it to the output port.
+
+    :param memory: Number of images that is simultaneously loaded into the memory.
+    :type memory: int
+    :param image_in_port: Input port with the images.
+    :type image_in_port: PynPoint.Core.DataIO.InputPort
+    :param image_out_port: Output port for the sections.
+    :type image_out_port: PynPoint.Core.DataIO.OutputPort
+    :param section: Pixel range (y_start, y_end, x_start, x_end) of the section.
+    :type section: tuple, int
+    :param message: Progress message.
+    :type message: str
+
+    :return: None
+    """
+
+    y_start, y_end, x_start, x_end = section
+
+    if image_in_port.get_ndim() == 2:
+        progress(0, 1, message)
+
+        image_out_port.append(image_in_port[y_start:y_end, x_start:x_end][np.newaxis, ])
+
+    else:
+        frames = memory_frames(memory, image_in_port.get_shape()[0])
+
+        for i, _ in enumerate(frames[:-1]):
+            progress(i, len(frames[:-1]), message)
+
+            image_out_port.append(image_in_port[frames[i]:frames[i+1],
+                                                y_start:y_end,
+                                                x_start:x_end], data_dim=3)
+
+    sys.stdout.write(message+" [DONE]\n")
+    sys.stdout.flush()
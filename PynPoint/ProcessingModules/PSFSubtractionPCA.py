@@ -11,6 +11,7 @@ import numpy as np
 from sklearn.decomposition import PCA
 from scipy import linalg, ndimage, sparse
 
+from PynPoint.Util.ImageTools import annulus_mask, rotate_pixels, rotation_mask
 from PynPoint.Util.ModuleTools import progress
 from PynPoint.Util.MultiprocessingPCA import PcaMultiprocessingCapsule
 from PynPoint.Core.Processing import ProcessingModule
@@ -647,6 +648,15 @@ class PcaPsfSubtractionModule(ProcessingModule):
         :Keyword arguments:
              * **basis_out_tag** (*str*) -- Tag of the database entry with the basis set.
              * **verbose** (*bool*) -- Print progress to the standard output.
+             * **annulus** (*tuple*) -- Inner and outer radius (arcsec) of an annulus. The basis
+                                       is fitted and the PSF model is subtracted only for the
+                                       pixels within the annulus, padded by three pixels such
+                                       that the interpolation at the edge of the annulus uses
+                                       residuals instead of zeros. Only the pixels within the
+                                       annulus are derotated and the residuals are zero outside
+                                       the annulus.
+                                       Multiprocessing is not used in that case. The full images
+                                       are used if not specified.
 
         :return: None
         """
@@ -663,6 +673,14 @@ class PcaPsfSubtractionModule(ProcessingModule):
         else:
             self.m_basis_out_port = None
 
+        if "annulus" in kwargs:
+            self.m_annulus = kwargs["annulus"]
+        else:
+            self.m_annulus = None
+
+        self.m_mask = None
+        self.m_mask_fit = None
+
         # look for the maximum number of components
         self.m_max_pacs = np.max(pca_numbers)
         self.m_components = np.sort(np.atleast_1d(pca_numbers))
@@ -754,20 +772,36 @@ class PcaPsfSubtractionModule(ProcessingModule):
                                                           star_data.shape[0])))).T
 
             tmp_psf_images = self.m_pca.inverse_transform(tmp_pca_representation)
-            tmp_psf_images = tmp_psf_images.reshape((star_data.shape[0],
-                                                     star_data.shape[1],
-                                                     star_data.shape[2]))
-
-            # subtract the psf model of the star
-            tmp_without_psf = star_data - tmp_psf_images
 
-            # inverse rotation
             delta_para = -1.*self.m_star_in_port.get_attribute("PARANG")
-            res_array = np.zeros(shape=tmp_without_psf.shape)
-            for j, angle in enumerate(delta_para):
-                res_temp = tmp_without_psf[j, ]
-                # ndimage.rotate rotates in clockwise direction for positive angles
-                res_array[j, ] = ndimage.rotate(res_temp, angle+self.m_extra_rot, reshape=False)
+
+            if self.m_mask is None:
+                tmp_psf_images = tmp_psf_images.reshape((star_data.shape[0],
+                                                         star_data.shape[1],
+                                                         star_data.shape[2]))
+
+                # subtract the psf model of the star
+                tmp_without_psf = star_data - tmp_psf_images
+
+                # inverse rotation
+                res_array = np.zeros(shape=tmp_without_psf.shape)
+                for j, angle in enumerate(delta_para):
+                    res_temp = tmp_without_psf[j, ]
+                    # ndimage.rotate rotates in clockwise direction for positive angles
+                    res_array[j, ] = ndimage.rotate(res_temp, angle+self.m_extra_rot, reshape=False)
+
+            else:
+                # subtract the psf model of the star within the annulus
+                tmp_without_psf = star_sklearn - tmp_psf_images
+
+                # inverse rotation of the annulus
+                res_array = np.zeros(shape=star_data.shape)
+                res_temp = np.zeros(shape=star_data.shape[1:])
+                for j, angle in enumerate(delta_para):
+                    res_temp[self.m_mask_fit] = tmp_without_psf[j, ]
+                    res_array[j, self.m_mask] = rotate_pixels(res_temp,
+                                                              angle+self.m_extra_rot,
+                                                              self.m_mask)
 
             # create residuals
             # 1.) The de-rotated result images
@@ -855,8 +889,21 @@ class PcaPsfSubtractionModule(ProcessingModule):
             stdout.write("Constructing PSF model...")
             stdout.flush()
 
-        ref_star_sklearn = star_data.reshape((ref_star_data.shape[0],
-                                              ref_star_data.shape[1] * ref_star_data.shape[2]))
+        if self.m_annulus is not None:
+            pixscale = self.m_star_in_port.get_attribute("PIXSCALE")
+
+            self.m_mask = annulus_mask(star_data.shape[1:],
+                                       self.m_annulus[0]/pixscale,
+                                       self.m_annulus[1]/pixscale)
+
+            self.m_mask_fit = rotation_mask(self.m_mask)
+
+            ref_star_sklearn = star_data[:, self.m_mask_fit]
+
+        else:
+            ref_star_sklearn = star_data.reshape((ref_star_data.shape[0],
+                                                  ref_star_data.shape[1] * ref_star_data.shape[2]))
+
         self.m_pca.fit(ref_star_sklearn)
 
         if self.m_verbose:
@@ -864,18 +911,28 @@ class PcaPsfSubtractionModule(ProcessingModule):
             stdout.flush()
 
         if self.m_basis_out_port is not None:
-            basis = self.m_pca.components_.reshape((self.m_pca.components_.shape[0],
-                                                    star_data.shape[1], star_data.shape[2]))
+            if self.m_mask is None:
+                basis = self.m_pca.components_.reshape((self.m_pca.components_.shape[0],
+                                                        star_data.shape[1], star_data.shape[2]))
+            else:
+                basis = np.zeros((self.m_pca.components_.shape[0],
+                                  star_data.shape[1], star_data.shape[2]))
+                basis[:, self.m_mask_fit] = self.m_pca.components_
+
             self.m_basis_out_port.set_all(basis)
 
         # prepare the data for sklearns PCA
-        star_sklearn = star_data.reshape((star_data.shape[0],
-                                          star_data.shape[1] * star_data.shape[2]))
+        if self.m_mask is None:
+            star_sklearn = star_data.reshape((star_data.shape[0],
+                                              star_data.shape[1] * star_data.shape[2]))
+        else:
+            star_sklearn = star_data[:, self.m_mask_fit]
 
         cpu = self._m_config_port.get_attribute("CPU")
 
         # multiprocessing crashed on Mac in combination with numpy
-        if platform == "darwin" or self.m_res_arr_out_ports is not None or cpu == 1:
+        if platform == "darwin" or self.m_res_arr_out_ports is not None or cpu == 1 or \
+                self.m_mask is not None:
             self._run_single_processing(star_sklearn, star_data)
 
         else:
@@ -13,8 +13,8 @@ import numpy as np
 from scipy import ndimage
 
 from PynPoint.Core.Processing import ProcessingModule
-from PynPoint.ProcessingModules.ImageResizing import RemoveLinesModule, ScaleImagesModule
 from PynPoint.Util.ModuleTools import progress, memory_frames
+from PynPoint.Util.ImageTools import scale_image
 
 
 class PSFpreparationModule(ProcessingModule):
@@ -623,7 +623,8 @@ class SDIpreparationModule(ProcessingModule):
         """
         Run method of the module. Normalizes the images for the different filter widths,
         upscales the images, and crops the images to the initial image shape in order to
-        align the PSF patterns.
+        align the PSF patterns. The images are upscaled and normalized in the same way as with
+        ScaleImagesModule and cropped in memory instead of through the database.
 
         :return: None
         """
@@ -634,41 +635,40 @@ class SDIpreparationModule(ProcessingModule):
         wvl_factor = self.m_line_wvl/self.m_cnt_wvl
         width_factor = self.m_line_width/self.m_cnt_width
 
-        sys.stdout.write("Running SDIpreparationModule...\n")
-        sys.stdout.flush()
-
-        scaling = ScaleImagesModule(scaling=(wvl_factor, width_factor),
-                                    name_in="scaling",
-                                    image_in_tag=self.m_image_in_port.tag,
-                                    image_out_tag="sdi_scaled")
-
-        scaling.connect_database(self._m_data_base)
-        scaling.run()
+        pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
 
-        sdi_port = self.add_input_port("sdi_scaled")
+        im_shape = self.m_image_in_port.get_shape()[-2:]
 
-        npix_del = sdi_port.get_shape()[1] - self.m_image_in_port.get_shape()[1]
+        npix_del = int(round(wvl_factor*im_shape[0])) - im_shape[0]
 
         if npix_del%2 == 0:
-            npix_del_a = npix_del/2
-            npix_del_b = npix_del/2
+            npix_del_a = npix_del//2
 
         else:
             warnings.warn("An unequal number of pixels is removed from both sides of the images. "
                           "Recentering of the images is therefore required.")
 
-            npix_del_a = (npix_del-1)/2
-            npix_del_b = (npix_del+1)/2
+            npix_del_a = (npix_del-1)//2
 
-        crop = RemoveLinesModule(lines=(npix_del_a, npix_del_b, npix_del_a, npix_del_b),
-                                 name_in="crop",
-                                 image_in_tag="sdi_scaled",
-                                 image_out_tag=self.m_image_out_port.tag)
+        def _image_scaling(image_in):
+            sum_before = np.sum(image_in)
 
-        crop.connect_database(self._m_data_base)
-        crop.run()
+            im_scale = scale_image(image_in, wvl_factor)
 
-        sys.stdout.write("Running SDIpreparationModule... [DONE]\n")
-        sys.stdout.flush()
+            sum_after = np.sum(im_scale)
 
+            im_scale = im_scale[npix_del_a:npix_del_a+im_shape[0],
+                                npix_del_a:npix_del_a+im_shape[1]]
+
+            return im_scale * (sum_before / sum_after) * width_factor
+
+        self.apply_function_to_images(_image_scaling,
+                                      self.m_image_in_port,
+                                      self.m_image_out_port,
+                                      "Running SDIpreparationModule...")
+
+        history = "(line, continuum) = ("+str(self.m_line_wvl)+", "+str(self.m_cnt_wvl)+")"
+        self.m_image_out_port.add_history_information("SDI preparation", history)
+        self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
+        self.m_image_out_port.add_attribute("PIXSCALE", pixscale/wvl_factor)
         self.m_image_in_port.close_port()
@@ -2,20 +2,23 @@
 Modules for locating, aligning, and centering of the star.
 """
 
+import sys
 import math
 
 import warnings
+from multiprocessing import Pool
+
 import numpy as np
 import cv2
 
-from skimage.feature import register_translation
-from skimage.transform import rescale
 from scipy.ndimage import fourier_shift
 from scipy.ndimage import shift
+from scipy.ndimage.filters import correlate1d
 from scipy.optimize import curve_fit
 
 from PynPoint.Core.Processing import ProcessingModule
-from PynPoint.Util.ModuleTools import memory_frames
+from PynPoint.Util.ModuleTools import memory_frames, progress
+from PynPoint.Util.ImageTools import FourierRegistration, scale_image
 
 
 class StarExtractionModule(ProcessingModule):
@@ -71,6 +74,11 @@ class StarExtractionModule(ProcessingModule):
              * **position_out_tag** (*str*) -- Tag of the database entry to which the STAR_POSITION
                                                attributes are written. The *image_in_tag* is used
                                                if set to None.
+             * **tracking** (*float*) -- Size (arcsec) of the search window that is centered on
+                                         the position of the star in the previous image. Only
+                                         the first image is searched with *position* and only
+                                         the window is read from the database for the other
+                                         images. Not used if set to None.
 
         :return: None
         """
@@ -80,6 +88,11 @@ class StarExtractionModule(ProcessingModule):
         else:
             position_out_tag = None
 
+        if "tracking" in kwargs:
+            self.m_tracking = kwargs["tracking"]
+        else:
+            self.m_tracking = None
+
         super(StarExtractionModule, self).__init__(name_in)
 
         self.m_image_in_port = self.add_input_port(image_in_tag)
@@ -96,6 +109,8 @@ class StarExtractionModule(ProcessingModule):
 
         if position_out_tag is None:
             self.m_position_out_port = self.add_output_port(image_in_tag)
+        elif position_out_tag == image_out_tag:
+            self.m_position_out_port = self.m_image_out_port
         else:
             self.m_position_out_port = self.add_output_port(position_out_tag)
 
@@ -103,8 +118,6 @@ class StarExtractionModule(ProcessingModule):
         self.m_fwhm_star = fwhm_star
         self.m_position = position
 
-        self.m_count = 0
-
     def run(self):
         """
         Run method of the module. Locates the position of the star (only pixel precision) by
@@ -112,24 +125,44 @@ class StarExtractionModule(ProcessingModule):
         used to smooth away the contribution of bad pixels which may have higher values than the
         peak of the PSF. Images are cropped and written to an output port. The position of the
         star is attached to the input images as the non-static attribute STAR_POSITION (y, x).
+        The images of each MEMORY block are smoothed and searched at once, unless the search
+        region changes from image to image (i.e., with a 2D *position* or with *tracking*), in
+        which case the images are searched one by one. Only the search region, including a margin
+        for the cropped images, is read from the database.
 
         :return: None
         """
 
+        if self.m_image_out_port is not None and self.m_image_size is not None:
+            self.m_image_out_port.del_all_data()
+            self.m_image_out_port.del_all_attributes()
+
+        memory = self._m_config_port.get_attribute("MEMORY")
         pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
 
+        ndim = self.m_image_in_port.get_ndim()
+        npix_y, npix_x = self.m_image_in_port.get_shape()[-2:]
+
+        if ndim == 2:
+            nimages = 1
+        elif ndim == 3:
+            nimages = self.m_image_in_port.get_shape()[0]
+
         if self.m_position is not None:
             self.m_position = np.asarray(self.m_position)
 
-            if self.m_position.ndim == 2 and \
-                    self.m_position.shape[0] != self.m_image_in_port.get_shape()[0]:
+            if self.m_position.ndim == 2 and self.m_position.shape[0] != nimages:
                 raise ValueError("Either a single 'position' should be specified or an array "
                                  "equal in size to the number of images in 'image_in_tag'.")
 
-            if self.m_position[0] is None and self.m_position[1] is None:
-                npix = self.m_image_in_port.get_shape()[1]
-                self.m_position[0] = npix/2.
-                self.m_position[1] = npix/2.
+            if self.m_position.ndim == 1:
+                if self.m_position[0] is None and self.m_position[1] is None:
+                    self.m_position[0] = npix_x/2.
+                    self.m_position[1] = npix_y/2.
+
+                if self.m_position[2] is not None and \
+                        (self.m_position[0] > npix_x or self.m_position[1] > npix_y):
+                    raise ValueError('The specified position is outside the image.')
 
         if self.m_image_size is not None:
             psf_radius = int((self.m_image_size/2.)/pixscale)
@@ -137,84 +170,160 @@ class StarExtractionModule(ProcessingModule):
         self.m_fwhm_star /= pixscale
         self.m_fwhm_star = int(self.m_fwhm_star)
 
-        star = []
-        index = []
+        sigma = self.m_fwhm_star/math.sqrt(8.*math.log(2.))
+        kernel = cv2.getGaussianKernel(self.m_fwhm_star*2+1, sigma)[:, 0]
 
-        def _crop_image(image):
-            sigma = self.m_fwhm_star/math.sqrt(8.*math.log(2.))
-            kernel = (self.m_fwhm_star*2 + 1, self.m_fwhm_star*2 + 1)
+        if self.m_tracking is not None:
+            window = int((self.m_tracking/2.)/pixscale)
 
+        def _search_region(index):
             if self.m_position is None:
-                subimage = image
+                return (0, npix_y, 0, npix_x), (0., 0.)
+
+            if self.m_position.ndim == 1:
+                pos_x, pos_y, width = self.m_position
 
-            elif self.m_position[2] is None:
-                pos_x = self.m_position[0]
-                pos_y = self.m_position[1]
-                subimage = image
-                width = np.shape(image)[0]
+            elif self.m_position.ndim == 2:
+                pos_x, pos_y, width = self.m_position[index, ]
+
+            if width is None:
+                return (0, npix_y, 0, npix_x), (pos_y-npix_y/2., pos_x-npix_y/2.)
+
+            width /= pixscale
+
+            if pos_y <= width/2. or pos_x <= width/2. \
+                    or pos_y+width/2. >= npix_y or pos_x+width/2. >= npix_x:
+                warnings.warn("The region for the star extraction exceeds the image.")
+
+            region = (max(int(pos_y-width/2.), 0), int(pos_y+width/2.),
+                      max(int(pos_x-width/2.), 0), int(pos_x+width/2.))
+
+            return region, (float(region[0]), float(region[2]))
+
+        def _read_region(index, region):
+            if ndim == 2:
+                return self.m_image_in_port[region[0]:region[1], region[2]:region[3]]
+
+            return self.m_image_in_port[index, region[0]:region[1], region[2]:region[3]]
+
+        def _track_star(index, previous):
+            # the smoothing kernel requires pixels around the search window
+            region = (max(previous[0]-window-self.m_fwhm_star, 0),
+                      min(previous[0]+window+self.m_fwhm_star+1, npix_y),
+                      max(previous[1]-window-self.m_fwhm_star, 0),
+                      min(previous[1]+window+self.m_fwhm_star+1, npix_x))
+
+            search = (max(previous[0]-window, 0)-region[0],
+                      min(previous[0]+window+1, npix_y)-region[0],
+                      max(previous[1]-window, 0)-region[2],
+                      min(previous[1]+window+1, npix_x)-region[2])
+
+            im_smooth = _smooth_images(_read_region(index, region)[np.newaxis, ], kernel)
+            im_smooth = im_smooth[:, search[0]:search[1], search[2]:search[3]]
+
+            return _argmax_images(im_smooth)[0, ] + \
+                np.array([region[0]+search[0], region[2]+search[2]])
+
+        star = np.zeros((nimages, 2), dtype=np.int64)
+        index = []
+
+        write_crop = self.m_image_size is not None and self.m_image_out_port is not None
+
+        if self.m_position is None or self.m_position.ndim == 1:
+            block_region, block_offset = _search_region(0)
+
+            # the crops around a position in the search region are part of the section
+            if write_crop:
+                section = (max(block_region[0]-psf_radius, 0),
+                           min(block_region[1]+psf_radius, npix_y),
+                           max(block_region[2]-psf_radius, 0),
+                           min(block_region[3]+psf_radius, npix_x))
 
             else:
-                if self.m_position.ndim == 1:
-                    pos_x = self.m_position[0]
-                    pos_y = self.m_position[1]
-                    width = self.m_position[2]/pixscale
+                section = block_region
 
-                    if pos_x > self.m_image_in_port.get_shape()[1] or \
-                            pos_y > self.m_image_in_port.get_shape()[2]:
-                        raise ValueError('The specified position is outside the image.')
+        frames = memory_frames(memory, nimages)
 
-                elif self.m_position.ndim == 2:
-                    pos_x = self.m_position[self.m_count, 0]
-                    pos_y = self.m_position[self.m_count, 1]
-                    width = self.m_position[self.m_count, 2]/pixscale
+        for i, _ in enumerate(frames[:-1]):
+            progress(i, len(frames[:-1]), "Running StarExtractionModule...")
 
-                if pos_y <= width/2. or pos_x <= width/2. \
-                        or pos_y+width/2. >= self.m_image_in_port.get_shape()[2]\
-                        or pos_x+width/2. >= self.m_image_in_port.get_shape()[1]:
-                    warnings.warn("The region for the star extraction exceeds the image.")
+            frame_start = frames[i]
+            frame_end = frames[i+1]
 
-                subimage = image[int(pos_y-width/2.):int(pos_y+width/2.),
-                                 int(pos_x-width/2.):int(pos_x+width/2.)]
+            if self.m_tracking is None and \
+                    (self.m_position is None or self.m_position.ndim == 1):
 
-            im_smooth = cv2.GaussianBlur(subimage, kernel, sigma)
+                if ndim == 2:
+                    images = _read_region(0, section)[np.newaxis, ]
+                elif ndim == 3:
+                    images = self.m_image_in_port[frame_start:frame_end,
+                                                  section[0]:section[1],
+                                                  section[2]:section[3]]
 
-            # argmax[0] is the y position and argmax[1] is the x position
-            argmax = np.asarray(np.unravel_index(im_smooth.argmax(), im_smooth.shape))
+                subimages = images[:, block_region[0]-section[0]:block_region[1]-section[0],
+                                   block_region[2]-section[2]:block_region[3]-section[2]]
 
-            if self.m_position is not None:
-                argmax[0] += pos_y-width/2.
-                argmax[1] += pos_x-width/2.
+                argmax = _argmax_images(_smooth_images(subimages, kernel))
+
+                # truncation of the offset as for the assignment to an integer array
+                star[frame_start:frame_end, ] = (argmax + np.asarray(block_offset)).astype(np.int64)
+
+            else:
+                images = None
+
+                for j in range(frame_start, frame_end):
+                    if self.m_tracking is not None and j > 0:
+                        star[j, ] = _track_star(j, star[j-1, ])
+
+                    else:
+                        region, offset = _search_region(j)
+
+                        im_smooth = _smooth_images(_read_region(j, region)[np.newaxis, ], kernel)
+
+                        star[j, ] = (_argmax_images(im_smooth)[0, ] +
+                                     np.asarray(offset)).astype(np.int64)
 
             if self.m_image_size is not None:
-                if argmax[0] <= psf_radius or argmax[1] <= psf_radius \
-                        or argmax[0] + psf_radius >= image.shape[0] \
-                        or argmax[1] + psf_radius >= image.shape[1]:
+                im_crop = np.zeros((frame_end-frame_start, 2*psf_radius, 2*psf_radius))
 
-                    warnings.warn("PSF size is too large to crop the image around the brightest "
-                                  "pixel (image index = "+str(self.m_count)+", pixel [x, y] = "
-                                  +str([argmax[1]]+[argmax[0]])+"). Using the center of the image "
-                                  "instead.")
+                for j in range(frame_start, frame_end):
+                    if star[j, 0] <= psf_radius or star[j, 1] <= psf_radius \
+                            or star[j, 0] + psf_radius >= npix_y \
+                            or star[j, 1] + psf_radius >= npix_x:
 
-                    index.append(self.m_count)
+                        warnings.warn("PSF size is too large to crop the image around the "
+                                      "brightest pixel (image index = "+str(j)+", pixel [x, y] = "
+                                      +str([star[j, 1]]+[star[j, 0]])+"). Using the center of "
+                                      "the image instead.")
 
-                    argmax = [np.size(image, 0)/2., np.size(image, 0)/2.]
+                        index.append(j)
 
-                im_crop = image[int(argmax[0] - psf_radius):int(argmax[0] + psf_radius),
-                                int(argmax[1] - psf_radius):int(argmax[1] + psf_radius)]
+                        star[j, ] = [npix_y/2, npix_x/2]
 
-            star.append(argmax)
+                    if write_crop:
+                        crop = (star[j, 0]-psf_radius, star[j, 0]+psf_radius,
+                                star[j, 1]-psf_radius, star[j, 1]+psf_radius)
 
-            self.m_count += 1
+                        if images is not None and crop[0] >= section[0] and \
+                                crop[1] <= section[1] and crop[2] >= section[2] and \
+                                crop[3] <= section[3]:
 
-            if self.m_image_size is not None:
-                return im_crop
+                            im_crop[j-frame_start, ] = images[j-frame_start,
+                                                              crop[0]-section[0]:
+                                                              crop[1]-section[0],
+                                                              crop[2]-section[2]:
+                                                              crop[3]-section[2]]
 
-        self.apply_function_to_images(_crop_image,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running StarExtractionModule...")
+                        else:
+                            im_crop[j-frame_start, ] = _read_region(j, crop)
+
+                if write_crop:
+                    self.m_image_out_port.append(im_crop, data_dim=3)
 
-        self.m_position_out_port.add_attribute("STAR_POSITION", np.asarray(star), static=False)
+        sys.stdout.write("Running StarExtractionModule... [DONE]\n")
+        sys.stdout.flush()
+
+        self.m_position_out_port.add_attribute("STAR_POSITION", star, static=False)
 
         if self.m_index_out_port is not None:
             self.m_index_out_port.set_all(np.transpose(np.asarray(index)))
@@ -225,6 +334,10 @@ class StarExtractionModule(ProcessingModule):
             self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
             self.m_image_out_port.add_history_information("Star extract", "maximum")
 
+            # the copied attributes could contain STAR_POSITION from an earlier run
+            if self.m_position_out_port is self.m_image_out_port:
+                self.m_position_out_port.add_attribute("STAR_POSITION", star, static=False)
+
         self.m_position_out_port.close_port()
 
 
@@ -241,7 +354,8 @@ class StarAlignmentModule(ProcessingModule):
                  interpolation="spline",
                  accuracy=10,
                  resize=None,
-                 num_references=10):
+                 num_references=10,
+                 template=False):
         """
         Constructor of StarAlignmentModule.
 
@@ -256,7 +370,7 @@ class StarAlignmentModule(ProcessingModule):
                                  is taken as reference image(s)
         :type ref_image_in_tag: str
         :param image_out_tag: Tag of the database entry with the images that are written as
-                              output.
+                              output. Should be different from *image_in_tag*.
         :type image_out_tag: str
         :param interpolation: Type of interpolation that is used for shifting the images (spline,
                               bilinear, or fft).
@@ -268,6 +382,10 @@ class StarAlignmentModule(ProcessingModule):
         :type resize: float
         :param num_references: Number of reference images for the cross-correlation.
         :type num_references: int
+        :param template: Average the reference images into a single template for the
+                         cross-correlation, instead of averaging the offsets with respect to each
+                         reference image. This is approximately *num_references* times faster.
+        :type template: bool
 
         :return: None
         """
@@ -277,7 +395,9 @@ class StarAlignmentModule(ProcessingModule):
         self.m_image_in_port = self.add_input_port(image_in_tag)
         self.m_image_out_port = self.add_output_port(image_out_tag)
 
-        if ref_image_in_tag is not None:
+        if ref_image_in_tag == image_in_tag:
+            self.m_ref_image_in_port = self.m_image_in_port
+        elif ref_image_in_tag is not None:
             self.m_ref_image_in_port = self.add_input_port(ref_image_in_tag)
         else:
             self.m_ref_image_in_port = None
@@ -286,16 +406,24 @@ class StarAlignmentModule(ProcessingModule):
         self.m_accuracy = accuracy
         self.m_resize = resize
         self.m_num_references = num_references
+        self.m_template = template
 
     def run(self):
         """
         Run method of the module. Applies a cross-correlation of the input images with respect to
         a stack of reference images, rescales the image dimensions, and shifts the images to a
-        common center.
+        common center. The Fourier transforms of the reference images are calculated once and
+        the offsets of the images are calculated in batches of MEMORY images.
 
         :return: None
         """
 
+        if self.m_image_out_port.tag != self.m_image_in_port.tag:
+            self.m_image_out_port.del_all_data()
+            self.m_image_out_port.del_all_attributes()
+
+        memory = self._m_config_port.get_attribute("MEMORY")
+
         if self.m_ref_image_in_port is not None:
             im_dim = self.m_ref_image_in_port.get_ndim()
 
@@ -324,29 +452,29 @@ class StarAlignmentModule(ProcessingModule):
             sort = np.sort(random)
             ref_images = self.m_image_in_port[sort, :, :]
 
-        def _align_image(image_in):
-            offset = np.array([0., 0.])
-
-            for i in range(self.m_num_references):
-                tmp_offset, _, _ = register_translation(ref_images[i, :, :],
-                                                        image_in,
-                                                        upsample_factor=self.m_accuracy)
-                offset += tmp_offset
+        registration = FourierRegistration(ref_images,
+                                           upsample_factor=self.m_accuracy,
+                                           template=self.m_template)
 
-            offset /= float(self.m_num_references)
+        def _align_image(image_in, offset):
             if self.m_resize is not None:
                 offset *= self.m_resize
 
-            if self.m_resize is not None:
+                if self.m_interpolation == "spline":
+                    # Rescale and shift the input image with a single interpolation. The flux is
+                    # conserved with the ratio of the number of pixels of the rescaled and input
+                    # image, such that flux which is shifted out of the image does not change the
+                    # normalization.
+                    tmp_image = scale_image(image_in, self.m_resize, offset=offset)
+
+                    return tmp_image*(float(image_in.size)/float(tmp_image.size))
+
                 sum_before = np.sum(image_in)
-                tmp_image = rescale(image=np.asarray(image_in, dtype=np.float64),
-                                    scale=(self.m_resize, self.m_resize),
-                                    order=5,
-                                    mode="reflect")
-                sum_after = np.sum(tmp_image)
 
-                # Conserve flux because the rescale function normalizes all values to [0:1].
-                tmp_image = tmp_image*(sum_before/sum_after)
+                tmp_image = scale_image(image_in, self.m_resize)
+
+                # Conserve flux because the rescaling increases the number of pixels.
+                tmp_image = tmp_image*(sum_before/np.sum(tmp_image))
 
             else:
                 tmp_image = image_in
@@ -366,10 +494,37 @@ class StarAlignmentModule(ProcessingModule):
 
             return tmp_image
 
-        self.apply_function_to_images(_align_image,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running StarAlignmentModule...")
+        nimages = self.m_image_in_port.get_shape()[0]
+        frames = memory_frames(memory, nimages)
+
+        for i, _ in enumerate(frames[:-1]):
+            progress(i, len(frames[:-1]), "Running StarAlignmentModule...")
+
+            images = self.m_image_in_port[frames[i]:frames[i+1], ]
+
+            offsets = registration.shifts(images)
+
+            result = []
+            for j, item in enumerate(images):
+                result.append(_align_image(item, offsets[j, ]))
+
+            if self.m_image_out_port.tag == self.m_image_in_port.tag:
+                try:
+                    if np.size(frames) == 2:
+                        self.m_image_out_port.set_all(np.asarray(result), keep_attributes=True)
+                    else:
+                        self.m_image_out_port[frames[i]:frames[i+1]] = np.asarray(result)
+
+                except TypeError:
+                    raise ValueError("Input and output port have the same tag while "
+                                     "StarAlignmentModule is changing the image shape. This is "
+                                     "only possible with MEMORY=None.")
+
+            else:
+                self.m_image_out_port.append(np.asarray(result), data_dim=3)
+
+        sys.stdout.write("Running StarAlignmentModule... [DONE]\n")
+        sys.stdout.flush()
 
         self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
 
@@ -427,7 +582,17 @@ class StarCenteringModule(ProcessingModule):
         :type fit_out_tag: str
         :param method: Fit and shift all the images individually ("full") or only fit the mean of
                        the cube and shift all images to that location ("mean"). The "mean" method
-                       could be used after running the StarAlignmentModule.
+                       could be used after running the StarAlignmentModule. Two faster methods
+                       estimate the centers of all images of a MEMORY block at once, without an
+                       iterative fit. With "moments", the center, FWHM, and angle are calculated
+                       from the first and second intensity-weighted moments of the pixels within
+                       *radius*, with negative pixel values set to zero, and the amplitude is the
+                       maximum pixel value. With "xcorr", the mean of the cube is fitted with a 2D
+                       Gaussian and the images are cross-correlated with the mean image, with a
+                       parabolic interpolation of the peak of the cross-correlation. The offsets
+                       are added to the center of the mean image while the FWHM, amplitude, and
+                       angle are the values of the mean image. The errors are set to zero for
+                       both methods.
         :type method: str
         :param interpolation: Type of interpolation that is used for shifting the images (spline,
                               bilinear, or fft).
@@ -483,11 +648,18 @@ class StarCenteringModule(ProcessingModule):
         Run method of the module. Uses a non-linear least squares (Levenberg-Marquardt) to fit the
         the individual images or the mean of the stack with a 2D Gaussian profile, shifts the
         images with subpixel precision, and writes the centered images and the fitting results. The
-        fitting results contain zeros in case the algorithm could not converge.
+        fitting results contain zeros in case the algorithm could not converge. The fit uses an
+        analytic Jacobian and is only evaluated at the pixels within the radius. The images of
+        each MEMORY block are fitted in parallel if CPU > 1. The "moments" and "xcorr" methods
+        replace the fit of the individual images by a vectorized estimate for each MEMORY block.
 
         :return: None
         """
 
+        if self.m_method not in ("full", "mean", "moments", "xcorr"):
+            raise ValueError("The centering method should be 'full', 'mean', 'moments', or "
+                             "'xcorr'.")
+
         if self.m_image_out_port is not None:
             self.m_image_out_port.del_all_data()
             self.m_image_out_port.del_all_attributes()
@@ -500,6 +672,7 @@ class StarCenteringModule(ProcessingModule):
             self.m_mask_out_port.del_all_attributes()
 
         memory = self._m_config_port.get_attribute("MEMORY")
+        cpu = self._m_config_port.get_attribute("CPU")
         pixscale = self.m_image_in_port.get_attribute("PIXSCALE")
 
         def _initialize():
@@ -525,96 +698,60 @@ class StarCenteringModule(ProcessingModule):
 
             return ndim, nimages, npix, frames
 
-        def _2d_gaussian((x_grid, y_grid, rr_ap_1d, npix),
-                         x_center,
-                         y_center,
-                         fwhm_x,
-                         fwhm_y,
-                         amp,
-                         theta):
-            rr_ap = np.reshape(rr_ap_1d, (npix, npix))
-
-            xx_grid, yy_grid = np.meshgrid(x_grid, y_grid)
-            x_diff = xx_grid - x_center
-            y_diff = yy_grid - y_center
+        def _aperture_data(images, write_mask=True):
+            data = np.zeros((images.shape[0], xy_ap.shape[1]))
 
-            sigma_x = fwhm_x/math.sqrt(8.*math.log(2.))
-            sigma_y = fwhm_y/math.sqrt(8.*math.log(2.))
+            for i, image in enumerate(images):
+                if write_mask and self.m_mask_out_port is not None:
+                    mask = np.copy(image)
+                    mask[rr_ap > self.m_radius] = 0.
 
-            a_gauss = 0.5 * ((np.cos(theta)/sigma_x)**2 + (np.sin(theta)/sigma_y)**2)
-            b_gauss = 0.5 * ((np.sin(2.*theta)/sigma_x**2) - (np.sin(2.*theta)/sigma_y**2))
-            c_gauss = 0.5 * ((np.sin(theta)/sigma_x)**2 + (np.cos(theta)/sigma_y)**2)
+                    if self.m_method == "mean":
+                        self.m_mask_out_port.set_all(mask)
+                    else:
+                        self.m_mask_out_port.append(mask, data_dim=3)
 
-            gaussian = amp*np.exp(-(a_gauss*x_diff**2 + b_gauss*x_diff*y_diff + c_gauss*y_diff**2))
-            gaussian = gaussian[rr_ap < self.m_radius]
+                if self.m_sign == "negative":
+                    image = -image + np.abs(np.min(-image))
 
-            return np.ravel(gaussian)
+                data[i, ] = image[aperture]
 
-        def _least_squares(image):
-            npix = image.shape[0]
+            return data
 
-            if npix%2 == 0:
-                x_grid = y_grid = np.linspace(-npix/2+0.5, npix/2-0.5, npix)
-                x_ap = np.linspace(-npix/2+0.5-self.m_guess[0], npix/2-0.5-self.m_guess[0], npix)
-                y_ap = np.linspace(-npix/2+0.5-self.m_guess[1], npix/2-0.5-self.m_guess[1], npix)
-
-            elif npix%2 == 1:
-                x_grid = y_grid = np.linspace(-(npix-1)/2, (npix-1)/2, npix)
-                x_ap = np.linspace(-(npix-1)/2-self.m_guess[0], (npix-1)/2-self.m_guess[0], npix)
-                y_ap = np.linspace(-(npix-1)/2-self.m_guess[1], (npix-1)/2-self.m_guess[1], npix)
-
-            xx_ap, yy_ap = np.meshgrid(x_ap, y_ap)
-            rr_ap = np.sqrt(xx_ap**2+yy_ap**2)
-            rr_ap_1d = np.ravel(rr_ap)
-
-            if self.m_mask_out_port is not None:
-                mask = np.copy(image)
-                mask[rr_ap > self.m_radius] = 0.
-
-                if self.m_method == "mean":
-                    self.m_mask_out_port.set_all(mask)
-                elif self.m_method == "full":
-                    self.m_mask_out_port.append(mask, data_dim=3)
+        def _fit_images(data):
+            if pool is None or data.shape[0] == 1:
+                result = [_fit_gaussian(item, xy_ap, self.m_guess) for item in data]
+            else:
+                result = pool.map(_fit_gaussian_shared, list(data))
 
-            if self.m_sign == "negative":
-                image = -image + np.abs(np.min(-image))
+            popt = np.zeros((len(result), 6))
+            perr = np.zeros((len(result), 6))
 
-            image = image[rr_ap < self.m_radius]
+            for i, item in enumerate(result):
+                popt[i, ] = item[0]
+                perr[i, ] = item[1]
 
-            try:
-                popt, pcov = curve_fit(_2d_gaussian,
-                                       (x_grid, y_grid, rr_ap_1d, npix),
-                                       image,
-                                       p0=self.m_guess,
-                                       sigma=None,
-                                       method='lm')
+                if not item[2]:
+                    self.m_count += 1
 
-                perr = np.sqrt(np.diag(pcov))
+            return popt, perr
 
-            except RuntimeError:
-                popt = np.zeros(6)
-                perr = np.zeros(6)
-                self.m_count += 1
+        def _write_fit(popt, perr):
+            fit_res = np.zeros((popt.shape[0], 12))
 
-            res = np.asarray((popt[0]*pixscale, perr[0]*pixscale,
-                              popt[1]*pixscale, perr[1]*pixscale,
-                              popt[2]*pixscale, perr[2]*pixscale,
-                              popt[3]*pixscale, perr[3]*pixscale,
-                              popt[4], perr[4],
-                              math.degrees(popt[5])%360., math.degrees(perr[5])))
+            for i in range(4):
+                fit_res[:, 2*i] = popt[:, i]*pixscale
+                fit_res[:, 2*i+1] = perr[:, i]*pixscale
 
-            self.m_fit_out_port.append(res, data_dim=2)
+            fit_res[:, 8] = popt[:, 4]
+            fit_res[:, 9] = perr[:, 4]
+            fit_res[:, 10] = np.degrees(popt[:, 5])%360.
+            fit_res[:, 11] = np.degrees(perr[:, 5])
 
-            return popt
+            self.m_fit_out_port.append(fit_res, data_dim=2)
 
         def _centering(image,
-                       fit):
-
-            if self.m_method == "full":
-                popt = _least_squares(np.copy(image))
-
-            elif self.m_method == "mean":
-                popt = fit
+                       popt):
 
             if self.m_interpolation == "spline":
                 im_center = shift(image, (-popt[1], -popt[0]), order=5)
@@ -630,28 +767,84 @@ class StarCenteringModule(ProcessingModule):
 
         ndim, nimages, npix, frames = _initialize()
 
-        if self.m_method == "full":
-            fit = None
+        rr_ap, xy_ap = _fit_aperture(npix, self.m_guess, self.m_radius)
+        aperture = rr_ap < self.m_radius
 
-        elif self.m_method == "mean":
-            im_mean = np.zeros((npix, npix))
+        # multiprocessing crashed on Mac in combination with numpy
+        if sys.platform == "darwin" or cpu == 1 or self.m_method != "full":
+            pool = None
 
-            if ndim == 2:
-                im_mean += self.m_image_in_port[:, :]
+        else:
+            pool = Pool(processes=cpu,
+                        initializer=_init_fit,
+                        initargs=(xy_ap, self.m_guess))
 
-            elif ndim == 3:
-                for i, _ in enumerate(frames[:-1]):
-                    im_mean += np.sum(self.m_image_in_port[frames[i]:frames[i+1], ], axis=0)
+        try:
+            if self.m_method == "mean" or self.m_method == "xcorr":
+                im_mean = np.zeros((npix, npix))
 
-                im_mean /= float(nimages)
+                if ndim == 2:
+                    im_mean += self.m_image_in_port[:, :]
 
-            fit = _least_squares(im_mean)
+                elif ndim == 3:
+                    for i, _ in enumerate(frames[:-1]):
+                        im_mean += np.sum(self.m_image_in_port[frames[i]:frames[i+1], ], axis=0)
 
-        self.apply_function_to_images(_centering,
-                                      self.m_image_in_port,
-                                      self.m_image_out_port,
-                                      "Running StarCenteringModule...",
-                                      func_args=(fit, ))
+                    im_mean /= float(nimages)
+
+                if self.m_method == "mean":
+                    popt, perr = _fit_images(_aperture_data(im_mean[np.newaxis, ]))
+                    _write_fit(popt, perr)
+
+                elif self.m_method == "xcorr":
+                    popt, _ = _fit_images(_aperture_data(im_mean[np.newaxis, ], write_mask=False))
+                    mean_freq = np.conj(np.fft.fftn(im_mean))
+
+                fit = popt[0, ]
+
+            for i, _ in enumerate(frames[:-1]):
+                progress(i, len(frames[:-1]), "Running StarCenteringModule...")
+
+                if ndim == 2:
+                    images = self.m_image_in_port[:, :][np.newaxis, ]
+                elif ndim == 3:
+                    images = self.m_image_in_port[frames[i]:frames[i+1], ]
+
+                if self.m_method == "full":
+                    popt, perr = _fit_images(_aperture_data(images))
+                    _write_fit(popt, perr)
+
+                elif self.m_method == "moments":
+                    popt, converged = _fit_moments(_aperture_data(images), xy_ap)
+                    self.m_count += np.size(converged) - np.count_nonzero(converged)
+                    _write_fit(popt, np.zeros(popt.shape))
+
+                elif self.m_method == "xcorr":
+                    if self.m_mask_out_port is not None:
+                        _aperture_data(images)
+
+                    popt = np.repeat(fit[np.newaxis, ], images.shape[0], axis=0)
+                    popt[:, 1::-1] += _xcorr_shifts(images, mean_freq)
+                    _write_fit(popt, np.zeros(popt.shape))
+
+                elif self.m_method == "mean":
+                    popt = np.repeat(fit[np.newaxis, ], images.shape[0], axis=0)
+
+                if self.m_image_out_port is not None:
+                    im_center = np.zeros(images.shape)
+
+                    for j, item in enumerate(images):
+                        im_center[j, ] = _centering(item, popt[j, ])
+
+                    self.m_image_out_port.append(im_center, data_dim=3)
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        sys.stdout.write("Running StarCenteringModule... [DONE]\n")
+        sys.stdout.flush()
 
         if self.m_count > 0:
             print "2D Gaussian fit could not converge on %s image(s). [WARNING]" % self.m_count
@@ -721,3 +914,361 @@ class ShiftImagesModule(ProcessingModule):
         self.m_image_out_port.add_history_information("Images shifted", str(self.m_shift))
         self.m_image_out_port.copy_attributes_from_input_port(self.m_image_in_port)
         self.m_image_out_port.close_port()
+
+
+# pixel coordinates of the apertures of the 2D Gaussian fit, for each image size, guess, and radius
+_APERTURE_CACHE = {}
+
+# coordinates and initial guess that are stored once in each worker process of the centering
+_FIT_ARGS = None
+
+
+def _fit_aperture(npix,
+                  guess,
+                  radius):
+    """
+    Internal function which returns the distance of each pixel to the position of the initial
+    guess, and the coordinates (x, y) relative to the image center of the pixels that are used
+    for the 2D Gaussian fit. The grids are cached for each image size, guess, and radius.
+
+    :param npix: Number of pixels along each axis of the image.
+    :type npix: int
+    :param guess: Initial parameter values of the fit, starting with the x and y position (pix)
+                  relative to the image center.
+    :type guess: tuple
+    :param radius: Radius (pix) of the aperture around the initial position.
+    :type radius: float
+
+    :return: Distance of each pixel to the initial position and the coordinates (x, y) of the
+             pixels within the aperture with the shape (2, number of pixels).
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+
+    key = (npix, guess[0], guess[1], radius)
+
+    if key not in _APERTURE_CACHE:
+        if npix%2 == 0:
+            grid = np.linspace(-npix/2+0.5, npix/2-0.5, npix)
+        elif npix%2 == 1:
+            grid = np.linspace(-(npix-1)/2, (npix-1)/2, npix)
+
+        xx_grid, yy_grid = np.meshgrid(grid, grid)
+        rr_ap = np.sqrt((xx_grid-guess[0])**2+(yy_grid-guess[1])**2)
+
+        aperture = rr_ap < radius
+        xy_ap = np.vstack((xx_grid[aperture], yy_grid[aperture]))
+
+        _APERTURE_CACHE[key] = (rr_ap, xy_ap)
+
+    return _APERTURE_CACHE[key]
+
+
+def _gaussian_terms(xy_ap,
+                    x_center,
+                    y_center,
+                    fwhm_x,
+                    fwhm_y,
+                    theta):
+    """
+    Internal function which returns the offsets to the center, the standard deviations, and the
+    exponent of a 2D elliptical Gaussian.
+    """
+
+    x_diff = xy_ap[0, ] - x_center
+    y_diff = xy_ap[1, ] - y_center
+
+    sigma_x = fwhm_x/math.sqrt(8.*math.log(2.))
+    sigma_y = fwhm_y/math.sqrt(8.*math.log(2.))
+
+    a_gauss = 0.5 * ((np.cos(theta)/sigma_x)**2 + (np.sin(theta)/sigma_y)**2)
+    b_gauss = 0.5 * ((np.sin(2.*theta)/sigma_x**2) - (np.sin(2.*theta)/sigma_y**2))
+    c_gauss = 0.5 * ((np.sin(theta)/sigma_x)**2 + (np.cos(theta)/sigma_y)**2)
+
+    exponent = a_gauss*x_diff**2 + b_gauss*x_diff*y_diff + c_gauss*y_diff**2
+
+    return x_diff, y_diff, sigma_x, sigma_y, (a_gauss, b_gauss, c_gauss), exponent
+
+
+def _gaussian_2d(xy_ap,
+                 x_center,
+                 y_center,
+                 fwhm_x,
+                 fwhm_y,
+                 amp,
+                 theta):
+    """
+    Internal function for a 2D elliptical Gaussian, evaluated at the pixels of the aperture.
+
+    :param xy_ap: Coordinates (x, y) of the pixels with the shape (2, number of pixels).
+    :type xy_ap: numpy.ndarray
+
+    :return: Gaussian at the pixels of the aperture.
+    :rtype: numpy.ndarray
+    """
+
+    exponent = _gaussian_terms(xy_ap, x_center, y_center, fwhm_x, fwhm_y, theta)[-1]
+
+    return amp*np.exp(-exponent)
+
+
+def _gaussian_2d_jacobian(xy_ap,
+                          x_center,
+                          y_center,
+                          fwhm_x,
+                          fwhm_y,
+                          amp,
+                          theta):
+    """
+    Internal function for the analytic Jacobian of _gaussian_2d with respect to the six
+    parameters.
+
+    :param xy_ap: Coordinates (x, y) of the pixels with the shape (2, number of pixels).
+    :type xy_ap: numpy.ndarray
+
+    :return: Jacobian with the shape (number of pixels, 6).
+    :rtype: numpy.ndarray
+    """
+
+    x_diff, y_diff, sigma_x, sigma_y, coeff, exponent = \
+        _gaussian_terms(xy_ap, x_center, y_center, fwhm_x, fwhm_y, theta)
+
+    a_gauss, b_gauss, c_gauss = coeff
+
+    gauss_norm = np.exp(-exponent)
+    gaussian = amp*gauss_norm
+
+    cos_sq = np.cos(theta)**2
+    sin_sq = np.sin(theta)**2
+    sin_2t = np.sin(2.*theta)
+    cos_2t = np.cos(2.*theta)
+
+    xx_diff = x_diff**2
+    xy_diff = x_diff*y_diff
+    yy_diff = y_diff**2
+
+    fwhm_factor = math.sqrt(8.*math.log(2.))
+
+    jacobian = np.empty((x_diff.size, 6))
+
+    jacobian[:, 0] = gaussian*(2.*a_gauss*x_diff + b_gauss*y_diff)
+    jacobian[:, 1] = gaussian*(b_gauss*x_diff + 2.*c_gauss*y_diff)
+
+    jacobian[:, 2] = gaussian*(cos_sq*xx_diff + sin_2t*xy_diff + sin_sq*yy_diff) / \
+                     (fwhm_factor*sigma_x**3)
+
+    jacobian[:, 3] = gaussian*(sin_sq*xx_diff - sin_2t*xy_diff + cos_sq*yy_diff) / \
+                     (fwhm_factor*sigma_y**3)
+
+    jacobian[:, 4] = gauss_norm
+
+    inv_diff = 1./sigma_x**2 - 1./sigma_y**2
+
+    jacobian[:, 5] = -gaussian*(-0.5*sin_2t*inv_diff*xx_diff +
+                                cos_2t*inv_diff*xy_diff +
+                                0.5*sin_2t*inv_diff*yy_diff)
+
+    return jacobian
+
+
+def _fit_gaussian(data,
+                  xy_ap,
+                  guess):
+    """
+    Internal function to fit a 2D Gaussian to the pixels within the aperture with a non-linear
+    least squares (Levenberg-Marquardt) fit with an analytic Jacobian.
+
+    :param data: Pixel values within the aperture.
+    :type data: numpy.ndarray
+    :param xy_ap: Coordinates (x, y) of the pixels with the shape (2, number of pixels).
+    :type xy_ap: numpy.ndarray
+    :param guess: Initial parameter values.
+    :type guess: tuple
+
+    :return: Best-fit parameters, 1-sigma errors, and a flag which is False if the fit did not
+             converge, in which case the parameters and errors are zero.
+    :rtype: numpy.ndarray, numpy.ndarray, bool
+    """
+
+    try:
+        popt, pcov = curve_fit(_gaussian_2d,
+                               xy_ap,
+                               data,
+                               p0=guess,
+                               sigma=None,
+                               method='lm',
+                               jac=_gaussian_2d_jacobian)
+
+        perr = np.sqrt(np.diag(pcov))
+        converged = True
+
+    except RuntimeError:
+        popt = np.zeros(6)
+        perr = np.zeros(6)
+        converged = False
+
+    return popt, perr, converged
+
+
+def _init_fit(xy_ap,
+              guess):
+    """
+    Internal function which initializes a worker process of the StarCenteringModule with the
+    coordinates of the aperture and the initial guess.
+
+    :return: None
+    """
+
+    global _FIT_ARGS
+
+    _FIT_ARGS = (xy_ap, guess)
+
+
+def _fit_gaussian_shared(data):
+    """
+    Internal function which fits the pixel values of an aperture in a worker process that has
+    been initialized with _init_fit.
+
+    :return: Best-fit parameters, 1-sigma errors, and convergence flag.
+    :rtype: numpy.ndarray, numpy.ndarray, bool
+    """
+
+    return _fit_gaussian(data, *_FIT_ARGS)
+
+
+def _fit_moments(data,
+                 xy_ap):
+    """
+    Internal function which calculates the center, FWHM, amplitude, and angle of the PSF from the
+    intensity-weighted moments of the pixels within the aperture. Negative pixel values are set
+    to zero. The parameters are the same as for _gaussian_2d, with the FWHM calculated along the
+    major and minor axis of the second moments.
+
+    :param data: Pixel values within the aperture with the shape (number of images, number of
+                 pixels).
+    :type data: numpy.ndarray
+    :param xy_ap: Coordinates (x, y) of the pixels with the shape (2, number of pixels).
+    :type xy_ap: numpy.ndarray
+
+    :return: Parameters with the shape (number of images, 6) and a flag which is False if there
+             are no positive pixel values within the aperture, in which case the parameters are
+             zero.
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+
+    weights = np.clip(data, 0., None)
+
+    total = np.sum(weights, axis=1)
+    converged = total > 0.
+    total[~converged] = 1.
+
+    x_center = np.dot(weights, xy_ap[0, ])/total
+    y_center = np.dot(weights, xy_ap[1, ])/total
+
+    cov_xx = np.dot(weights, xy_ap[0, ]**2)/total - x_center**2
+    cov_yy = np.dot(weights, xy_ap[1, ]**2)/total - y_center**2
+    cov_xy = np.dot(weights, xy_ap[0, ]*xy_ap[1, ])/total - x_center*y_center
+
+    theta = 0.5*np.arctan2(2.*cov_xy, cov_xx-cov_yy)
+
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+
+    var_major = cos_theta**2*cov_xx + 2.*sin_theta*cos_theta*cov_xy + sin_theta**2*cov_yy
+    var_minor = sin_theta**2*cov_xx - 2.*sin_theta*cos_theta*cov_xy + cos_theta**2*cov_yy
+
+    popt = np.column_stack((x_center,
+                            y_center,
+                            math.sqrt(8.*math.log(2.))*np.sqrt(np.clip(var_major, 0., None)),
+                            math.sqrt(8.*math.log(2.))*np.sqrt(np.clip(var_minor, 0., None)),
+                            np.amax(data, axis=1),
+                            theta))
+
+    popt[~converged, ] = 0.
+
+    return popt, converged
+
+
+def _xcorr_shifts(images,
+                  ref_freq):
+    """
+    Internal function which calculates the shifts of the images with respect to a reference
+    image from the peak of the cross-correlation, with a parabolic interpolation along each axis
+    for subpixel precision.
+
+    :param images: Stack of images (3D).
+    :type images: numpy.ndarray
+    :param ref_freq: Complex conjugate of the Fourier transform of the reference image.
+    :type ref_freq: numpy.ndarray
+
+    :return: Shifts (y, x) of the images with respect to the reference image with the shape
+             (number of images, 2).
+    :rtype: numpy.ndarray
+    """
+
+    cross_corr = np.fft.ifftn(np.fft.fftn(images, axes=(-2, -1))*ref_freq[np.newaxis, ],
+                              axes=(-2, -1)).real
+
+    nimages = images.shape[0]
+    shape = images.shape[-2:]
+
+    index = np.arange(nimages)
+
+    peak = np.unravel_index(np.argmax(cross_corr.reshape(nimages, -1), axis=1), shape)
+
+    shifts = np.zeros((nimages, 2))
+
+    for i in range(2):
+        peak_min = list(peak)
+        peak_plus = list(peak)
+
+        peak_min[i] = (peak[i]-1)%shape[i]
+        peak_plus[i] = (peak[i]+1)%shape[i]
+
+        corr_0 = cross_corr[index, peak[0], peak[1]]
+        corr_min = cross_corr[index, peak_min[0], peak_min[1]]
+        corr_plus = cross_corr[index, peak_plus[0], peak_plus[1]]
+
+        denominator = 2.*(corr_min - 2.*corr_0 + corr_plus)
+        denominator[denominator == 0.] = np.inf
+
+        shifts[:, i] = peak[i] + (corr_min-corr_plus)/denominator
+        shifts[:, i] = np.where(shifts[:, i] > shape[i]/2., shifts[:, i]-shape[i], shifts[:, i])
+
+    return shifts
+
+
+def _smooth_images(images,
+                   kernel):
+    """
+    Internal function which smooths a stack of images with a separable kernel along the two image
+    axes. The border is reflected without repeating the edge pixels, as with cv2.GaussianBlur.
+
+    :param images: Stack of images (3D).
+    :type images: numpy.ndarray
+    :param kernel: 1D kernel.
+    :type kernel: numpy.ndarray
+
+    :return: Smoothed images.
+    :rtype: numpy.ndarray
+    """
+
+    images = correlate1d(images, kernel, axis=1, mode="mirror")
+
+    return correlate1d(images, kernel, axis=2, mode="mirror")
+
+
+def _argmax_images(images):
+    """
+    Internal function which returns the pixel positions (y, x) of the maximum value in each image
+    of a stack.
+
+    :param images: Stack of images (3D).
+    :type images: numpy.ndarray
+
+    :return: Pixel positions (y, x) with the shape (number of images, 2).
+    :rtype: numpy.ndarray
+    """
+
+    argmax = np.argmax(images.reshape(images.shape[0], -1), axis=1)
+
+    return np.column_stack(np.unravel_index(argmax, images.shape[1:]))
@@ -7,7 +7,8 @@ from PynPoint.ProcessingModules.BackgroundSubtraction import SimpleBackgroundSub
 
 from PynPoint.ProcessingModules.BadPixelCleaning import BadPixelSigmaFilterModule, \
                                                         BadPixelInterpolationModule, \
-                                                        BadPixelMapModule
+                                                        BadPixelMapModule, \
+                                                        BadPixelTimeSeriesModule
 
 from PynPoint.ProcessingModules.DarkAndFlatCalibration import DarkCalibrationModule, \
                                                               FlatCalibrationModule, \
@@ -53,4 +54,4 @@ from PynPoint.ProcessingModules.FluxAndPosition import FakePlanetModule, \
                                                        MCMCsamplingModule, \
                                                        AperturePhotometryModule
 
-from PynPoint.ProcessingModules.DetectionLimits import ContrastCurveModule
+from PynPoint.ProcessingModules.DetectionLimits import ContrastCurveModule, SnrMapModule
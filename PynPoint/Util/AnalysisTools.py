@@ -3,34 +3,243 @@ Functions for analysis of a planet signal.
 """
 
 import math
+import multiprocessing
+
+from collections import OrderedDict
+from sys import platform
 
 import numpy as np
 
-from photutils import aperture_photometry, CircularAperture
+from photutils.geometry import circular_overlap_grid
+from scipy.ndimage import map_coordinates
+from scipy.signal import fftconvolve
+from scipy.sparse import csr_matrix
 from scipy.stats import t
 
 
-def false_alarm(image, x_pos, y_pos, size, ignore):
+_WEIGHTS_CACHE = OrderedDict()
+_RING_CACHE = OrderedDict()
+
+_CACHE_SIZE = 1000
+
+# number of decimals (pix) to which the subpixel offset of an aperture is rounded
+_OFFSET_DECIMALS = 3
+
+# aperture sum maps that are shared with the worker processes of snr_map
+_SUM_MAPS = None
+
+
+def _cache_get(cache, key):
+    """
+    Internal function to retrieve an item from one of the bounded aperture caches. The item is
+    moved to the end of the cache such that the least recently used item is evicted first.
     """
-    Function for the formal t-test for high-contrast imaging at small working angles, as well as
-    the related false positive fraction (Mawet et al. 2014).
 
-    :param image: Input image.
-    :type image: ndarray
+    value = cache.pop(key, None)
+
+    if value is not None:
+        cache[key] = value
+
+    return value
+
+def _cache_insert(cache, key, value):
+    """
+    Internal function to store an item in one of the bounded aperture caches. The least
+    recently used item is removed if the cache is full.
+    """
+
+    if len(cache) >= _CACHE_SIZE:
+        cache.popitem(last=False)
+
+    cache[key] = value
+
+def aperture_weights(x_pos, y_pos, radius):
+    """
+    Function to calculate the exact overlap of a circular aperture with the pixel grid. The pixel
+    convention is the same as for photutils (i.e., the center of the bottom left pixel is located
+    at (0, 0)). The weights only depend on the radius and the subpixel offset of the aperture
+    and are therefore cached and reused for apertures at other positions. The subpixel offset is
+    rounded to 1e-3 pix such that apertures at nearby positions share the same weights.
+
     :param x_pos: Position (pix) along the x-axis.
     :type x_pos: float
     :param y_pos: Position (pix) along the y-axis.
     :type y_pos: float
-    :param size: Aperture radius (pix).
-    :type size: float
-    :param ignore: Ignore neighboring aperture for the noise.
-    :type ignore: bool
+    :param radius: Aperture radius (pix).
+    :type radius: float
 
-    :return: Noise level, SNR, FPF
-    :rtype: float, float, float
+    :return: Index of the first pixel along the y-axis and x-axis, and the 2D array with the
+             overlap weights.
+    :rtype: int, int, ndarray
+    """
+
+    x_min = int(math.floor(x_pos - radius + 0.5))
+    y_min = int(math.floor(y_pos - radius + 0.5))
+
+    key = (radius, round(x_pos-x_min, _OFFSET_DECIMALS), round(y_pos-y_min, _OFFSET_DECIMALS))
+
+    weights = _cache_get(_WEIGHTS_CACHE, key)
+
+    if weights is None:
+        # the weights are calculated at the rounded position
+        x_pos = x_min + key[1]
+        y_pos = y_min + key[2]
+
+        x_max = int(math.ceil(x_pos + radius + 0.5))
+        y_max = int(math.ceil(y_pos + radius + 0.5))
+
+        weights = circular_overlap_grid(x_min-0.5-x_pos,
+                                        x_max-0.5-x_pos,
+                                        y_min-0.5-y_pos,
+                                        y_max-0.5-y_pos,
+                                        x_max-x_min,
+                                        y_max-y_min,
+                                        radius,
+                                        1,
+                                        1)
+
+        _cache_insert(_WEIGHTS_CACHE, key, weights)
+
+    return y_min, x_min, weights
+
+def aperture_matrix(shape, positions, radius):
+    """
+    Function to create a sparse matrix with the exact overlap weights of circular apertures.
+    The aperture sums of an image are obtained with a single matrix-vector product with the
+    flattened image. Pixels outside the image are excluded from the apertures.
+
+    :param shape: Shape of the image (y, x).
+    :type shape: tuple
+    :param positions: Positions (pix) of the apertures, as (x, y) pairs with the shape
+                      (number of apertures, 2).
+    :type positions: ndarray
+    :param radius: Aperture radius (pix).
+    :type radius: float
+
+    :return: Sparse matrix with the shape (number of apertures, number of pixels).
+    :rtype: scipy.sparse.csr_matrix
+    """
+
+    rows = []
+    columns = []
+    values = []
+
+    for i, item in enumerate(positions):
+        y_min, x_min, weights = aperture_weights(item[0], item[1], radius)
+
+        y_index, x_index = np.nonzero(weights)
+
+        y_index += y_min
+        x_index += x_min
+
+        inside = (y_index >= 0) & (y_index < shape[0]) & (x_index >= 0) & (x_index < shape[1])
+
+        rows.append(np.full(np.count_nonzero(inside), i, dtype=np.int64))
+        columns.append(y_index[inside]*shape[1] + x_index[inside])
+        values.append(weights[y_index[inside]-y_min, x_index[inside]-x_min])
+
+    return csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                      shape=(len(positions), shape[0]*shape[1]))
+
+def aperture_sum(image, x_pos, y_pos, radius):
+    """
+    Function to calculate the flux in circular apertures with the exact overlap weights.
+
+    :param image: Input image.
+    :type image: ndarray
+    :param x_pos: Position (pix) along the x-axis. A list of positions can be provided.
+    :type x_pos: float
+    :param y_pos: Position (pix) along the y-axis. A list of positions can be provided.
+    :type y_pos: float
+    :param radius: Aperture radius (pix).
+    :type radius: float
+
+    :return: Aperture sum, or an array with one sum per position.
+    :rtype: float
+    """
+
+    positions = np.column_stack((np.atleast_1d(x_pos), np.atleast_1d(y_pos)))
+    phot = aperture_matrix(image.shape, positions, radius).dot(image.ravel())
+
+    if np.isscalar(x_pos):
+        phot = phot[0]
+
+    return phot
+
+def aperture_sum_stack(images, x_pos, y_pos, radius):
+    """
+    Function to calculate the flux in a circular aperture for each image of a stack. The exact
+    overlap weights are obtained from the cache of aperture_weights, such that the weights are
+    only calculated once for each subpixel offset. The sums of all images are calculated with a
+    single tensor product. Pixels outside the images are excluded from the aperture.
+
+    :param images: Stack of images (3D).
+    :type images: ndarray
+    :param x_pos: Position (pix) along the x-axis, either a single value or one value per image.
+    :type x_pos: float
+    :param y_pos: Position (pix) along the y-axis, either a single value or one value per image.
+    :type y_pos: float
+    :param radius: Aperture radius (pix).
+    :type radius: float
+
+    :return: Aperture sum of each image.
+    :rtype: ndarray
+    """
+
+    if np.isscalar(x_pos) and np.isscalar(y_pos):
+        y_min, x_min, weights = aperture_weights(x_pos, y_pos, radius)
+
+        y_start = max(y_min, 0)
+        x_start = max(x_min, 0)
+        y_end = min(y_min+weights.shape[0], images.shape[1])
+        x_end = min(x_min+weights.shape[1], images.shape[2])
+
+        if y_end <= y_start or x_end <= x_start:
+            return np.zeros(images.shape[0])
+
+        weights = weights[y_start-y_min:y_end-y_min, x_start-x_min:x_end-x_min]
+
+        return np.tensordot(images[:, y_start:y_end, x_start:x_end],
+                            weights,
+                            axes=((1, 2), (0, 1)))
+
+    x_pos = np.broadcast_to(x_pos, (images.shape[0], ))
+    y_pos = np.broadcast_to(y_pos, (images.shape[0], ))
+
+    apertures = [aperture_weights(x_pos[i], y_pos[i], radius) for i in range(images.shape[0])]
+
+    # the weights of all images are padded to a common size
+    size_y = max([item[2].shape[0] for item in apertures])
+    size_x = max([item[2].shape[1] for item in apertures])
+
+    corner = np.zeros((images.shape[0], 2), dtype=np.int64)
+    weights = np.zeros((images.shape[0], size_y, size_x))
+
+    for i, item in enumerate(apertures):
+        corner[i, ] = item[0:2]
+        weights[i, :item[2].shape[0], :item[2].shape[1]] = item[2]
+
+    y_index = corner[:, 0, np.newaxis, np.newaxis] + np.arange(size_y)[np.newaxis, :, np.newaxis]
+    x_index = corner[:, 1, np.newaxis, np.newaxis] + np.arange(size_x)[np.newaxis, np.newaxis, :]
+
+    inside = (y_index >= 0) & (y_index < images.shape[1]) & \
+             (x_index >= 0) & (x_index < images.shape[2])
+
+    weights *= inside
+
+    crops = images[np.arange(images.shape[0])[:, np.newaxis, np.newaxis],
+                   np.clip(y_index, 0, images.shape[1]-1),
+                   np.clip(x_index, 0, images.shape[2]-1)]
+
+    return np.einsum("ijk,ijk->i", crops, weights)
+
+def _ring_apertures(shape, x_pos, y_pos, size, ignore):
+    """
+    Internal function which returns the positions of the apertures around a ring through the
+    specified position. The first aperture is located at the specified position.
     """
 
-    center = (np.size(image, 0)/2., np.size(image, 1)/2.)
+    center = (shape[0]/2., shape[1]/2.)
     radius = math.sqrt((center[0]-y_pos)**2.+(center[1]-x_pos)**2.)
 
     num_ap = int(math.pi*radius/size)
@@ -45,21 +254,84 @@ def false_alarm(image, x_pos, y_pos, size, ignore):
                          "false positive fraction. Increase the lower limit of the "
                          "separation argument." % num_ap)
 
-    ap_phot = np.zeros(num_ap)
-    for i, theta in enumerate(ap_theta):
-        x_tmp = center[1] + (x_pos-center[1])*math.cos(theta) - \
-                            (y_pos-center[0])*math.sin(theta)
-        y_tmp = center[0] + (x_pos-center[1])*math.sin(theta) + \
-                            (y_pos-center[0])*math.cos(theta)
+    x_ap = center[1] + (x_pos-center[1])*np.cos(ap_theta) - (y_pos-center[0])*np.sin(ap_theta)
+    y_ap = center[0] + (x_pos-center[1])*np.sin(ap_theta) + (y_pos-center[0])*np.cos(ap_theta)
+
+    return np.column_stack((x_ap, y_ap))
+
+def _ring_matrix(shape, x_pos, y_pos, size, ignore):
+    """
+    Internal function which returns the (cached) sparse aperture matrix of the rings through
+    the specified positions, together with the number of apertures of each ring.
+    """
+
+    key = (shape, tuple(x_pos), tuple(y_pos), size, ignore)
 
-        aperture = CircularAperture((x_tmp, y_tmp), size)
-        phot_table = aperture_photometry(image, aperture, method='exact')
-        ap_phot[i] = phot_table['aperture_sum']
+    ring = _cache_get(_RING_CACHE, key)
 
-    noise = np.std(ap_phot[1:]) * math.sqrt(1.+1./float(num_ap-1))
-    t_test = (ap_phot[0] - np.mean(ap_phot[1:])) / noise
+    if ring is None:
+        positions = []
+        for i, _ in enumerate(x_pos):
+            positions.append(_ring_apertures(shape, x_pos[i], y_pos[i], size, ignore))
 
-    return noise, t_test, 1. - t.cdf(t_test, num_ap-2)
+        num_ap = np.array([item.shape[0] for item in positions])
+        matrix = aperture_matrix(shape, np.concatenate(positions), size)
+
+        ring = (matrix, num_ap)
+
+        _cache_insert(_RING_CACHE, key, ring)
+
+    return ring
+
+def false_alarm(image, x_pos, y_pos, size, ignore):
+    """
+    Function for the formal t-test for high-contrast imaging at small working angles, as well as
+    the related false positive fraction (Mawet et al. 2014). The apertures of all rings are
+    evaluated with a single sparse matrix product, which is cached for repeated calls with the
+    same positions.
+
+    :param image: Input image.
+    :type image: ndarray
+    :param x_pos: Position (pix) along the x-axis. A list of positions can be provided.
+    :type x_pos: float
+    :param y_pos: Position (pix) along the y-axis. A list of positions can be provided.
+    :type y_pos: float
+    :param size: Aperture radius (pix).
+    :type size: float
+    :param ignore: Ignore neighboring aperture for the noise.
+    :type ignore: bool
+
+    :return: Noise level, SNR, FPF. Arrays with one value per position are returned if a list of
+             positions is provided.
+    :rtype: float, float, float
+    """
+
+    x_list = np.atleast_1d(np.asarray(x_pos, dtype=np.float64))
+    y_list = np.atleast_1d(np.asarray(y_pos, dtype=np.float64))
+
+    if x_list.shape != y_list.shape:
+        raise ValueError("The x_pos and y_pos arguments should have the same length.")
+
+    matrix, num_ap = _ring_matrix(image.shape, x_list, y_list, size, ignore)
+    ap_phot = matrix.dot(image.ravel())
+
+    noise = np.zeros(x_list.size)
+    t_test = np.zeros(x_list.size)
+    fpf = np.zeros(x_list.size)
+
+    count = 0
+    for i, item in enumerate(num_ap):
+        ring = ap_phot[count:count+item]
+        count += item
+
+        noise[i] = np.std(ring[1:]) * math.sqrt(1.+1./float(item-1))
+        t_test[i] = (ring[0] - np.mean(ring[1:])) / noise[i]
+        fpf[i] = 1. - t.cdf(t_test[i], item-2)
+
+    if np.isscalar(x_pos):
+        return noise[0], t_test[0], fpf[0]
+
+    return noise, t_test, fpf
 
 def student_fpf(sigma, radius, size, ignore):
     """
@@ -71,3 +343,170 @@ def student_fpf(sigma, radius, size, ignore):
         num_ap -= 2
 
     return 1. - t.cdf(sigma, num_ap-2, loc=0., scale=1.)
+
+def _aperture_sum_maps(image, radius, oversampling):
+    """
+    Internal function which calculates the aperture sums at all pixels of an image, and at
+    subpixel offsets of 1/oversampling pix, by FFT convolution with the exact overlap weights.
+    The maps are padded with a margin such that apertures that partially overlap with the
+    image are included.
+
+    :return: Interleaved map with the shape ((y + 2*margin)*oversampling,
+             (x + 2*margin)*oversampling), and the margin (pix).
+    :rtype: ndarray, int
+    """
+
+    margin = int(math.ceil(radius)) + 1
+
+    maps = np.zeros((oversampling, oversampling,
+                     image.shape[0]+2*margin, image.shape[1]+2*margin))
+
+    for j in range(oversampling):
+        for i in range(oversampling):
+            y_min, x_min, weights = aperture_weights(float(i)/float(oversampling),
+                                                     float(j)/float(oversampling),
+                                                     radius)
+
+            conv = fftconvolve(image, weights[::-1, ::-1], mode='full')
+
+            # pixel k of the map corresponds to index k+offset of the convolution
+            y_offset = y_min + weights.shape[0] - 1 - margin
+            x_offset = x_min + weights.shape[1] - 1 - margin
+
+            y_start = max(0, -y_offset)
+            x_start = max(0, -x_offset)
+            y_end = min(maps.shape[2], conv.shape[0]-y_offset)
+            x_end = min(maps.shape[3], conv.shape[1]-x_offset)
+
+            maps[j, i, y_start:y_end, x_start:x_end] = \
+                conv[y_start+y_offset:y_end+y_offset, x_start+x_offset:x_end+x_offset]
+
+    maps = np.transpose(maps, (2, 0, 3, 1)).reshape(maps.shape[2]*oversampling,
+                                                    maps.shape[3]*oversampling)
+
+    return maps, margin
+
+def _init_snr_map(maps):
+    """
+    Internal function which stores the aperture sum maps in a worker process.
+    """
+
+    global _SUM_MAPS
+    _SUM_MAPS = maps
+
+def _ring_statistics(task):
+    """
+    Internal function which calculates the SNR and FPF for a group of pixels with the same
+    number of apertures in their rings. The aperture sums are interpolated from the subpixel map.
+    """
+
+    num_ap, x_pix, y_pix, center, ignore, margin, oversampling = task
+
+
+    ap_theta = np.linspace(0, 2.*math.pi, num_ap, endpoint=False)
+
+    if ignore:
+        num_ap -= 2
+        ap_theta = np.delete(ap_theta, [1, np.size(ap_theta)-1])
+
+    x_ap = center[1] + np.outer(x_pix-center[1], np.cos(ap_theta)) - \
+                       np.outer(y_pix-center[0], np.sin(ap_theta))
+    y_ap = center[0] + np.outer(x_pix-center[1], np.sin(ap_theta)) + \
+                       np.outer(y_pix-center[0], np.cos(ap_theta))
+
+    # bilinear interpolation of the aperture sums between the subpixel grid points
+    ap_phot = map_coordinates(_SUM_MAPS,
+                              ((y_ap+margin)*oversampling, (x_ap+margin)*oversampling),
+                              order=1,
+                              mode='constant',
+                              cval=0.)
+
+    noise = np.std(ap_phot[:, 1:], axis=1) * math.sqrt(1.+1./float(num_ap-1))
+    t_test = (ap_phot[:, 0] - np.mean(ap_phot[:, 1:], axis=1)) / noise
+
+    return t_test, 1. - t.cdf(t_test, num_ap-2)
+
+def snr_map(image, size, ignore, oversampling=4, cpu=1):
+    """
+    Function to calculate the SNR and FPF with the Student's t-test (Mawet et al. 2014) at every
+    pixel of an image. The statistic is the same as for false_alarm, with the test aperture
+    centered on each pixel. The aperture sums are calculated with FFT convolutions on a subpixel
+    grid and are bilinearly interpolated at the positions of the reference apertures, so the
+    results differ slightly from false_alarm for a small oversampling. Only pixels for which the
+    ring of apertures lies within the image are evaluated. The pixels are processed in groups of
+    equal number of apertures, in parallel if cpu > 1.
+
+    :param image: Input image.
+    :type image: ndarray
+    :param size: Aperture radius (pix).
+    :type size: float
+    :param ignore: Ignore neighboring aperture for the noise.
+    :type ignore: bool
+    :param oversampling: Number of subpixel positions per pixel, along each axis, at which the
+                         aperture sums are calculated.
+    :type oversampling: int
+    :param cpu: Number of processes.
+    :type cpu: int
+
+    :return: SNR map and FPF map. Pixels outside the evaluated region, or with less than three
+             apertures in their ring, are set to NaN.
+    :rtype: ndarray, ndarray
+    """
+
+    maps, margin = _aperture_sum_maps(image, size, oversampling)
+
+    center = (image.shape[0]/2., image.shape[1]/2.)
+
+    y_grid, x_grid = np.indices(image.shape)
+    radius = np.sqrt((center[0]-y_grid)**2.+(center[1]-x_grid)**2.)
+
+    num_ap = (math.pi*radius/size).astype(int)
+
+    # the ring apertures should be located within the image
+    num_ap[radius+size > min(center)] = 0
+
+    if ignore:
+        num_ap[num_ap-2 < 3] = 0
+    else:
+        num_ap[num_ap < 3] = 0
+
+    # limit the size of the temporary arrays of a task
+    max_size = 2**20
+
+    tasks = []
+    pixels = []
+
+    for item in np.unique(num_ap[num_ap > 0]):
+        index = np.flatnonzero(num_ap == item)
+
+        for chunk in np.array_split(index, int(math.ceil(float(index.size*item)/max_size))):
+            tasks.append((item,
+                          x_grid.flat[chunk].astype(np.float64),
+                          y_grid.flat[chunk].astype(np.float64),
+                          center,
+                          ignore,
+                          margin,
+                          oversampling))
+
+            pixels.append(chunk)
+
+    # multiprocessing crashed on Mac in combination with numpy
+    if platform == "darwin" or cpu == 1:
+        _init_snr_map(maps)
+        results = [_ring_statistics(task) for task in tasks]
+
+    else:
+        pool = multiprocessing.Pool(cpu, _init_snr_map, (maps, ))
+        results = pool.map(_ring_statistics, tasks)
+
+        pool.close()
+        pool.join()
+
+    snr = np.full(image.shape, np.nan)
+    fpf = np.full(image.shape, np.nan)
+
+    for i, item in enumerate(results):
+        snr.flat[pixels[i]] = item[0]
+        fpf.flat[pixels[i]] = item[1]
+
+    return snr, fpf
@@ -0,0 +1,491 @@
+"""
+Functions and classes for image manipulation.
+"""
+
+import math
+
+import numpy as np
+
+from scipy.ndimage import shift, spline_filter, spline_filter1d, map_coordinates, \
+                          affine_transform, binary_dilation
+
+
+# number of pixels beyond which the boundary has a negligible effect (<1e-11) on the cubic
+# spline prefilter of rotate_pixels
+_PREFILTER_MARGIN = 20
+
+# number of pixels around a mask that are used by the cubic spline interpolation of
+# rotate_pixels, including the offset between the center of the rotation and the mask
+_ROTATION_PAD = 3
+
+
+class PsfStamp(object):
+    """
+    Class which stores a PSF template that is repeatedly shifted and added to a stack of images,
+    for example to inject fake planets. The template is cropped to a stamp around the center of
+    the image and the interpolation coefficients (spline coefficients or Fourier transform) of the
+    stamp are calculated only once. Injection therefore scales with the area of the stamp instead
+    of the area of the image.
+    """
+
+    def __init__(self,
+                 psf,
+                 radius=None,
+                 interpolation="spline"):
+        """
+        Constructor of PsfStamp.
+
+        :param psf: PSF template, either a single image (2D) or a stack of images (3D) with one
+                    template per image that the PSF is added to. The PSF should be centered at
+                    half the image size.
+        :type psf: numpy.ndarray
+        :param radius: Radius (pix) of the stamp that is cropped around the center of the PSF.
+                       The full image is used if set to None.
+        :type radius: float
+        :param interpolation: Type of interpolation that is used for shifting the PSF (spline,
+                              bilinear, or fft).
+        :type interpolation: str
+
+        :return: None
+        """
+
+        if interpolation not in ("spline", "bilinear", "fft"):
+            raise ValueError("Interpolation should be fft, spline, or bilinear.")
+
+        psf = np.asarray(psf, dtype=np.float64)
+
+        if psf.ndim not in (2, 3):
+            raise ValueError("The PSF template should be a 2D or 3D array.")
+
+        self.m_interpolation = interpolation
+        self.m_image_shape = psf.shape[-2:]
+
+        if radius is None:
+            self.m_full = True
+            self.m_origin = (0, 0)
+            stamp = psf
+
+        else:
+            # additional margin for the support of the interpolation kernel
+            half = int(math.ceil(radius)) + 3
+
+            center = (self.m_image_shape[0]//2, self.m_image_shape[1]//2)
+
+            y_start = max(center[0]-half, 0)
+            x_start = max(center[1]-half, 0)
+            y_end = min(center[0]+half+1, self.m_image_shape[0])
+            x_end = min(center[1]+half+1, self.m_image_shape[1])
+
+            self.m_full = False
+            self.m_origin = (y_start, x_start)
+            stamp = psf[..., y_start:y_end, x_start:x_end]
+
+        if interpolation == "spline":
+            # same prefilter as applied by scipy.ndimage.shift, along the image axes only
+            coefficients = spline_filter1d(stamp, 5, axis=-2, output=np.float64)
+            self.m_coefficients = spline_filter1d(coefficients, 5, axis=-1, output=np.float64)
+
+        elif interpolation == "bilinear":
+            self.m_coefficients = np.copy(stamp)
+
+        elif interpolation == "fft":
+            self.m_coefficients = np.fft.fftn(stamp, axes=(-2, -1))
+
+            self.m_freq_y = np.fft.fftfreq(stamp.shape[-2])
+            self.m_freq_x = np.fft.fftfreq(stamp.shape[-1])
+
+        self.m_ndim = psf.ndim
+        self.m_stamp_shape = stamp.shape[-2:]
+
+    @property
+    def image_shape(self):
+        """
+        Returns the shape of the images of the original PSF template.
+
+        :return: Image shape (y, x).
+        :rtype: tuple
+        """
+
+        return self.m_image_shape
+
+    def _coefficients(self, index):
+        if self.m_ndim == 2:
+            return self.m_coefficients
+
+        return self.m_coefficients[index, ]
+
+    def _shift_spline(self, index, shift_yx):
+        if self.m_interpolation == "spline":
+            return shift(self._coefficients(index),
+                         shift_yx,
+                         order=5,
+                         mode='reflect',
+                         prefilter=False)
+
+        return shift(self._coefficients(index),
+                     shift_yx,
+                     order=1,
+                     mode='reflect')
+
+    def _shift_fft(self, index, shifts):
+        ramp_y = np.exp(-2.*np.pi*1j*shifts[:, 0, np.newaxis]*self.m_freq_y[np.newaxis, :])
+        ramp_x = np.exp(-2.*np.pi*1j*shifts[:, 1, np.newaxis]*self.m_freq_x[np.newaxis, :])
+
+        if self.m_ndim == 2:
+            psf_fft = self.m_coefficients[np.newaxis, ]
+        else:
+            psf_fft = self.m_coefficients[index, ]
+
+        psf_fft = psf_fft * ramp_y[:, :, np.newaxis] * ramp_x[:, np.newaxis, :]
+
+        return np.fft.ifftn(psf_fft, axes=(-2, -1)).real
+
+    def add_to_images(self,
+                      images,
+                      shifts,
+                      scaling,
+                      index=None):
+        """
+        Function which shifts the PSF and adds it to each image of a stack. The images are
+        modified in place.
+
+        :param images: Stack of images (3D).
+        :type images: numpy.ndarray
+        :param shifts: Shift (pix) of the PSF for each image, as (y, x) pairs with the shape
+                       (number of images, 2).
+        :type shifts: numpy.ndarray
+        :param scaling: Scaling factor of the PSF, either a single value or one value per image.
+        :type scaling: float
+        :param index: Indices of the PSF templates that are used for the images, only required
+                      for a 3D PSF. The first templates are used if set to None.
+        :type index: numpy.ndarray
+
+        :return: None
+        """
+
+        shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 2)
+        scaling = np.broadcast_to(np.asarray(scaling, dtype=np.float64), (images.shape[0], ))
+
+        if index is None:
+            index = np.arange(images.shape[0])
+
+        if self.m_full:
+            if self.m_interpolation == "fft":
+                images += scaling[:, np.newaxis, np.newaxis] * self._shift_fft(index, shifts)
+
+            else:
+                for i in range(images.shape[0]):
+                    images[i, ] += scaling[i] * self._shift_spline(index[i], shifts[i, ])
+
+            return
+
+        # integer part of the shift is applied by the location of the stamp
+        int_shifts = np.floor(shifts).astype(int)
+        sub_shifts = shifts - int_shifts
+
+        if self.m_interpolation == "fft":
+            stamps = self._shift_fft(index, sub_shifts)
+
+        for i in range(images.shape[0]):
+            if self.m_interpolation == "fft":
+                stamp = stamps[i, ]
+            else:
+                stamp = self._shift_spline(index[i], sub_shifts[i, ])
+
+            y_start = self.m_origin[0] + int_shifts[i, 0]
+            x_start = self.m_origin[1] + int_shifts[i, 1]
+
+            y_end = y_start + self.m_stamp_shape[0]
+            x_end = x_start + self.m_stamp_shape[1]
+
+            # part of the stamp that falls within the image
+            y_min = max(0, -y_start)
+            x_min = max(0, -x_start)
+            y_max = self.m_stamp_shape[0] - max(0, y_end-images.shape[1])
+            x_max = self.m_stamp_shape[1] - max(0, x_end-images.shape[2])
+
+            if y_max <= y_min or x_max <= x_min:
+                continue
+
+            images[i, y_start+y_min:y_start+y_max, x_start+x_min:x_start+x_max] += \
+                scaling[i] * stamp[y_min:y_max, x_min:x_max]
+
+
+def scale_image(image,
+                scaling,
+                offset=(0., 0.),
+                output_shape=None):
+    """
+    Function to rescale and shift an image with a single fifth order spline interpolation. The
+    scaling is identical to skimage.transform.rescale (with order=5 and mode="reflect"), including
+    the clipping to the range of the input values, but the shift and an optional crop are applied
+    by the same affine transformation instead of a second interpolation. Pixels that are shifted
+    in from outside the scaled image are set to zero, as with scipy.ndimage.shift.
+
+    :param image: Input image.
+    :type image: numpy.ndarray
+    :param scaling: Scaling factor of the image size.
+    :type scaling: float
+    :param offset: Shift (y, x) of the scaled image (pix). A negative offset can be used to crop
+                   the scaled image, together with *output_shape*.
+    :type offset: tuple, float
+    :param output_shape: Shape (y, x) of the output image. The shape of the scaled image is used
+                         if set to None.
+    :type output_shape: tuple, int
+
+    :return: Scaled and shifted image.
+    :rtype: numpy.ndarray
+    """
+
+    image = np.asarray(image, dtype=np.float64)
+
+    scaled_shape = (int(round(scaling*image.shape[0])), int(round(scaling*image.shape[1])))
+
+    if output_shape is None:
+        output_shape = scaled_shape
+
+    # pixel centers of the scaled image in the pixel coordinates of the input image
+    factor = np.asarray(image.shape, dtype=np.float64)/np.asarray(scaled_shape)
+    offset = np.asarray(offset, dtype=np.float64)
+
+    im_scale = affine_transform(image,
+                                np.diag(factor),
+                                offset=factor*(0.5-offset)-0.5,
+                                output_shape=output_shape,
+                                order=5,
+                                mode="mirror")
+
+    im_scale = np.clip(im_scale, np.amin(image), np.amax(image))
+
+    for i in range(2):
+        position = np.arange(output_shape[i]) - offset[i]
+        outside = (position < 0.) | (position > scaled_shape[i]-1.)
+
+        if i == 0:
+            im_scale[outside, :] = 0.
+        else:
+            im_scale[:, outside] = 0.
+
+    return im_scale
+
+def annulus_mask(shape,
+                 radius_in,
+                 radius_out):
+    """
+    Function to create a mask of the pixels within an annulus. The radius is measured from the
+    center of the image, npix/2, in the same way as the separations of the other modules.
+
+    :param shape: Shape of the image (y, x).
+    :type shape: tuple
+    :param radius_in: Inner radius (pix) of the annulus.
+    :type radius_in: float
+    :param radius_out: Outer radius (pix) of the annulus.
+    :type radius_out: float
+
+    :return: Boolean mask which is True for pixels within the annulus.
+    :rtype: numpy.ndarray
+    """
+
+    y_grid, x_grid = np.indices(shape, dtype=np.float64)
+
+    y_grid -= shape[0]/2.
+    x_grid -= shape[1]/2.
+
+    rr_grid = np.sqrt(x_grid**2+y_grid**2)
+
+    return (rr_grid >= radius_in) & (rr_grid <= radius_out)
+
+def rotation_mask(mask):
+    """
+    Function to pad a mask with the pixels that are used by rotate_pixels for the interpolation
+    at the edge of the mask. Values that are derotated with rotate_pixels at the pixels of *mask*
+    are only interpolated against the image values within the padded mask, instead of the zeros
+    outside *mask*, if the image is known within the padded mask.
+
+    :param mask: Boolean mask of the pixels that are evaluated with rotate_pixels.
+    :type mask: numpy.ndarray
+
+    :return: Boolean mask which is padded by three pixels.
+    :rtype: numpy.ndarray
+    """
+
+    return binary_dilation(mask, structure=np.ones((3, 3)), iterations=_ROTATION_PAD)
+
+def rotate_pixels(image,
+                  angle,
+                  mask):
+    """
+    Function to rotate an image, only evaluated at the pixels of a mask. The values are the same
+    as the values of scipy.ndimage.rotate (with reshape=False and the default spline order and
+    boundary mode) at the pixels of the mask. The spline prefilter is only applied to the
+    bounding box of the input pixels that are required for the mask, with an additional margin
+    of 20 pixels, so both the prefilter and the interpolation scale with the size of the mask
+    instead of the size of the image.
+
+    :param image: Input image.
+    :type image: numpy.ndarray
+    :param angle: Rotation angle (deg), with the same convention as scipy.ndimage.rotate.
+    :type angle: float
+    :param mask: Boolean mask of the pixels that are evaluated.
+    :type mask: numpy.ndarray
+
+    :return: Values of the rotated image at the pixels of the mask.
+    :rtype: numpy.ndarray
+    """
+
+    angle = math.radians(angle)
+
+    y_pix, x_pix = np.nonzero(mask)
+
+    y_pix = y_pix - (image.shape[0]/2. - 0.5)
+    x_pix = x_pix - (image.shape[1]/2. - 0.5)
+
+    y_in = math.cos(angle)*y_pix + math.sin(angle)*x_pix + image.shape[0]/2. - 0.5
+    x_in = -math.sin(angle)*y_pix + math.cos(angle)*x_pix + image.shape[1]/2. - 0.5
+
+    if y_in.size == 0:
+        return np.zeros(0)
+
+    # bounding box of the input pixels, with a margin for the spline prefilter
+    y_min = max(int(math.floor(np.amin(y_in)))-_PREFILTER_MARGIN, 0)
+    y_max = min(int(math.ceil(np.amax(y_in)))+_PREFILTER_MARGIN+1, image.shape[0])
+
+    x_min = max(int(math.floor(np.amin(x_in)))-_PREFILTER_MARGIN, 0)
+    x_max = min(int(math.ceil(np.amax(x_in)))+_PREFILTER_MARGIN+1, image.shape[1])
+
+    if y_min >= y_max or x_min >= x_max:
+        return np.zeros(y_in.size)
+
+    coeff = spline_filter(np.asarray(image[y_min:y_max, x_min:x_max], dtype=np.float64), order=3)
+
+    return map_coordinates(coeff,
+                           (y_in-y_min, x_in-x_min),
+                           order=3,
+                           mode='constant',
+                           cval=0.,
+                           prefilter=False)
+
+class FourierRegistration(object):
+    """
+    Class for the subpixel registration of images with respect to a set of reference images,
+    with the same algorithm as skimage.feature.register_translation (Guizar-Sicairos et al. 2008).
+    The Fourier transforms of the references are calculated only once and the images are
+    registered in batches, with one Fourier transform per image and a local upsampled DFT around
+    the peak of each cross-correlation.
+    """
+
+    def __init__(self,
+                 references,
+                 upsample_factor=1,
+                 template=False):
+        """
+        Constructor of FourierRegistration.
+
+        :param references: Stack of reference images (3D) or a single reference image (2D).
+        :type references: numpy.ndarray
+        :param upsample_factor: Upsampling factor. Images are registered to within
+                                1/upsample_factor of a pixel.
+        :type upsample_factor: float
+        :param template: Average the references into a single template instead of averaging the
+                         shifts with respect to each reference. The cross-correlation is then
+                         calculated only once per image.
+        :type template: bool
+
+        :return: None
+        """
+
+        references = np.asarray(references, dtype=np.float64)
+
+        if references.ndim == 2:
+            references = references[np.newaxis, ]
+
+        self.m_ref_freq = np.fft.fftn(references, axes=(-2, -1))
+
+        if template:
+            self.m_ref_freq = np.mean(self.m_ref_freq, axis=0)[np.newaxis, ]
+
+        self.m_shape = references.shape[-2:]
+        self.m_upsample = float(upsample_factor)
+
+        # integer frequencies of the matrix multiply DFT, as used by register_translation
+        self.m_freq_y = np.fft.ifftshift(np.arange(self.m_shape[0])) - \
+                        np.floor(self.m_shape[0]/2.)
+        self.m_freq_x = np.fft.ifftshift(np.arange(self.m_shape[1])) - \
+                        np.floor(self.m_shape[1]/2.)
+
+    def _upsampled_peak(self, image_product, shifts):
+        """
+        Internal method to refine the shifts with a matrix multiply DFT in a small region around
+        the initial estimate.
+        """
+
+        upsample = self.m_upsample
+
+        shifts = np.round(shifts*upsample)/upsample
+
+        region = int(np.ceil(upsample*1.5))
+        dftshift = np.fix(region/2.)
+
+        offset = dftshift - shifts*upsample
+        sample = np.arange(region, dtype=np.float64)
+
+        # sample positions of the upsampled region, with the shape (images, region)
+        sample_y = sample[np.newaxis, :] - offset[:, 0, np.newaxis]
+        sample_x = sample[np.newaxis, :] - offset[:, 1, np.newaxis]
+
+        row_kernel = np.exp((-2j*np.pi/(self.m_shape[0]*upsample)) *
+                            sample_y[:, :, np.newaxis]*self.m_freq_y[np.newaxis, np.newaxis, :])
+
+        col_kernel = np.exp((-2j*np.pi/(self.m_shape[1]*upsample)) *
+                            self.m_freq_x[np.newaxis, :, np.newaxis]*sample_x[:, np.newaxis, :])
+
+        cross_corr = np.abs(np.matmul(np.matmul(row_kernel, image_product.conj()), col_kernel))
+        cross_corr = cross_corr.reshape(cross_corr.shape[0], -1)
+
+        maxima = np.column_stack(np.unravel_index(np.argmax(cross_corr, axis=1), (region, region)))
+
+        return shifts + (maxima-dftshift)/upsample
+
+    def shifts(self, images):
+        """
+        Method to calculate the shifts that register the images with the references.
+
+        :param images: Stack of images (3D).
+        :type images: numpy.ndarray
+
+        :return: Shifts (y, x) of each image, averaged over the references, with the shape
+                 (number of images, 2).
+        :rtype: numpy.ndarray
+        """
+
+        if images.shape[-2:] != self.m_shape:
+            raise ValueError("The images should have the same shape as the reference images.")
+
+        image_freq = np.fft.fftn(np.asarray(images, dtype=np.float64), axes=(-2, -1)).conj()
+
+        shape = np.asarray(self.m_shape)
+        midpoints = np.fix(shape/2.)
+
+        shifts = np.zeros((images.shape[0], 2))
+
+        for ref_freq in self.m_ref_freq:
+            image_product = ref_freq[np.newaxis, ] * image_freq
+
+            cross_corr = np.abs(np.fft.ifftn(image_product, axes=(-2, -1)))
+            cross_corr = cross_corr.reshape(cross_corr.shape[0], -1)
+
+            maxima = np.column_stack(np.unravel_index(np.argmax(cross_corr, axis=1),
+                                                      self.m_shape)).astype(np.float64)
+
+            maxima = np.where(maxima > midpoints, maxima-shape, maxima)
+
+            if self.m_upsample > 1.:
+                maxima = self._upsampled_peak(image_product, maxima)
+
+            for i, item in enumerate(self.m_shape):
+                if item == 1:
+                    maxima[:, i] = 0.
+
+            shifts += maxima
+
+        return shifts/float(self.m_ref_freq.shape[0])
@@ -4,6 +4,7 @@ import warnings
 import numpy as np
 
 from PynPoint.Core.Pypeline import Pypeline
+from PynPoint.Core.DataIO import DataStorage
 from PynPoint.IOmodules.FitsReading import FitsReadingModule
 from PynPoint.ProcessingModules.BackgroundSubtraction import MeanBackgroundSubtractionModule, SimpleBackgroundSubtractionModule, \
                                                              NoddingBackgroundModule, DitheringBackgroundModule
@@ -209,6 +210,106 @@ class TestBackgroundSubtraction(object):
         assert np.allclose(data[0, 13, 13], 0.05300208049366906, rtol=1e-6, atol=0.)
         assert np.allclose(np.mean(data), 0.0012755430394817146, rtol=1e-3, atol=0.)
 
+    def test_dithering_background_intermediate(self):
+
+        # remove the intermediate results of the previous test
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        for tag in storage.m_data_bank.keys():
+            if tag.startswith("dither_") or tag.startswith("header_dither_"):
+                del storage.m_data_bank[tag]
+
+        storage.close_connection()
+
+        pca_dither3 = DitheringBackgroundModule(name_in="pca_dither3",
+                                                image_in_tag="read",
+                                                image_out_tag="pca_dither3",
+                                                center=((25., 75.), (75., 75.), (75., 25.), (25., 25.)),
+                                                cubes=1,
+                                                size=0.8,
+                                                gaussian=0.1,
+                                                pca_number=5,
+                                                mask_star=0.1,
+                                                bad_pixel=(9, 5., 3),
+                                                combine="mean",
+                                                intermediate=False)
+
+        self.pipeline.add_module(pca_dither3)
+
+        self.pipeline.run_module("pca_dither3")
+
+        data = self.pipeline.get_data("pca_dither3")
+        assert np.allclose(data[0, 13, 13], 0.0530465391626132, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 0.0012752436234406766, rtol=limit, atol=0.)
+        assert data.shape == (80, 28, 28)
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        tags = storage.m_data_bank.keys()
+
+        # only the results that are combined are stored in the central database
+        for i in range(4):
+            assert "dither_mean"+str(i+1) in tags
+            assert "dither_crop"+str(i+1) not in tags
+            assert "dither_star"+str(i+1) not in tags
+            assert "dither_bad"+str(i+1) not in tags
+            assert "dither_bpmap"+str(i+1) not in tags
+
+        storage.close_connection()
+
+    def test_dithering_background_cpu(self):
+
+        pca_dither4 = DitheringBackgroundModule(name_in="pca_dither4",
+                                                image_in_tag="read",
+                                                image_out_tag="pca_dither4",
+                                                center=((25., 75.), (75., 75.), (75., 25.), (25., 25.)),
+                                                cubes=1,
+                                                size=0.8,
+                                                gaussian=0.1,
+                                                pca_number=5,
+                                                mask_star=0.1,
+                                                mask_planet=None,
+                                                bad_pixel=None,
+                                                combine="pca",
+                                                intermediate=False)
+
+        self.pipeline.add_module(pca_dither4)
+
+        # the dither positions are processed in a pool of worker processes with CPU > 1
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["CPU"] = 2
+        self.pipeline.m_data_storage.close_connection()
+
+        self.pipeline.run_module("pca_dither4")
+
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["CPU"] = 1
+        self.pipeline.m_data_storage.close_connection()
+
+        data = self.pipeline.get_data("pca_dither4")
+        assert np.allclose(data[0, 13, 13], 0.05300208049366906, rtol=1e-6, atol=0.)
+        assert np.allclose(np.mean(data), 0.0012755430394817146, rtol=1e-3, atol=0.)
+        assert data.shape == (80, 28, 28)
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        tags = storage.m_data_bank.keys()
+
+        # only the results that are combined are copied to the central database
+        for i in range(4):
+            assert "dither_pca_res"+str(i+1) in tags
+            assert "dither_crop"+str(i+1) not in tags
+            assert "dither_background"+str(i+1) not in tags
+            assert "dither_pca_fit"+str(i+1) not in tags
+
+        storage.close_connection()
+
+        # the temporary databases of the dither positions are removed
+        assert not [item for item in os.listdir(self.test_dir) if item.startswith("dither_")]
+
     def test_nodding_background(self):
 
         read1 = FitsReadingModule(name_in="read1",
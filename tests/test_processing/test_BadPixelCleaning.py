@@ -7,7 +7,8 @@ import numpy as np
 from PynPoint.Core.Pypeline import Pypeline
 from PynPoint.Core.DataIO import DataStorage
 from PynPoint.ProcessingModules.BadPixelCleaning import BadPixelSigmaFilterModule, BadPixelMapModule, \
-                                                        BadPixelInterpolationModule
+                                                        BadPixelInterpolationModule, \
+                                                        BadPixelTimeSeriesModule
 from PynPoint.Util.TestTools import create_config
 
 warnings.simplefilter("always")
@@ -35,8 +36,16 @@ def setup_module():
     flat[:, 22, 22] = -1.
     flat[:, 24, 24] = -1.
 
+    time_series = np.random.normal(loc=0, scale=2e-4, size=(40, 100, 100))
+    time_series[:, 30, 30] += 5e-3
+    time_series[:, 40, 40] = 0.
+    time_series[::2, 50, 50] += 5e-3
+    time_series[0, 60, 60] = 1.
+    time_series[15:28, 70, 70] += 5e-3
+
     h5f = h5py.File(file_in, "w")
     h5f.create_dataset("images", data=images)
+    h5f.create_dataset("time_series", data=time_series)
     h5f.create_dataset("dark", data=dark)
     h5f.create_dataset("flat", data=flat)
     h5f.create_dataset("header_images/STAR_POSITION", data=np.full((40, 2), 50.))
@@ -136,3 +145,144 @@ class TestBadPixelCleaning(object):
         assert np.allclose(np.mean(data), 3.0499629451215465e-07, rtol=limit, atol=0.)
 
         storage.close_connection()
+
+    def test_bad_pixel_interpolation_fast(self):
+
+        interpolation = BadPixelInterpolationModule(name_in="tolerance",
+                                                    image_in_tag="images",
+                                                    bad_pixel_map_tag="bp_map",
+                                                    image_out_tag="tolerance",
+                                                    iterations=100,
+                                                    tolerance=0.9)
+
+        self.pipeline.add_module(interpolation)
+
+        interpolation = BadPixelInterpolationModule(name_in="sparse",
+                                                    image_in_tag="images",
+                                                    bad_pixel_map_tag="bp_map",
+                                                    image_out_tag="sparse",
+                                                    iterations=100,
+                                                    sparse=0.01)
+
+        self.pipeline.add_module(interpolation)
+
+        self.pipeline.run()
+
+        # running the module again overwrites the output instead of appending to it
+        self.pipeline.run_module("sparse")
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["tolerance"]
+        assert np.allclose(data[0, 0, 0], 0.00032486907273264834, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 10, 10], 7.438893938735338e-07, rtol=1e-6, atol=0.)
+        assert np.allclose(data[0, 20, 20], -1.0605272200711733e-05, rtol=1e-6, atol=0.)
+        assert np.allclose(np.mean(data), 3.0482273273282057e-07, rtol=1e-6, atol=0.)
+        assert data.shape == (40, 100, 100)
+
+        data = storage.m_data_bank["sparse"]
+        assert np.allclose(data[0, 0, 0], 0.00032486907273264834, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 10, 10], 8.755796837586202e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 20, 20], -3.4744443627579894e-05, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 2.988935059508087e-07, rtol=limit, atol=0.)
+        assert data.shape == (40, 100, 100)
+
+        storage.close_connection()
+
+    def test_bad_pixel_interpolation_same_tag(self):
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        storage.m_data_bank["same_tag"] = storage.m_data_bank["images"][...]
+
+        storage.close_connection()
+
+        interpolation = BadPixelInterpolationModule(name_in="same_tag",
+                                                    image_in_tag="same_tag",
+                                                    bad_pixel_map_tag="bp_map",
+                                                    image_out_tag="same_tag",
+                                                    iterations=100,
+                                                    sparse=0.01)
+
+        self.pipeline.add_module(interpolation)
+
+        # the images are written in place per block of MEMORY images
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["MEMORY"] = 15
+        self.pipeline.m_data_storage.close_connection()
+
+        self.pipeline.run_module("same_tag")
+
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["MEMORY"] = 100
+        self.pipeline.m_data_storage.close_connection()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["same_tag"]
+        assert np.allclose(data, storage.m_data_bank["sparse"], rtol=limit, atol=0.)
+        assert data.shape == (40, 100, 100)
+
+        storage.close_connection()
+
+    def test_bad_pixel_time_series(self):
+
+        time_series = BadPixelTimeSeriesModule(name_in="time_series",
+                                               image_in_tag="time_series",
+                                               bp_map_out_tag="time_series_map",
+                                               box=5,
+                                               sigma=5.)
+
+        self.pipeline.add_module(time_series)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["time_series_map"]
+
+        assert data[30, 30] == 0.
+        assert data[40, 40] == 0.
+        assert data[50, 50] == 0.
+        assert data[60, 60] == 1.
+        assert data[70, 70] == 0.
+        assert np.mean(data) == 0.9996
+        assert data.shape == (100, 100)
+
+        storage.close_connection()
+
+    def test_bad_pixel_time_series_memory(self):
+
+        time_series = BadPixelTimeSeriesModule(name_in="time_series_memory",
+                                               image_in_tag="time_series",
+                                               bp_map_out_tag="time_series_memory",
+                                               box=5,
+                                               sigma=5.)
+
+        self.pipeline.add_module(time_series)
+
+        # the stack is read in several sections with MEMORY < number of images
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["MEMORY"] = 15
+        self.pipeline.m_data_storage.close_connection()
+
+        self.pipeline.run_module("time_series_memory")
+
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["MEMORY"] = 100
+        self.pipeline.m_data_storage.close_connection()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        # the pixel flickers in one third of the images, all of which are in the same section
+        data = storage.m_data_bank["time_series_memory"]
+        assert data[70, 70] == 0.
+        assert np.array_equal(data, storage.m_data_bank["time_series_map"])
+        assert data.shape == (100, 100)
+
+        storage.close_connection()
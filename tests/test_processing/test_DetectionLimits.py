@@ -9,8 +9,11 @@ from astropy.io import fits
 from PynPoint.Core.Pypeline import Pypeline
 from PynPoint.Core.DataIO import DataStorage
 from PynPoint.IOmodules.FitsReading import FitsReadingModule
-from PynPoint.ProcessingModules.DetectionLimits import ContrastCurveModule
+from PynPoint.ProcessingModules.DetectionLimits import ContrastCurveModule, SnrMapModule
+from PynPoint.ProcessingModules.FluxAndPosition import FakePlanetModule
 from PynPoint.ProcessingModules.PSFpreparation import AngleInterpolationModule
+from PynPoint.ProcessingModules.PSFSubtractionPCA import PcaPsfSubtractionModule
+from PynPoint.Util.AnalysisTools import false_alarm
 from PynPoint.Util.TestTools import create_config, create_star_data
 
 warnings.simplefilter("always")
@@ -90,10 +93,184 @@ class TestDetectionLimits(object):
 
         data = storage.m_data_bank["pca"]
         assert np.allclose(data[9, 68, 49], 5.707647718560735e-05, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), -3.66890878538392e-08, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), -3.6689159656875036e-08, rtol=limit, atol=0.)
 
         data = storage.m_data_bank["pca"]
-        assert np.allclose(data[21, 31, 50], 5.4392925807364694e-05, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), -3.668908785383954e-08, rtol=limit, atol=0.)
+        assert np.allclose(data[21, 31, 50], 5.440008661435812e-05, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), -3.6689159656875036e-08, rtol=limit, atol=0.)
+
+        storage.close_connection()
+
+    def test_contrast_curve_batch(self):
+
+        read = FitsReadingModule(name_in="read_batch",
+                                 image_tag="read_batch")
+
+        self.pipeline.add_module(read)
+
+        angle = AngleInterpolationModule(name_in="angle_batch",
+                                         data_tag="read_batch")
+
+        self.pipeline.add_module(angle)
+
+        contrast = ContrastCurveModule(name_in="contrast_batch",
+                                       image_in_tag="read_batch",
+                                       psf_in_tag="read_batch",
+                                       pca_out_tag="pca_batch",
+                                       contrast_out_tag="limits_batch",
+                                       separation=(0.5, 1.0, 0.4),
+                                       angle=(0., 360., 180.),
+                                       magnitude=(7.5, 1.),
+                                       sigma=5.,
+                                       accuracy=1e-1,
+                                       psf_scaling=1.,
+                                       aperture=0.1,
+                                       ignore=True,
+                                       pca_number=5,
+                                       norm=False,
+                                       cent_size=None,
+                                       edge_size=None,
+                                       extra_rot=0.,
+                                       batch=True)
+
+        self.pipeline.add_module(contrast)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["limits_batch"]
+        assert data.shape == (2, 4)
+        assert np.allclose(data[0, 1], 6.545140839204709, rtol=limit, atol=0.)
+        assert np.allclose(data[1, 1], 6.769178970577196, rtol=limit, atol=0.)
+
+        data = storage.m_data_bank["pca_batch"]
+        assert data.shape == (22, 100, 100)
+
+        storage.close_connection()
+
+    def test_contrast_curve_pca_list(self):
+
+        read = FitsReadingModule(name_in="read_list",
+                                 image_tag="read_list")
+
+        self.pipeline.add_module(read)
+
+        angle = AngleInterpolationModule(name_in="angle_list",
+                                         data_tag="read_list")
+
+        self.pipeline.add_module(angle)
+
+        for name, pca_number in (("single", 5), ("list", [15, 5])):
+            contrast = ContrastCurveModule(name_in="contrast_"+name,
+                                           image_in_tag="read_list",
+                                           psf_in_tag="read_list",
+                                           pca_out_tag=None,
+                                           contrast_out_tag="limits_"+name,
+                                           separation=(0.5, 0.6, 0.1),
+                                           angle=(0., 360., 180.),
+                                           magnitude=(7.5, 1.),
+                                           sigma=5.,
+                                           accuracy=1e-1,
+                                           psf_scaling=1.,
+                                           aperture=0.1,
+                                           ignore=True,
+                                           pca_number=pca_number,
+                                           norm=False,
+                                           cent_size=None,
+                                           edge_size=None,
+                                           extra_rot=0.)
+
+            self.pipeline.add_module(contrast)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["limits_list"]
+        assert data.shape == (2, 1, 4)
+        assert np.allclose(data[0, ], storage.m_data_bank["limits_single"], rtol=limit, atol=0.)
+
+        storage.close_connection()
+
+    def test_snr_map(self):
+
+        read = FitsReadingModule(name_in="read_snr",
+                                 image_tag="read_snr")
+
+        self.pipeline.add_module(read)
+
+        angle = AngleInterpolationModule(name_in="angle_snr",
+                                         data_tag="read_snr")
+
+        self.pipeline.add_module(angle)
+
+        fake = FakePlanetModule(position=(0.5, 90.),
+                                magnitude=5.,
+                                psf_scaling=1.,
+                                interpolation="spline",
+                                name_in="fake_snr",
+                                image_in_tag="read_snr",
+                                psf_in_tag="read_snr",
+                                image_out_tag="fake_snr",
+                                verbose=False)
+
+        self.pipeline.add_module(fake)
+
+        pca = PcaPsfSubtractionModule(pca_numbers=[5, ],
+                                      name_in="pca_snr",
+                                      images_in_tag="fake_snr",
+                                      reference_in_tag="fake_snr",
+                                      res_mean_tag="res_mean_snr",
+                                      res_median_tag=None,
+                                      res_arr_out_tag=None,
+                                      res_rot_mean_clip_tag=None,
+                                      extra_rot=0.)
+
+        self.pipeline.add_module(pca)
+
+        snr = SnrMapModule(name_in="snr_map",
+                           image_in_tag="res_mean_snr",
+                           snr_out_tag="snr_map",
+                           fpf_out_tag="fpf_map",
+                           candidate_out_tag="candidates",
+                           aperture=0.1,
+                           ignore=True,
+                           oversampling=8,
+                           threshold=5.)
+
+        self.pipeline.add_module(snr)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        image = storage.m_data_bank["res_mean_snr"][0, ]
+        _, snr_single, fpf_single = false_alarm(image, 31., 50., 0.1/0.027, True)
+
+        data = storage.m_data_bank["snr_map"]
+        assert data.shape == (1, 100, 100)
+        assert np.allclose(data[0, 50, 31], 4.682212906132191, rtol=1e-6, atol=0.)
+        assert np.allclose(data[0, 50, 31], snr_single, rtol=1e-2, atol=0.)
+        assert np.isnan(data[0, 50, 50])
+        assert np.isnan(data[0, 0, 0])
+
+        data = storage.m_data_bank["fpf_map"]
+        assert np.allclose(data[0, 50, 31], fpf_single, rtol=1e-2, atol=0.)
+
+        # candidates within one aperture radius of the injected planet
+        data = storage.m_data_bank["candidates"][...]
+        assert data.shape[1] == 7
+
+        distance = np.sqrt((data[:, 1]-(50.-0.5/0.027))**2 + (data[:, 2]-50.)**2)
+        planet = data[distance < 0.1/0.027, ]
+
+        assert planet.shape == (1, 7)
+        assert np.allclose(planet[0, 0:3], (0., 29., 50.), rtol=limit, atol=0.)
+        assert np.allclose(planet[0, 3], 0.567, rtol=limit, atol=0.)
+        assert np.allclose(planet[0, 5], 13.981295, rtol=1e-6, atol=0.)
 
         storage.close_connection()
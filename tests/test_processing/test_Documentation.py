@@ -248,12 +248,12 @@ class TestDocumentation(object):
         assert np.allclose(data[0, 10, 10], 0.052958146579313935, rtol=limit, atol=0.)
 
         data = self.pipeline.get_data("im_arr_aligned")
-        assert np.allclose(data[0, 10, 10], 1.1307471842831197e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 10, 10], 1.1308094405110227e-05, rtol=limit, atol=0.)
 
         data = self.pipeline.get_data("im_arr_stacked")
-        assert np.allclose(data[0, 10, 10], 2.5572805947810986e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 10, 10], 2.5569386291164023e-05, rtol=limit, atol=0.)
 
         data = self.pipeline.get_data("res_mean")
-        assert np.allclose(data[38, 22], 0.00018312083384477404, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), -1.598348168584834e-07, rtol=limit, atol=0.)
+        assert np.allclose(data[38, 22], 0.00018312339258886955, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), -1.5985358495988537e-07, rtol=limit, atol=0.)
         assert data.shape == (44, 44)
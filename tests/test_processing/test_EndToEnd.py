@@ -113,6 +113,12 @@ class TestEndToEnd(object):
         assert np.allclose(np.mean(data), 0.00010141595132969683, rtol=limit, atol=0.)
         assert data.shape == (78, 100, 100)
 
+        # running the module again overwrites the output instead of appending to it
+        self.pipeline.run_module("cut_lines")
+
+        data = self.pipeline.get_data("im_cut")
+        assert data.shape == (78, 100, 100)
+
     def test_background(self):
         background = MeanBackgroundSubtractionModule(shift=None,
                                                      cubes=1,
@@ -176,11 +182,11 @@ class TestEndToEnd(object):
 
         data = self.pipeline.get_data("im_center")
 
-        assert np.allclose(data[1, 0, 0], 1.2113798549047296e-06, rtol=limit, atol=0.)
-        assert np.allclose(data[16, 0, 0], 1.0022456564129139e-05, rtol=limit, atol=0.)
-        assert np.allclose(data[50, 0, 0], 1.7024977291686637e-06, rtol=limit, atol=0.)
-        assert np.allclose(data[67, 0, 0], 7.8143774182171561e-07, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), 2.5260676762055473e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[1, 0, 0], 1.2118720879933887e-06, rtol=limit, atol=0.)
+        assert np.allclose(data[16, 0, 0], 1.0019265093129385e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[50, 0, 0], 1.702667813708824e-06, rtol=limit, atol=0.)
+        assert np.allclose(data[67, 0, 0], 7.813685023928112e-07, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 2.5262026631840237e-05, rtol=limit, atol=0.)
         assert data.shape == (78, 200, 200)
 
     def test_remove_frames(self):
@@ -195,11 +201,11 @@ class TestEndToEnd(object):
 
         data = self.pipeline.get_data("im_remove")
 
-        assert np.allclose(data[0, 0, 0], 1.2113798549047296e-06, rtol=limit, atol=0.)
-        assert np.allclose(data[14, 0, 0], 1.0022456564129139e-05, rtol=limit, atol=0.)
-        assert np.allclose(data[47, 0, 0], 1.7024977291686637e-06, rtol=limit, atol=0.)
-        assert np.allclose(data[63, 0, 0], 7.8143774182171561e-07, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), 2.5255308248050269e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 0, 0], 1.2118720879933887e-06, rtol=limit, atol=0.)
+        assert np.allclose(data[14, 0, 0], 1.0019265093129385e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[47, 0, 0], 1.702667813708824e-06, rtol=limit, atol=0.)
+        assert np.allclose(data[63, 0, 0], 7.813685023928112e-07, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 2.5256892415816938e-05, rtol=limit, atol=0.)
         assert data.shape == (74, 200, 200)
 
     def test_subset(self):
@@ -214,8 +220,8 @@ class TestEndToEnd(object):
 
         data = self.pipeline.get_data("im_subset")
 
-        assert np.allclose(data[0, 0, 0], -1.9081971570461925e-06, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), 2.5255308248050275e-05, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 0, 0], -1.908587754333749e-06, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 2.5256892415816904e-05, rtol=limit, atol=0.)
         assert data.shape == (37, 200, 200)
 
     def test_pca(self):
@@ -237,6 +243,6 @@ class TestEndToEnd(object):
 
         data = self.pipeline.get_data("res_mean")
 
-        assert np.allclose(data[154, 99], 0.0004308570688425797, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), 9.372451154992271e-08, rtol=limit, atol=0.)
+        assert np.allclose(data[154, 99], 0.00043086078837446936, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 9.374537060173127e-08, rtol=limit, atol=0.)
         assert data.shape == (200, 200)
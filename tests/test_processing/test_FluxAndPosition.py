@@ -10,9 +10,11 @@ from PynPoint.Core.Pypeline import Pypeline
 from PynPoint.Core.DataIO import DataStorage
 from PynPoint.IOmodules.FitsReading import FitsReadingModule
 from PynPoint.ProcessingModules.FluxAndPosition import FakePlanetModule, SimplexMinimizationModule, \
-                                                       FalsePositiveModule, AperturePhotometryModule
+                                                       FalsePositiveModule, AperturePhotometryModule, \
+                                                       MCMCsamplingModule
 from PynPoint.ProcessingModules.PSFpreparation import AngleInterpolationModule
 from PynPoint.ProcessingModules.PSFSubtractionPCA import PcaPsfSubtractionModule
+from PynPoint.ProcessingModules.StarAlignment import StarExtractionModule
 from PynPoint.Util.TestTools import create_config, create_star_data
 
 warnings.simplefilter("always")
@@ -154,8 +156,8 @@ class TestFluxAndPosition(object):
         data = storage.m_data_bank["snr_fpf"]
         assert np.allclose(data[0, 2], 0.513710034941892, rtol=limit, atol=0.)
         assert np.allclose(data[0, 3], 93.01278750418334, rtol=limit, atol=0.)
-        assert np.allclose(data[0, 4], 11.775360946367874, rtol=limit, atol=0.)
-        assert np.allclose(data[0, 5], 2.9838031156970146e-08, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 4], 11.773913139766405, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 5], 2.98788265240546e-08, rtol=limit, atol=0.)
 
         data = storage.m_data_bank["photometry"]
         assert np.allclose(data[0][0], 0.983374353660573, rtol=limit, atol=0.)
@@ -163,3 +165,413 @@ class TestFluxAndPosition(object):
         assert np.allclose(np.mean(data), 0.9835085649488583, rtol=limit, atol=0.)
 
         storage.close_connection()
+
+    def test_fake_planet_multiple(self):
+
+        read = FitsReadingModule(name_in="read_multiple",
+                                 image_tag="read_multiple")
+
+        self.pipeline.add_module(read)
+
+        angle = AngleInterpolationModule(name_in="angle_multiple",
+                                         data_tag="read_multiple")
+
+        self.pipeline.add_module(angle)
+
+        fake = FakePlanetModule(position=[(0.5, 90.), (0.8, 200.)],
+                                magnitude=[5., 6.],
+                                psf_scaling=1.,
+                                interpolation="spline",
+                                name_in="fake_multiple",
+                                image_in_tag="read_multiple",
+                                psf_in_tag="read_multiple",
+                                image_out_tag="fake_multiple",
+                                verbose=False)
+
+        self.pipeline.add_module(fake)
+
+        fake = FakePlanetModule(position=(0.5, 90.),
+                                magnitude=5.,
+                                psf_scaling=1.,
+                                interpolation="spline",
+                                name_in="fake_single1",
+                                image_in_tag="read_multiple",
+                                psf_in_tag="read_multiple",
+                                image_out_tag="fake_single1",
+                                verbose=False)
+
+        self.pipeline.add_module(fake)
+
+        fake = FakePlanetModule(position=(0.8, 200.),
+                                magnitude=6.,
+                                psf_scaling=1.,
+                                interpolation="spline",
+                                name_in="fake_single2",
+                                image_in_tag="fake_single1",
+                                psf_in_tag="read_multiple",
+                                image_out_tag="fake_single2",
+                                verbose=False)
+
+        self.pipeline.add_module(fake)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["fake_multiple"]
+        assert np.allclose(data, storage.m_data_bank["fake_single2"], rtol=limit, atol=1e-15)
+
+        storage.close_connection()
+
+    def test_fake_planet_stamp(self):
+
+        read = FitsReadingModule(name_in="read_stamp",
+                                 image_tag="read_stamp")
+
+        self.pipeline.add_module(read)
+
+        angle = AngleInterpolationModule(name_in="angle_stamp",
+                                         data_tag="read_stamp")
+
+        self.pipeline.add_module(angle)
+
+        for interpolation in ("spline", "fft"):
+            fake = FakePlanetModule(position=(0.5, 90.),
+                                    magnitude=5.,
+                                    psf_scaling=1.,
+                                    interpolation=interpolation,
+                                    name_in="fake_full_"+interpolation,
+                                    image_in_tag="read_stamp",
+                                    psf_in_tag="read_stamp",
+                                    image_out_tag="fake_full_"+interpolation,
+                                    verbose=False)
+
+            self.pipeline.add_module(fake)
+
+            fake = FakePlanetModule(position=(0.5, 90.),
+                                    magnitude=5.,
+                                    psf_scaling=1.,
+                                    interpolation=interpolation,
+                                    name_in="fake_stamp_"+interpolation,
+                                    image_in_tag="read_stamp",
+                                    psf_in_tag="read_stamp",
+                                    image_out_tag="fake_stamp_"+interpolation,
+                                    verbose=False,
+                                    stamp_radius=0.2)
+
+            self.pipeline.add_module(fake)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        images = np.asarray(storage.m_data_bank["read_stamp"])
+
+        for interpolation in ("spline", "fft"):
+            planet_full = storage.m_data_bank["fake_full_"+interpolation] - images
+            planet_stamp = storage.m_data_bank["fake_stamp_"+interpolation] - images
+
+            assert np.allclose(planet_stamp[:, 49, 31], planet_full[:, 49, 31], rtol=0., atol=1e-5)
+            assert np.allclose(planet_stamp[:, 10, 90], 0., rtol=0., atol=1e-15)
+
+        storage.close_connection()
+
+    def test_false_positive_multiple(self):
+
+        read = FitsReadingModule(name_in="read_false",
+                                 image_tag="read_false")
+
+        self.pipeline.add_module(read)
+
+        false = FalsePositiveModule(position=(31., 49.),
+                                    aperture=0.1,
+                                    ignore=True,
+                                    name_in="false_single",
+                                    image_in_tag="read_false",
+                                    snr_out_tag="snr_single")
+
+        self.pipeline.add_module(false)
+
+        false = FalsePositiveModule(position=[(31., 49.), (70.5, 62.3)],
+                                    aperture=0.1,
+                                    ignore=True,
+                                    name_in="false_multiple",
+                                    image_in_tag="read_false",
+                                    snr_out_tag="snr_multiple")
+
+        self.pipeline.add_module(false)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        single = storage.m_data_bank["snr_single"]
+        multiple = storage.m_data_bank["snr_multiple"]
+
+        assert single.shape == (1, 6)
+        assert multiple.shape == (2, 6)
+        assert np.allclose(multiple[0, ], single[0, ], rtol=limit, atol=0.)
+        assert np.allclose(multiple[1, 0:2], (70.5, 62.3), rtol=limit, atol=0.)
+
+        storage.close_connection()
+
+    def test_simplex_multi_start(self):
+
+        simplex = SimplexMinimizationModule(position=(31., 49.),
+                                            magnitude=5.,
+                                            psf_scaling=-1.,
+                                            name_in="simplex_multi",
+                                            image_in_tag="fake",
+                                            psf_in_tag="read",
+                                            res_out_tag="simplex_res_multi",
+                                            flux_position_tag="flux_position_multi",
+                                            merit="sum",
+                                            aperture=0.05,
+                                            sigma=0.027,
+                                            tolerance=0.1,
+                                            pca_number=2,
+                                            cent_size=None,
+                                            edge_size=None,
+                                            extra_rot=0.,
+                                            n_start=2,
+                                            start_step=1.)
+
+        self.pipeline.add_module(simplex)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        single = storage.m_data_bank["flux_position"]
+        multiple = storage.m_data_bank["flux_position_multi"]
+        n_eval = storage.m_data_bank["header_flux_position_multi/NEVAL"]
+
+        assert n_eval.shape == (2, )
+        assert multiple.shape == (np.sum(n_eval)+1, 6)
+        assert storage.m_data_bank["simplex_res_multi"].shape == (3, 100, 100)
+
+        # the first start is equal to the minimization through the database
+        assert np.allclose(multiple[0, ], single[0, ], rtol=1e-6, atol=0.)
+        assert np.allclose(multiple[1, ], single[1, ], rtol=1e-6, atol=0.)
+
+        assert np.allclose(multiple[-1, ], multiple[np.argmin(multiple[:-1, 5]), ],
+                           rtol=limit, atol=0.)
+        assert multiple[-1, 5] <= np.amin(single[:, 5])
+
+        storage.close_connection()
+
+    def test_simplex_multi_start_float32(self):
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        fake = storage.m_data_bank["fake"]
+
+        storage.m_data_bank["fake_float32"] = fake[...].astype(np.float32)
+        storage.m_data_bank.copy("header_fake", "header_fake_float32")
+
+        for key, value in fake.attrs.items():
+            storage.m_data_bank["fake_float32"].attrs[key] = value
+
+        storage.close_connection()
+
+        simplex = SimplexMinimizationModule(position=(31., 49.),
+                                            magnitude=5.,
+                                            psf_scaling=-1.,
+                                            name_in="simplex_float32",
+                                            image_in_tag="fake_float32",
+                                            psf_in_tag="read",
+                                            res_out_tag="simplex_res_float32",
+                                            flux_position_tag="flux_position_float32",
+                                            merit="sum",
+                                            aperture=0.05,
+                                            sigma=0.027,
+                                            tolerance=0.1,
+                                            pca_number=2,
+                                            cent_size=None,
+                                            edge_size=None,
+                                            extra_rot=0.,
+                                            n_start=2,
+                                            start_step=1.)
+
+        self.pipeline.add_module(simplex)
+
+        self.pipeline.run_module("simplex_float32")
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        multiple = storage.m_data_bank["flux_position_multi"]
+        float32 = storage.m_data_bank["flux_position_float32"]
+        n_eval = storage.m_data_bank["header_flux_position_float32/NEVAL"]
+
+        assert n_eval.shape == (2, )
+        assert float32.shape == (np.sum(n_eval)+1, 6)
+        assert storage.m_data_bank["simplex_res_float32"].shape == (3, 100, 100)
+
+        assert np.allclose(float32[0, ], multiple[0, ], rtol=1e-6, atol=0.)
+        assert np.allclose(float32[-1, 0:5], multiple[-1, 0:5], rtol=1e-2, atol=0.)
+
+        storage.close_connection()
+
+    def test_mcmc_sampling_resume(self):
+
+        np.random.seed(1)
+
+        mcmc = MCMCsamplingModule(param=(0.5, 90., 5.),
+                                  bounds=((0.4, 0.6), (80., 100.), (4., 6.)),
+                                  name_in="mcmc_first",
+                                  image_in_tag="fake",
+                                  psf_in_tag="read",
+                                  chain_out_tag="mcmc_chain",
+                                  nwalkers=6,
+                                  nsteps=3,
+                                  psf_scaling=-1.,
+                                  pca_number=2,
+                                  aperture=0.1,
+                                  mask=0.,
+                                  extra_rot=0.,
+                                  lnprob_out_tag="mcmc_lnprob",
+                                  checkpoint=1,
+                                  sigma=(1e-3, 1e-1, 1e-2))
+
+        self.pipeline.add_module(mcmc)
+        self.pipeline.run_module("mcmc_first")
+
+        chain_first = self.pipeline.get_data("mcmc_chain")
+
+        assert chain_first.shape == (6, 3, 3)
+        assert self.pipeline.get_data("mcmc_chain_checkpoint").shape == (3, 6, 4)
+
+        mcmc = MCMCsamplingModule(param=(0.5, 90., 5.),
+                                  bounds=((0.4, 0.6), (80., 100.), (4., 6.)),
+                                  name_in="mcmc_resume",
+                                  image_in_tag="fake",
+                                  psf_in_tag="read",
+                                  chain_out_tag="mcmc_chain",
+                                  nwalkers=6,
+                                  nsteps=5,
+                                  psf_scaling=-1.,
+                                  pca_number=2,
+                                  aperture=0.1,
+                                  mask=0.,
+                                  extra_rot=0.,
+                                  lnprob_out_tag="mcmc_lnprob",
+                                  resume=True,
+                                  sigma=(1e-3, 1e-1, 1e-2))
+
+        self.pipeline.add_module(mcmc)
+        self.pipeline.run_module("mcmc_resume")
+
+        # the resumed chain contains the steps of both runs
+        chain = self.pipeline.get_data("mcmc_chain")
+        checkpoint = self.pipeline.get_data("mcmc_chain_checkpoint")
+
+        assert chain.shape == (6, 5, 3)
+        assert checkpoint.shape == (5, 6, 4)
+        assert self.pipeline.get_data("mcmc_lnprob").shape == (6, 5)
+
+        assert np.allclose(chain[:, :3, :], chain_first, rtol=limit, atol=0.)
+        assert np.allclose(np.transpose(checkpoint[:, :, :3], (1, 0, 2)), chain,
+                           rtol=limit, atol=0.)
+
+    def test_mcmc_sampling_tau(self):
+
+        np.random.seed(1)
+
+        mcmc = MCMCsamplingModule(param=(0.5, 90., 5.),
+                                  bounds=((0.4, 0.6), (80., 100.), (4., 6.)),
+                                  name_in="mcmc_tau",
+                                  image_in_tag="fake",
+                                  psf_in_tag="read",
+                                  chain_out_tag="mcmc_chain_tau",
+                                  nwalkers=6,
+                                  nsteps=20,
+                                  psf_scaling=-1.,
+                                  pca_number=2,
+                                  aperture=0.1,
+                                  mask=0.,
+                                  extra_rot=0.,
+                                  tau_step=2,
+                                  tau_factor=1e-3,
+                                  tau_tolerance=1e3,
+                                  sigma=(1e-3, 1e-1, 1e-2))
+
+        self.pipeline.add_module(mcmc)
+        self.pipeline.run_module("mcmc_tau")
+
+        # the sampling stops before nsteps at an estimate of the autocorrelation time
+        chain = self.pipeline.get_data("mcmc_chain_tau")
+
+        assert chain.shape[0] == 6 and chain.shape[2] == 3
+        assert chain.shape[1] < 20
+
+        tau_step = self.pipeline.get_attribute("mcmc_chain_tau", "TAU_STEP", static=False)
+        tau = self.pipeline.get_attribute("mcmc_chain_tau", "TAU", static=False)
+
+        assert np.array_equal(tau_step, np.arange(2, chain.shape[1]+1, 2))
+        assert tau.shape == (tau_step.size, 3)
+        assert np.all(np.isfinite(tau))
+
+    def test_aperture_photometry_star_position(self):
+
+        # move the star from (50, 50) to (y, x) = (62, 43)
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        read = storage.m_data_bank["read"]
+
+        storage.m_data_bank["read_phot"] = np.roll(read[...], (12, -7), axis=(1, 2))
+        storage.m_data_bank.copy("header_read", "header_read_phot")
+
+        for key, value in read.attrs.items():
+            storage.m_data_bank["read_phot"].attrs[key] = value
+
+        storage.close_connection()
+
+        extraction = StarExtractionModule(name_in="extract_phot",
+                                          image_in_tag="read_phot",
+                                          image_out_tag=None,
+                                          image_size=None,
+                                          fwhm_star=0.1,
+                                          position=None)
+
+        self.pipeline.add_module(extraction)
+
+        photometry = AperturePhotometryModule(radius=0.1,
+                                              position="STAR_POSITION",
+                                              name_in="photometry_star",
+                                              image_in_tag="read_phot",
+                                              phot_out_tag="photometry_star")
+
+        self.pipeline.add_module(photometry)
+
+        photometry = AperturePhotometryModule(radius=0.1,
+                                              position=(43., 62.),
+                                              name_in="photometry_xy",
+                                              image_in_tag="read_phot",
+                                              phot_out_tag="photometry_xy")
+
+        self.pipeline.add_module(photometry)
+
+        self.pipeline.run_module("extract_phot")
+        self.pipeline.run_module("photometry_star")
+        self.pipeline.run_module("photometry_xy")
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        star = storage.m_data_bank["header_read_phot/STAR_POSITION"]
+        assert np.allclose(star[:, 0], 62., rtol=limit, atol=0.)
+        assert np.allclose(star[:, 1], 43., rtol=limit, atol=0.)
+
+        data = storage.m_data_bank["photometry_star"]
+        assert data.shape == (40, 1)
+        assert np.allclose(data, storage.m_data_bank["photometry_xy"], rtol=limit, atol=0.)
+        assert np.allclose(data, storage.m_data_bank["photometry"], rtol=limit, atol=0.)
+
+        storage.close_connection()
@@ -105,3 +105,36 @@ class TestPSFSubtractionPCA(object):
         assert np.allclose(data[0, 59, 46], 0.0010154680995154122, rtol=limit, atol=0.)
         assert np.allclose(np.mean(data), -4.708475279640416e-05, rtol=limit, atol=0.)
         assert data.shape == (5, 100, 100)
+
+    def test_psf_subtraction_pca_annulus(self):
+
+        pca = PcaPsfSubtractionModule(pca_numbers=(5, ),
+                                      name_in="pca_annulus",
+                                      images_in_tag="read",
+                                      reference_in_tag="read",
+                                      res_mean_tag="res_mean_annulus",
+                                      res_median_tag=None,
+                                      res_arr_out_tag=None,
+                                      res_rot_mean_clip_tag=None,
+                                      basis_out_tag="basis_annulus",
+                                      extra_rot=-15.,
+                                      verbose=False,
+                                      annulus=(0.2, 0.35))
+
+        self.pipeline.add_module(pca)
+
+        self.pipeline.run_module("pca_annulus")
+
+        data = self.pipeline.get_data("res_mean_annulus")
+        assert np.allclose(data[0, 59, 46], 0.00012849702954405835, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 8.424880962665392e-10, rtol=limit, atol=0.)
+        assert data[0, 50, 50] == 0.
+        assert data[0, 50, 44] == 0.
+        assert data[0, 10, 10] == 0.
+        assert data.shape == (1, 100, 100)
+
+        # the basis is also fitted to the pixels that pad the annulus for the derotation
+        data = self.pipeline.get_data("basis_annulus")
+        assert data[0, 50, 50] == 0.
+        assert data[0, 50, 44] != 0.
+        assert data.shape == (5, 100, 100)
@@ -108,11 +108,316 @@ class TestStarAlignment(object):
         assert data[10, 0] ==  data[10, 1] == 75
 
         data = storage.m_data_bank["shift"]
-        assert np.allclose(data[0, 10, 10], -4.341611534220891e-05, rtol=limit, atol=0.)
-        assert np.allclose(np.mean(data), 0.0005164420068450968, rtol=limit, atol=0.)
+        assert np.allclose(data[0, 10, 10], -4.341797434299268e-05, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 0.0005164407692161042, rtol=limit, atol=0.)
 
         data = storage.m_data_bank["center"]
         assert np.allclose(data[0, 10, 10], 4.128859892625027e-05, rtol=1e-4, atol=0.)
-        assert np.allclose(np.mean(data), 0.0005163806188663894, rtol=1e-7, atol=0.)
+        assert np.allclose(np.mean(data), 0.0005163793911877951, rtol=1e-7, atol=0.)
+
+        storage.close_connection()
+
+    def test_star_alignment_template(self):
+
+        read = FitsReadingModule(name_in="read_template",
+                                 image_tag="read_template")
+
+        self.pipeline.add_module(read)
+
+        extraction = StarExtractionModule(name_in="extract_template",
+                                          image_in_tag="read_template",
+                                          image_out_tag="extract_template",
+                                          image_size=0.6,
+                                          fwhm_star=0.1,
+                                          position=None)
+
+        self.pipeline.add_module(extraction)
+
+        align = StarAlignmentModule(name_in="align_template",
+                                    image_in_tag="extract_template",
+                                    ref_image_in_tag="extract_template",
+                                    image_out_tag="align_template",
+                                    interpolation="fft",
+                                    accuracy=10,
+                                    resize=None,
+                                    num_references=40,
+                                    template=True)
+
+        self.pipeline.add_module(align)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["align_template"]
+        assert np.allclose(data[0, 10, 10], 0.05304008435511765, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 0.0020655767159466613, rtol=limit, atol=0.)
+        assert data.shape == (40, 22, 22)
+
+        storage.close_connection()
+
+    def test_star_alignment_large_shift(self):
+
+        x_grid, y_grid = np.meshgrid(np.arange(40.), np.arange(40.))
+
+        image = np.exp(-((x_grid-20.)**2+(y_grid-20.)**2)/(2.*1.3**2)) + 1e-3
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        storage.m_data_bank["large_shift"] = np.array([image, np.roll(image, (10, 10), axis=(0, 1))])
+        storage.m_data_bank["large_shift"].attrs["PIXSCALE"] = 0.027
+        storage.m_data_bank["large_shift_ref"] = image
+
+        storage.close_connection()
+
+        align = StarAlignmentModule(name_in="align_large_shift",
+                                    image_in_tag="large_shift",
+                                    ref_image_in_tag="large_shift_ref",
+                                    image_out_tag="align_large_shift",
+                                    interpolation="spline",
+                                    accuracy=10,
+                                    resize=2)
+
+        self.pipeline.add_module(align)
+
+        self.pipeline.run_module("align_large_shift")
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        # the flux that is shifted out of the image does not change the flux normalization
+        data = storage.m_data_bank["align_large_shift"]
+        assert data.shape == (2, 80, 80)
+        assert np.allclose(data[1, 30:50, 30:50], data[0, 30:50, 30:50], rtol=1e-6, atol=0.)
+
+        storage.close_connection()
+
+    def test_star_alignment_same_tag(self):
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        storage.m_data_bank["same_tag"] = storage.m_data_bank["large_shift"][...]
+        storage.m_data_bank["same_tag"].attrs["PIXSCALE"] = 0.027
+
+        storage.close_connection()
+
+        for tag in ("align_same_tag", "same_tag"):
+            align = StarAlignmentModule(name_in=tag,
+                                        image_in_tag="same_tag",
+                                        ref_image_in_tag="large_shift_ref",
+                                        image_out_tag=tag,
+                                        interpolation="spline",
+                                        accuracy=10,
+                                        resize=None)
+
+            self.pipeline.add_module(align)
+
+        # the images are written in place per block of MEMORY images
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["MEMORY"] = 1
+        self.pipeline.m_data_storage.close_connection()
+
+        self.pipeline.run_module("align_same_tag")
+        self.pipeline.run_module("same_tag")
+
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["MEMORY"] = 100
+        self.pipeline.m_data_storage.close_connection()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["same_tag"]
+        assert data.shape == (2, 40, 40)
+        assert np.allclose(data, storage.m_data_bank["align_same_tag"], rtol=limit, atol=0.)
+        assert data.attrs["PIXSCALE"] == 0.027
+
+        storage.close_connection()
+
+    def test_star_centering_offset(self):
+
+        offset = np.array([[1.3, -0.7], [-0.4, 0.9], [0.25, 0.6], [-1.1, -0.35]])
+
+        fwhm_x, fwhm_y, theta = 3., 2., 0.3
+
+        sigma_x = fwhm_x/math.sqrt(8.*math.log(2.))
+        sigma_y = fwhm_y/math.sqrt(8.*math.log(2.))
+
+        a_gauss = 0.5 * ((np.cos(theta)/sigma_x)**2 + (np.sin(theta)/sigma_y)**2)
+        b_gauss = 0.5 * ((np.sin(2.*theta)/sigma_x**2) - (np.sin(2.*theta)/sigma_y**2))
+        c_gauss = 0.5 * ((np.sin(theta)/sigma_x)**2 + (np.cos(theta)/sigma_y)**2)
+
+        grid = np.linspace(-19.5, 19.5, 40)
+        x_grid, y_grid = np.meshgrid(grid, grid)
+
+        images = np.zeros((offset.shape[0], 40, 40))
+
+        for i, item in enumerate(offset):
+            x_diff = x_grid - item[0]
+            y_diff = y_grid - item[1]
+
+            images[i, ] = np.exp(-(a_gauss*x_diff**2 + b_gauss*x_diff*y_diff + c_gauss*y_diff**2))
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        storage.m_data_bank["offset"] = images
+        storage.m_data_bank["offset"].attrs["PIXSCALE"] = 0.027
+
+        storage.close_connection()
+
+        for cpu in (1, 2):
+            center = StarCenteringModule(name_in="center_offset"+str(cpu),
+                                         image_in_tag="offset",
+                                         image_out_tag=None,
+                                         mask_out_tag=None,
+                                         fit_out_tag="fit_offset"+str(cpu),
+                                         method="full",
+                                         interpolation="spline",
+                                         radius=0.2,
+                                         sign="positive",
+                                         guess=(0., 0., 2.5, 1.5, 0.8, 0.2))
+
+            self.pipeline.add_module(center)
+
+            # the fits are done in a pool of worker processes with CPU > 1
+            self.pipeline.m_data_storage.open_connection()
+            self.pipeline.m_data_storage.m_data_bank["config"].attrs["CPU"] = cpu
+            self.pipeline.m_data_storage.close_connection()
+
+            self.pipeline.run_module("center_offset"+str(cpu))
+
+        self.pipeline.m_data_storage.open_connection()
+        self.pipeline.m_data_storage.m_data_bank["config"].attrs["CPU"] = 1
+        self.pipeline.m_data_storage.close_connection()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["fit_offset1"]
+        assert data.shape == (4, 12)
+        assert np.allclose(data[:, 0]/0.027, offset[:, 0], rtol=0., atol=1e-6)
+        assert np.allclose(data[:, 2]/0.027, offset[:, 1], rtol=0., atol=1e-6)
+        assert np.allclose(data[:, 4]/0.027, fwhm_x, rtol=1e-6, atol=0.)
+        assert np.allclose(data[:, 6]/0.027, fwhm_y, rtol=1e-6, atol=0.)
+        assert np.allclose(data[:, 8], 1., rtol=1e-6, atol=0.)
+        assert np.allclose(data[:, 10], math.degrees(theta), rtol=1e-6, atol=0.)
+
+        assert np.allclose(storage.m_data_bank["fit_offset2"], data, rtol=limit, atol=0.)
+
+        storage.close_connection()
+
+    def test_star_centering_fast(self):
+
+        read = FitsReadingModule(name_in="read_fast",
+                                 image_tag="read_fast")
+
+        self.pipeline.add_module(read)
+
+        extraction = StarExtractionModule(name_in="extract_fast",
+                                          image_in_tag="read_fast",
+                                          image_out_tag="extract_fast",
+                                          image_size=0.6,
+                                          fwhm_star=0.1,
+                                          position=None)
+
+        self.pipeline.add_module(extraction)
+
+        shift = ShiftImagesModule((0.6, 0.3),
+                                  name_in="shift_fast",
+                                  image_in_tag="extract_fast",
+                                  image_out_tag="shift_fast")
+
+        self.pipeline.add_module(shift)
+
+        for method in ("moments", "xcorr"):
+            center = StarCenteringModule(name_in="center_"+method,
+                                         image_in_tag="shift_fast",
+                                         image_out_tag="center_"+method,
+                                         mask_out_tag="mask_"+method,
+                                         fit_out_tag="fit_"+method,
+                                         method=method,
+                                         interpolation="spline",
+                                         radius=0.1,
+                                         sign="positive",
+                                         guess=(0., 0., 1., 1., 1., 0.))
+
+            self.pipeline.add_module(center)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["fit_moments"]
+        assert np.allclose(np.mean(data[:, 0]), 0.026678682979804046, rtol=1e-6, atol=0.)
+        assert np.allclose(np.mean(data[:, 2]), 0.019344225227006778, rtol=1e-6, atol=0.)
+        assert np.all(data[:, 1::2] == 0.)
+        assert data.shape == (40, 12)
+
+        data = storage.m_data_bank["fit_xcorr"]
+        assert np.allclose(np.mean(data[:, 0]), 0.029698860372850033, rtol=1e-6, atol=0.)
+        assert np.allclose(np.mean(data[:, 2]), 0.021601984139181695, rtol=1e-6, atol=0.)
+        assert np.all(data[:, 1::2] == 0.)
+        assert data.shape == (40, 12)
+
+        data = storage.m_data_bank["center_moments"]
+        assert np.allclose(np.mean(data), 0.002065317929623148, rtol=1e-6, atol=0.)
+        assert data.shape == (40, 22, 22)
+
+        data = storage.m_data_bank["center_xcorr"]
+        assert np.allclose(np.mean(data), 0.0020654350020158766, rtol=1e-6, atol=0.)
+        assert data.shape == (40, 22, 22)
+
+        data = storage.m_data_bank["mask_xcorr"]
+        assert data.shape == (40, 22, 22)
+
+        storage.close_connection()
+
+    def test_star_extraction_tracking(self):
+
+        read = FitsReadingModule(name_in="read_tracking",
+                                 image_tag="read_tracking")
+
+        self.pipeline.add_module(read)
+
+        extraction = StarExtractionModule(name_in="extract_full",
+                                          image_in_tag="read_tracking",
+                                          image_out_tag="extract_full",
+                                          position_out_tag="extract_full",
+                                          image_size=0.6,
+                                          fwhm_star=0.1,
+                                          position=None)
+
+        self.pipeline.add_module(extraction)
+
+        extraction = StarExtractionModule(name_in="extract_tracking",
+                                          image_in_tag="read_tracking",
+                                          image_out_tag="extract_tracking",
+                                          position_out_tag="extract_tracking",
+                                          image_size=0.6,
+                                          fwhm_star=0.1,
+                                          position=None,
+                                          tracking=3.)
+
+        self.pipeline.add_module(extraction)
+
+        self.pipeline.run()
+
+        storage = DataStorage(self.test_dir+"/PynPoint_database.hdf5")
+        storage.open_connection()
+
+        data = storage.m_data_bank["extract_tracking"]
+        assert np.allclose(data[0, 10, 10], 0.05304008435511765, rtol=limit, atol=0.)
+        assert np.allclose(np.mean(data), 0.0020655767159466613, rtol=limit, atol=0.)
+        assert data.shape == (40, 22, 22)
+
+        position_full = storage.m_data_bank["header_extract_full/STAR_POSITION"]
+        position_tracking = storage.m_data_bank["header_extract_tracking/STAR_POSITION"]
+        assert np.array_equal(position_full, position_tracking)
+        assert position_tracking[10, 0] == position_tracking[10, 1] == 75
 
         storage.close_connection()